@@ -1,60 +1,182 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import glob, csv, sys
+import sys
 
 from django.apps import AppConfig
-from django.db.models.signals import post_migrate
+from django.core.paginator import Paginator
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
+from django.db.models import Q, QuerySet
 from django.utils.dateparse import parse_datetime
 from django.utils.timezone import make_aware
 
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, PageNumberPagination
+
+class IteratorPaginator(Paginator):
+    """
+    Paginator fetching the objects of a page by QuerySet.iterator(), which reads them through a named
+    server-side cursor on PostgreSQL instead of loading the whole result into the client at once
+    """
+
+    def page(self, number):
+        page = super(IteratorPaginator, self).page(number)
+        if isinstance(page.object_list, QuerySet):
+            page.object_list = list(page.object_list.iterator())
+        return page
+
 
 class LimitPageNumberPagination(PageNumberPagination):
+    django_paginator_class = IteratorPaginator
     page_size_query_param = 'limit'
     max_page_size = 1000
 
 
+class KeysetPagination(CursorPagination):
+    """
+    Cursor pagination which seeks the rows after (or before) the last row of the previous page by its keys,
+    instead of skipping rows with OFFSET. No count query is run, so every page takes the same time
+    however deep it is. The cursors are opaque tokens encoding the keys.
+
+    Attributes
+    ----------
+    ordering : tuple
+        the unique keys of rows. The first one is a datetime field and the last one is the primary key
+    """
+    ordering = ('start_time', 'id')
+    page_size_query_param = 'limit'
+    max_page_size = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request) or Cursor(offset=0, reverse=False, position=None)
+        reverse = self.cursor.reverse
+
+        if self.cursor.position is not None:
+            queryset = queryset.filter(self._seek(self._decode_position(self.cursor.position), reverse))
+
+        ordering = [('-' + key) if reverse else key for key in self.ordering]
+        results = list(queryset.order_by(*ordering)[:self.page_size + 1].iterator())
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if reverse:
+            self.page.reverse()
+
+        # a page reached backward always has the next page, and a page reached forward has the previous one
+        self.has_next = has_more if not reverse else self.cursor.position is not None
+        self.has_previous = has_more if reverse else self.cursor.position is not None
+        return self.page
+
+    def _seek(self, key, reverse):
+        # (time, id) > (t, i) is written as time >= t AND NOT (time = t AND id <= i), which can use the index of time
+        time_field, pk_field = self.ordering
+        time, pk = key
+        if reverse:
+            return Q(**{time_field + '__lte': time}) & ~Q(**{time_field: time, pk_field + '__gte': pk})
+        return Q(**{time_field + '__gte': time}) & ~Q(**{time_field: time, pk_field + '__lte': pk})
+
+    def _encode_position(self, instance):
+        return '{}_{}'.format(getattr(instance, self.ordering[0]).isoformat(), getattr(instance, self.ordering[1]))
+
+    def _decode_position(self, position):
+        time, _, pk = position.rpartition('_')
+        time = parse_datetime(time)
+        if time is None or not pk.isdigit():
+            raise NotFound(self.invalid_cursor_message)
+        return time, int(pk)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        # an empty page reached backward continues from the same position
+        position = self._encode_position(self.page[-1]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self._encode_position(self.page[0]) if self.page else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+
+class TripPagination(LimitPageNumberPagination):
+    """
+    Page number pagination, which switches to the keyset pagination when the 'cursor' parameter is given.
+    An empty cursor starts from the first trip.
+    """
+    cursor_query_param = 'cursor'
+
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if self.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            self.display_page_controls = False
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super(TripPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super(TripPagination, self).get_paginated_response(data)
+
+
 def make_aware_datetime(datetime):
     return make_aware(parse_datetime(datetime))
 
 def import_data(sender, **kwargs):
     """
-        Import trip history data from csv files.
+        Import trip history data from csv, csv.gz or zip files in the data folder.
     """
 
-    from .models import Station, Trip
+    from .importer import find_data_files, import_files
 
     print('-- importing Trip data --')
 
-    files = glob.glob("./data/*.csv")
-    count = 0
-    for file in files:
-        with open(file) as f:
-            reader = csv.reader(f, doublequote=True, lineterminator='\r\n', quotechar=str('"'), skipinitialspace=True)
-            header = next(reader)
-            for row in reader:                
-                # print(row)
-                trip = Trip(duration=int(row[0]), start_time=make_aware_datetime(row[1]), stop_time=make_aware_datetime(row[2]), bike_id=row[11], is_subscriber=row[12]=='Subscriber', birth_year=int(row[13]), gender=int(row[14]))
-                try:
-                    trip.start_station=Station.objects.get(pk=row[3])
-                except:
-                    trip.start_station_id = int(row[3])
-                try:
-                    trip.stop_station=Station.objects.get(pk=row[7])
-                except:
-                    trip.stop_station_id = int(row[7])
-
-                trip.save()
-
-                count += 1
-
-    print('Loaded {} trips'.format(count))
+    stats = import_files(find_data_files('./data'))
+
+    print(stats)
+    if stats.skipped_files:
+        print('{} files are skipped because they have already been imported'.format(len(stats.skipped_files)))
+    for filename in stats.changed_files:
+        print('{} is skipped because it has changed since it was imported'.format(filename))
+    if stats.unknown_stations:
+        print('{} stations referred by trips are not found'.format(len(stats.unknown_stations)))
 
 class ApisConfig(AppConfig):
     name = 'apis'
 
     def ready(self):
+        from .caching import bump_stations_version, bump_trips_version
+        from .instrumentation import instrument_connection
+        from .partitions import configure_trip_saves, route_trip
+        from .pragmas import configure_connection
+
+        # invalidate cached summaries when trips are saved or deleted one by one
+        Trip = self.get_model('Trip')
+        post_save.connect(bump_trips_version, sender=Trip, dispatch_uid='bump_trips_version_on_save')
+        post_delete.connect(bump_trips_version, sender=Trip, dispatch_uid='bump_trips_version_on_delete')
+        # create the partitions of the months of trips saved one by one (see TRIP_PARTITIONS)
+        pre_save.connect(route_trip, sender=Trip, dispatch_uid='route_trip_to_partition')
+        # only partitions on SQLite need Trip.save() to select the trip before updating it
+        configure_trip_saves()
+
+        # rebuild the spatial index of stations when they change
+        Station = self.get_model('Station')
+        post_save.connect(bump_stations_version, sender=Station, dispatch_uid='bump_stations_version_on_save')
+        post_delete.connect(bump_stations_version, sender=Station, dispatch_uid='bump_stations_version_on_delete')
+
+        # count and time the queries of each request
+        connection_created.connect(instrument_connection, dispatch_uid='instrument_connection')
+        # tune SQLite connections (WAL, page cache, mmap) by SQLITE_PRAGMAS
+        connection_created.connect(configure_connection, dispatch_uid='configure_sqlite_connection')
+
         # import trip data if it is not for a test
         if 'test' not in sys.argv:  
             post_migrate.connect(import_data, sender=self)
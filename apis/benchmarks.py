@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime, multiprocessing, os, random, shutil, sqlite3, tempfile, threading, time
+
+from .apps import make_aware_datetime
+from .timestamps import numpy, parse_timestamp, parse_timestamps
+
+# local hours which don't exist or are ambiguous in America/New_York in 2019. make_aware raises errors for them
+DST_TRANSITION_HOURS = ((datetime.date(2019, 3, 10), 2), (datetime.date(2019, 11, 3), 1))
+
+
+def best_of(func, repeat):
+    """
+    Return the shortest seconds to run the function among the repeated runs
+    """
+    seconds = []
+    for _ in range(repeat):
+        started = time.time()
+        func()
+        seconds.append(time.time() - started)
+    return min(seconds)
+
+
+def _result(seconds, rows):
+    return {'seconds': seconds, 'rows_per_sec': rows / seconds if seconds > 0 else None}
+
+
+def sample_timestamps(rows, seed=0):
+    """
+    Return timestamps of trips in 2019 formatted as the trip history files
+    """
+    generator = random.Random(seed)
+    start = datetime.datetime(2019, 1, 1)
+    values = []
+    while len(values) < rows:
+        value = start + datetime.timedelta(seconds=generator.randint(0, 365 * 24 * 3600 - 1), microseconds=generator.randint(0, 9999) * 100)
+        if (value.date(), value.hour) in DST_TRANSITION_HOURS:
+            continue
+        values.append(str(value.strftime('%Y-%m-%d %H:%M:%S.') + '{:04d}'.format(value.microsecond // 100)))
+    return values
+
+
+def bench_dateparse(rows=100000, repeat=3):
+    """
+    Compare the parsers of trip timestamps: make_aware_datetime (parse_datetime and make_aware),
+    parse_timestamp (per value) and parse_timestamps (per chunk, using numpy when available)
+    """
+    values = sample_timestamps(rows)
+
+    results = {
+        'make_aware_datetime': _result(best_of(lambda: [make_aware_datetime(v) for v in values], repeat), rows),
+        'parse_timestamp': _result(best_of(lambda: [parse_timestamp(v) for v in values], repeat), rows),
+        'parse_timestamps': _result(best_of(lambda: parse_timestamps(values), repeat), rows),
+    }
+    results['parse_timestamps']['numpy'] = numpy is not None
+    return results
+
+
+def bench_export(rows=100000, repeat=3):
+    """
+    Compare serializing the first trips in the database by TripSerializer (as the list API does)
+    with the CSV and NDJSON exports
+    """
+    from .exports import export_response
+    from .models import Trip
+    from .serializers import TripSerializer
+
+    queryset = Trip.objects.order_by('pk')[:rows]
+    rows = queryset.count()
+    fields = [f.name for f in Trip._meta.concrete_fields]
+
+    def export(export_format, compress=False):
+        for _ in export_response(queryset, fields, export_format, compress=compress).streaming_content:
+            pass
+
+    return {
+        'serializer': _result(best_of(lambda: TripSerializer(queryset.select_related('start_station__region', 'stop_station__region'), many=True).data, repeat), rows),
+        'csv': _result(best_of(lambda: export('csv'), repeat), rows),
+        'csv_gzip': _result(best_of(lambda: export('csv', compress=True), repeat), rows),
+        'ndjson': _result(best_of(lambda: export('ndjson'), repeat), rows),
+    }
+
+
+def latencies(func, requests):
+    """
+    Return p50 and p99 of the milliseconds to run the function and the runs per second
+    """
+    from .sketches import percentile
+
+    seconds = []
+    started = time.time()
+    for _ in range(requests):
+        request_started = time.time()
+        func()
+        seconds.append(time.time() - request_started)
+    elapsed = time.time() - started
+    seconds.sort()
+    return {
+        'p50_ms': percentile(seconds, 0.5) * 1000,
+        'p99_ms': percentile(seconds, 0.99) * 1000,
+        'requests_per_sec': requests / elapsed if elapsed > 0 else None,
+    }
+
+
+def _endpoints():
+    """
+    Return (name, path, parameters) of the requests measured by the load benchmark, for the trips in the database
+    """
+    from .models import Station, Trip
+
+    first_date = Trip.objects.order_by('start_date').values_list('start_date', flat=True).first()
+    middle_page = Trip.objects.count() // 200 + 1
+    station = Trip.objects.values_list('start_station', flat=True).order_by('start_time').first()
+    lat, lon = Station.objects.filter(pk=station).values_list('lat', 'lon').first()
+    return [
+        ('stations', '/apis/stations/', {'limit': 100}),
+        ('stations_bbox', '/apis/stations/', {'bbox': '{},{},{},{}'.format(lon - 0.02, lat - 0.02, lon + 0.02, lat + 0.02)}),
+        ('stations_near', '/apis/stations/', {'near': '{},{}'.format(lat, lon), 'k': 10}),
+        ('trips', '/apis/trips/', {'limit': 100}),
+        ('trips_deep_page', '/apis/trips/', {'limit': 100, 'page': middle_page}),
+        ('trips_cursor', '/apis/trips/', {'limit': 100, 'cursor': ''}),
+        ('trips_filtered', '/apis/trips/', {'limit': 100, 'gender': 2, 'start_station': station}),
+        ('summary_by_date', '/apis/trips/summary/', {'group_by': 'start_date', 'agg': 'count,avg', 'field': 'duration'}),
+        ('summary_by_station', '/apis/trips/summary/', {'group_by': 'start_station', 'agg': 'p50,p95', 'field': 'duration'}),
+        ('summary_by_weekday_hour', '/apis/trips/summary/', {'group_by': 'start_weekday,start_hour', 'is_subscriber': 'true'}),
+        ('summary_not_in_rollups', '/apis/trips/summary/', {'group_by': 'stop_station', 'duration_gt': 1800}),
+        ('od_matrix', '/apis/trips/od_matrix/', {'k': 100}),
+        ('export_day', '/apis/trips/export/', {'start_date': first_date.isoformat()}),
+    ]
+
+
+def _client():
+    from django.conf import settings
+    from django.test import Client
+
+    host = next((h for h in settings.ALLOWED_HOSTS if h != '*' and not h.startswith('.')), 'localhost')
+    return Client(HTTP_HOST=host)
+
+
+def _request(client, path, params):
+    from .caching import get_summary_cache
+
+    # the summaries are measured as computed, not as cached
+    get_summary_cache().clear()
+    response = client.get(path, params)
+    if response.streaming:
+        for _ in response.streaming_content:
+            pass
+    if response.status_code != 200:
+        raise ValueError('{} returned {}'.format(path, response.status_code))
+
+
+def bench_load(rows=100000, repeat=3, data=None, requests=20):
+    """
+    Import the synthetic trips by each import mode, and measure the latencies and the throughput of the endpoints
+    on the imported trips. Every change made to the database is rolled back. Run it with the SQLite and the
+    PostgreSQL settings to compare the backends.
+
+    Parameters
+    ----------
+    rows : int
+        the number of synthetic trips generated when data is not given
+
+    repeat : int
+        the number of runs of each import mode. The best one is reported
+
+    data : str
+        the directory written by gen_synthetic_trips. Synthetic trips are generated into a temporary directory if not given
+
+    requests : int
+        the number of requests to each endpoint
+    """
+    from django.conf import settings
+    from django.db import connection, transaction
+    from django.test.utils import override_settings
+    from .importer import find_data_files, import_files
+    from .models import Trip
+    from .synthetic import load_synthetic_stations, write_synthetic_data
+
+    if Trip.objects.exists():
+        raise ValueError('The load benchmark needs an empty Trip table')
+
+    directory = data or tempfile.mkdtemp()
+    try:
+        if data is None:
+            write_synthetic_data(directory, trips=rows, months=3, seed=0)
+        files = find_data_files(directory)
+
+        workers = min(4, multiprocessing.cpu_count())
+        runs = [('bulk', {'mode': 'bulk', 'workers': 1}, files)]
+        if connection.vendor == 'postgresql':
+            # 'bulk' writes by COPY, compared with INSERT statements of bulk_create
+            runs.append(('bulk_insert', {'mode': 'bulk', 'workers': 1, 'copy': False}, files))
+        if workers > 1 and len(files) > 1 and connection.vendor == 'sqlite':
+            # the workers of the other backends commit through their own connections, which can't be rolled back
+            runs.append(('bulk_parallel', {'mode': 'bulk', 'workers': workers}, files))
+        # the original one-by-one save only imports the first file
+        runs.append(('rowwise', {'mode': 'rowwise'}, files[:1]))
+
+        results = {'imports': {}, 'endpoints': {}}
+        for name, options, run_files in runs:
+            best = None
+            for i in range(repeat):
+                import_settings = dict(getattr(settings, 'TRIP_IMPORT', {}), COPY=options.get('copy', True))
+                with transaction.atomic(), override_settings(TRIP_IMPORT=import_settings):
+                    load_synthetic_stations(directory)
+                    stats = import_files(run_files, **dict((k, v) for k, v in options.items() if k != 'copy'))
+                    if best is None or stats.elapsed < best.elapsed:
+                        best = stats
+
+                    if name == 'bulk' and i == 0:
+                        client = _client()
+                        for endpoint, path, params in _endpoints():
+                            results['endpoints'][endpoint] = dict(latencies(lambda: _request(client, path, params), requests), path=path, params=params)
+                    transaction.set_rollback(True)
+
+            results['imports'][name] = dict(_result(best.elapsed, best.rows), rows=best.rows, files=len(run_files), workers=options.get('workers', 1))
+        return results
+    finally:
+        if data is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+# (name, parameters, rollup model) of the summaries measured by the sketches benchmark
+SKETCH_SUMMARIES = (
+    ('percentiles_by_date', {'group_by': 'start_date', 'agg': 'p50,p95', 'field': 'duration'}, 'DailyTripRollup'),
+    ('percentiles_by_station', {'group_by': 'start_station', 'agg': 'p50,p95', 'field': 'duration'}, 'HourlyTripRollup'),
+    ('distinct_bikes_by_hour', {'group_by': 'start_hour', 'agg': 'distinct_bikes', 'start_station': None}, 'HourlyTripRollup'),
+)
+
+
+def bench_sketches(rows=100000, repeat=3):
+    """
+    Measure the percentile and distinct_bikes summaries of synthetic trips merged from the sketches of the rollups
+    (within TRIP_ROLLUP_SKETCH_ROWS and without the limit), and computed without the rollups. Every change made
+    to the database is rolled back.
+    """
+    from django.apps import apps
+    from django.db import transaction
+    from django.test.utils import override_settings
+    from .importer import find_data_files, import_files
+    from .models import Trip
+    from .synthetic import load_synthetic_stations, write_synthetic_data
+
+    if Trip.objects.exists():
+        raise ValueError('The sketches benchmark needs an empty Trip table')
+
+    directory = tempfile.mkdtemp()
+    try:
+        write_synthetic_data(directory, trips=rows, months=3, seed=0)
+        results = {}
+        with transaction.atomic():
+            load_synthetic_stations(directory)
+            import_files(find_data_files(directory))
+            client = _client()
+            station = Trip.objects.values_list('start_station', flat=True).order_by('start_time').first()
+            for name, params, model_name in SKETCH_SUMMARIES:
+                params = dict((k, station if v is None else v) for k, v in params.items())
+                result = {'params': params, 'rollup_rows': apps.get_model('apis', model_name).objects.count()}
+                for run, overrides in (('rollups', {}), ('rollups_unlimited', {'TRIP_ROLLUP_SKETCH_ROWS': None}), ('without_rollups', {'TRIP_ROLLUPS': False})):
+                    with override_settings(**overrides):
+                        result[run + '_ms'] = best_of(lambda: _request(client, '/apis/trips/summary/', params), repeat) * 1000
+                results[name] = result
+            transaction.set_rollback(True)
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# the table written and read by the concurrent reads benchmark, with the indexes of Trip updated by imports
+CONCURRENT_READS_SCHEMA = (
+    'CREATE TABLE trip (id integer PRIMARY KEY, duration integer, start_time datetime, start_date date, '
+    'start_station_id integer, stop_station_id integer, bike_id integer, gender integer, is_subscriber bool)',
+    'CREATE INDEX trip_start_time ON trip (start_time)',
+    'CREATE INDEX trip_start_date ON trip (start_date)',
+    'CREATE INDEX trip_start_station ON trip (start_station_id)',
+)
+
+CONCURRENT_READS_QUERY = (
+    'SELECT start_date, gender, COUNT(*), AVG(duration) FROM trip '
+    'WHERE start_station_id = ? AND is_subscriber = 1 GROUP BY start_date, gender'
+)
+
+
+def _trip_rows(count, start, generator):
+    rows = []
+    for i in range(start, start + count):
+        start_time = datetime.datetime(2019, 1, 1) + datetime.timedelta(seconds=generator.randint(0, 365 * 24 * 3600 - 1))
+        rows.append((i + 1, generator.randint(60, 3600), str(start_time), start_time.date().isoformat(),
+                     generator.randint(1, 350), generator.randint(1, 350), generator.randint(1, 3500), generator.randint(0, 2), generator.random() < 0.8))
+    return rows
+
+
+def _concurrent_reads_run(path, rows, readers, pragmas, bulk_pragmas, batch_size):
+    """
+    Write the second half of the rows in batches while the readers run the query, on a database holding the first half
+    """
+    from .pragmas import apply_pragmas
+    from .sketches import percentile
+
+    generator = random.Random(0)
+    writer = sqlite3.connect(path, isolation_level=None)
+    apply_pragmas(writer, pragmas)
+    for statement in CONCURRENT_READS_SCHEMA:
+        writer.execute(statement)
+    writer.execute('BEGIN')
+    writer.executemany('INSERT INTO trip VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', _trip_rows(rows // 2, 0, generator))
+    writer.execute('COMMIT')
+    apply_pragmas(writer, bulk_pragmas)
+    trips = _trip_rows(rows - rows // 2, rows // 2, generator)
+
+    done = threading.Event()
+    seconds, errors = [], []
+
+    def read(seed):
+        stations = random.Random(seed)
+        reader = sqlite3.connect(path, isolation_level=None)
+        apply_pragmas(reader, pragmas)
+        try:
+            while not done.is_set():
+                started = time.time()
+                try:
+                    reader.execute(CONCURRENT_READS_QUERY, (stations.randint(1, 350),)).fetchall()
+                except sqlite3.OperationalError: # database is locked
+                    errors.append(time.time() - started)
+                    continue
+                seconds.append(time.time() - started)
+        finally:
+            reader.close()
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+
+    started = time.time()
+    try:
+        for offset in range(0, len(trips), batch_size):
+            writer.execute('BEGIN')
+            writer.executemany('INSERT INTO trip VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', trips[offset:offset + batch_size])
+            writer.execute('COMMIT')
+        elapsed = time.time() - started
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+        writer.close()
+
+    seconds.sort()
+    return {
+        'write': _result(elapsed, len(trips)),
+        'reads': len(seconds),
+        'read_p50_ms': percentile(seconds, 0.5) * 1000 if seconds else None,
+        'read_p99_ms': percentile(seconds, 0.99) * 1000 if seconds else None,
+        'read_max_ms': seconds[-1] * 1000 if seconds else None,
+        'locked_errors': len(errors),
+    }
+
+
+def bench_concurrent_reads(rows=100000, repeat=3, readers=4):
+    """
+    Measure the latencies of a summary query run by concurrent readers while trips are written in batches,
+    on a temporary SQLite database. 'rollback_journal' is SQLite's default journal (the readers wait for
+    the commits of the writer), and 'tuned' applies SQLITE_PRAGMAS to the connections and
+    SQLITE_BULK_LOAD_PRAGMAS to the writer, as the import does.
+
+    Parameters
+    ----------
+    rows : int
+        the number of trips. Half of them are written before the readers start
+
+    repeat : int
+        the number of runs of each profile. The one with the shortest p99 of reads is reported
+
+    readers : int
+        the number of threads running the query, each with its own connection
+    """
+    from .importer import get_import_setting
+    from .pragmas import get_bulk_load_pragmas, get_sqlite_pragmas
+
+    profiles = (
+        ('rollback_journal', {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'busy_timeout': 5000}, {}),
+        ('tuned', get_sqlite_pragmas(), get_bulk_load_pragmas()),
+    )
+    results = {}
+    for name, pragmas, bulk_pragmas in profiles:
+        best = None
+        for _ in range(repeat):
+            directory = tempfile.mkdtemp()
+            try:
+                result = _concurrent_reads_run(os.path.join(directory, 'trips.sqlite3'), rows, readers, pragmas, bulk_pragmas, get_import_setting('BATCH_SIZE'))
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            if best is None or (result['read_p99_ms'] is not None and (best['read_p99_ms'] is None or result['read_p99_ms'] < best['read_p99_ms'])):
+                best = result
+        results[name] = dict(best, pragmas=dict(pragmas), bulk_load_pragmas=dict(bulk_pragmas))
+    return results
+
+
+BENCHMARKS = {
+    'concurrent_reads': bench_concurrent_reads,
+    'dateparse': bench_dateparse,
+    'export': bench_export,
+    'load': bench_load,
+    'sketches': bench_sketches,
+}
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed bitmaps of the positions of trips in the columnar store, in the layout of Roaring bitmaps.
+
+Positions are split into chunks of 65536 by their high 16 bits. A chunk with at most 4096 positions is
+kept as a sorted array of the low 16 bits, and a denser chunk as a bitset of 8192 bytes, so a bitmap
+takes at most 2 bytes per position and at most 1 bit per possible position.
+
+A BitmapIndex has a bitmap for each value of a column (e.g. gender or start_date), which are persisted
+next to the arrays of the store and opened as memory maps. The conditions of filters are resolved by
+ANDing and ORing the bitmaps, without reading the columns.
+"""
+from __future__ import unicode_literals
+
+import os
+
+try:
+    import numpy
+except ImportError: # numpy is optional
+    numpy = None
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+ARRAY_MAX = 4096 # the maximum number of positions kept as an array container
+
+ARRAY, BITSET = 0, 1
+
+# the number of 1 bits of each byte
+POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], dtype='uint8') if numpy is not None else None
+
+
+def _is_bitset(container):
+    return container.dtype == numpy.uint8
+
+
+def _cardinality(container):
+    return int(POPCOUNT[container].sum()) if _is_bitset(container) else len(container)
+
+
+def _lows(container):
+    # the low 16 bits of the positions in the container, in ascending order
+    if _is_bitset(container):
+        return numpy.flatnonzero(numpy.unpackbits(container)).astype('uint16')
+    return container
+
+
+def _contains(bitset, lows):
+    lows = lows.astype('int64')
+    return ((bitset[lows >> 3] >> (7 - (lows & 7))) & 1).astype(bool)
+
+
+def _from_mask(mask):
+    # the container of the positions set in the mask of a chunk
+    count = int(mask.sum())
+    if not count:
+        return None
+    if count > ARRAY_MAX:
+        return numpy.packbits(mask)
+    return numpy.flatnonzero(mask).astype('uint16')
+
+
+def _from_lows(lows):
+    if len(lows) > ARRAY_MAX:
+        mask = numpy.zeros(CHUNK_SIZE, dtype=bool)
+        mask[lows] = True
+        return numpy.packbits(mask)
+    return lows
+
+
+def _and(a, b):
+    if _is_bitset(a) and _is_bitset(b):
+        result = a & b
+        return result if _cardinality(result) > ARRAY_MAX else _lows(result)
+    if _is_bitset(a):
+        a, b = b, a
+    if _is_bitset(b):
+        return a[_contains(b, a)]
+    return numpy.intersect1d(a, b, assume_unique=True)
+
+
+class Bitmap(object):
+    """
+    The set of positions of trips
+
+    Attributes
+    ----------
+    containers : dict
+        the high 16 bits of positions -> the container of the low 16 bits (uint16 array or uint8 bitset)
+    """
+
+    def __init__(self, containers=None):
+        self.containers = containers or {}
+
+    @classmethod
+    def from_positions(cls, positions):
+        """
+        Return the bitmap of the positions sorted in ascending order
+        """
+        positions = numpy.asarray(positions, dtype='int64')
+        highs = positions >> CHUNK_BITS
+        keys, starts = numpy.unique(highs, return_index=True)
+        ends = numpy.append(starts[1:], len(positions))
+        return cls(dict((int(key), _from_lows((positions[start:end] & (CHUNK_SIZE - 1)).astype('uint16'))) for key, start, end in zip(keys, starts, ends)))
+
+    def __len__(self):
+        return sum(_cardinality(container) for container in self.containers.values())
+
+    def __and__(self, other):
+        containers = {}
+        for key in set(self.containers) & set(other.containers):
+            container = _and(self.containers[key], other.containers[key])
+            if container is not None and len(container):
+                containers[key] = container
+        return Bitmap(containers)
+
+    def __or__(self, other):
+        return union([self, other])
+
+    def to_positions(self):
+        """
+        Return the positions in ascending order
+        """
+        if not self.containers:
+            return numpy.zeros(0, dtype='int64')
+        return numpy.concatenate([(key << CHUNK_BITS) + _lows(self.containers[key]).astype('int64') for key in sorted(self.containers)])
+
+
+def union(bitmaps):
+    """
+    Return the union of the bitmaps, merging the containers of each chunk at once
+    """
+    chunks = {}
+    for bitmap in bitmaps:
+        for key, container in bitmap.containers.items():
+            chunks.setdefault(key, []).append(container)
+
+    containers = {}
+    for key, parts in chunks.items():
+        if len(parts) == 1:
+            containers[key] = parts[0]
+            continue
+        mask = numpy.zeros(CHUNK_SIZE, dtype=bool)
+        for container in parts:
+            mask[_lows(container)] = True
+        containers[key] = _from_mask(mask)
+    return Bitmap(containers)
+
+
+class BitmapIndex(object):
+    """
+    The bitmaps of the values of a column
+
+    Attributes
+    ----------
+    values : ndarray
+        the distinct values of the column in ascending order
+
+    containers : ndarray
+        (the index of the value, the high 16 bits, ARRAY or BITSET, the offset in data, the number of bytes)
+        of the containers, sorted by the values
+
+    data : ndarray
+        the bytes of the containers
+    """
+
+    def __init__(self, values, containers, data):
+        self.values = values
+        self.containers = containers
+        self.data = data
+
+    @classmethod
+    def build(cls, column):
+        """
+        Build the bitmaps of the values of the column array
+        """
+        order = numpy.argsort(column, kind='mergesort') # the positions of each value stay in ascending order
+        values, starts = numpy.unique(column[order], return_index=True)
+        ends = numpy.append(starts[1:], len(column))
+
+        containers = []
+        parts = []
+        offset = 0
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            bitmap = Bitmap.from_positions(order[start:end])
+            for key in sorted(bitmap.containers):
+                container = bitmap.containers[key]
+                part = container.view('uint8')
+                containers.append((i, key, BITSET if _is_bitset(container) else ARRAY, offset, len(part)))
+                parts.append(part)
+                offset += len(part)
+
+        data = numpy.concatenate(parts) if parts else numpy.zeros(0, dtype='uint8')
+        return cls(values.astype('int64'), numpy.array(containers, dtype='int64').reshape(-1, 5), data)
+
+    def save(self, directory, name):
+        for part in ('values', 'containers', 'data'):
+            numpy.save(os.path.join(directory, '{}.{}.npy'.format(name, part)), getattr(self, part))
+
+    @classmethod
+    def load(cls, directory, name):
+        return cls(*[numpy.load(os.path.join(directory, '{}.{}.npy'.format(name, part)), mmap_mode='r') for part in ('values', 'containers', 'data')])
+
+    def _bitmap(self, i):
+        # the bitmap of the i-th value
+        rows = self.containers[numpy.searchsorted(self.containers[:, 0], i):numpy.searchsorted(self.containers[:, 0], i, side='right')]
+        containers = {}
+        for index, key, kind, offset, length in rows:
+            # views of the memory map
+            part = self.data[offset:offset + length]
+            containers[int(key)] = part if kind == BITSET else part.view('uint16')
+        return Bitmap(containers)
+
+    def equal(self, value):
+        """
+        Return the bitmap of the positions whose value is equal to the value
+        """
+        i = int(numpy.searchsorted(self.values, value))
+        if i < len(self.values) and self.values[i] == value:
+            return self._bitmap(i)
+        return Bitmap()
+
+    def range(self, lower=None, upper=None):
+        """
+        Return the bitmap of the positions whose value is greater than lower and less than upper
+        """
+        start = 0 if lower is None else int(numpy.searchsorted(self.values, lower, side='right'))
+        end = len(self.values) if upper is None else int(numpy.searchsorted(self.values, upper, side='left'))
+        return union([self._bitmap(i) for i in range(start, end)])
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Time buckets of trips, which summaries can be grouped by in addition to the fields of Trip.
+
+The buckets are computed from start_date (the local date) and the local hour of start_time in the database.
+Rollups have start_date and start_hour as columns, so they answer the bucketed summaries as well.
+"""
+from __future__ import unicode_literals
+
+from django.db.models import ExpressionWrapper, F, IntegerField, Value
+from django.db.models.functions import ExtractHour, ExtractMonth, ExtractWeek, ExtractWeekDay
+
+
+def _has_field(model, name):
+    return any(f.name == name for f in model._meta.get_fields())
+
+
+def _hour(model):
+    # the rollups store the local hour, while trips have to extract it from start_time
+    if _has_field(model, 'start_hour'):
+        return F('start_hour')
+    return ExtractHour('start_time')
+
+
+def _weekday(model):
+    # 0 (Sunday) - 6 (Saturday) as getDay() of JavaScript. ExtractWeekDay returns 1 (Sunday) - 7 (Saturday)
+    return ExpressionWrapper(ExtractWeekDay('start_date') - Value(1), output_field=IntegerField())
+
+
+# the names of the buckets -> (the columns which the buckets are computed from, the function returning the expression for a model)
+TIME_BUCKETS = {
+    'start_weekday': (('start_date',), _weekday),
+    'start_hour': (('start_date', 'start_hour'), _hour),
+    'start_week': (('start_date',), lambda model: ExtractWeek('start_date')), # ISO 8601 week number (1 - 53)
+    'start_month': (('start_date',), lambda model: ExtractMonth('start_date')),
+    # 0 (Sunday 0:00 - 1:00) - 167 (Saturday 23:00 - 24:00)
+    'start_hour_of_week': (('start_date', 'start_hour'), lambda model: ExpressionWrapper(_weekday(model) * Value(24) + _hour(model), output_field=IntegerField())),
+}
+
+
+def is_time_bucket(name):
+    return name in TIME_BUCKETS
+
+
+def bucket_columns(name):
+    """
+    Return the columns which the bucket (or the field itself) is computed from
+    """
+    if name in TIME_BUCKETS:
+        return TIME_BUCKETS[name][0]
+    return (name,)
+
+
+def annotate_bucket(queryset, name):
+    """
+    Annotate the queryset with the bucket so that it can be grouped by its name.
+    Fields (including the buckets stored as columns) are left as they are.
+    """
+    if name in TIME_BUCKETS and not _has_field(queryset.model, name):
+        return queryset.annotate(**{name: TIME_BUCKETS[name][1](queryset.model)})
+    return queryset
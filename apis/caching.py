@@ -0,0 +1,319 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import calendar, hashlib, json, threading, time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import six, timezone
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.six.moves import cPickle as pickle
+
+from rest_framework import status
+from rest_framework.response import Response
+
+try:
+    import redis
+except ImportError: # redis is optional, and only needed by RedisCache
+    redis = None
+
+TRIPS = 'trips' # the name of the data version of trips
+STATIONS = 'stations' # the name of the data version of stations
+ROLLUPS = 'rollups' # the name of the version of trips which the rollups summarize
+
+# the query parameters which are not filters but change summaries
+SUMMARY_PARAMS = ('group_by', 'agg', 'field', 'ordering', 'having', 'order_by', 'top')
+
+
+def get_data_version(name=TRIPS):
+    """
+    Return the version number and the last update time of the data
+    """
+    from .models import DataVersion
+
+    row = DataVersion.objects.filter(name=name).values_list('version', 'updated_at').first()
+    return row or (0, None)
+
+
+def bump_data_version(name=TRIPS):
+    """
+    Increment the version of the data, which invalidates the cached results computed from it.
+    Call this in the transaction changing the data.
+    """
+    _save_data_version(name, F('version') + 1, 1)
+
+
+def set_data_version(name, version):
+    """
+    Set the version of the data, e.g. to record the version of the data which another one is built from
+    """
+    _save_data_version(name, version, version)
+
+
+def _save_data_version(name, version, initial):
+    """
+    Update the version of the data to the value or the expression, or create it with the initial version.
+    The row is created in a savepoint, so a conflict with a concurrent writer creating the same row
+    keeps the transaction usable (on PostgreSQL), and the row created by the writer is updated instead.
+    """
+    from .models import DataVersion
+
+    now = timezone.now()
+    if DataVersion.objects.filter(name=name).update(version=version, updated_at=now):
+        return
+    try:
+        with transaction.atomic():
+            DataVersion.objects.create(name=name, version=initial, updated_at=now)
+    except IntegrityError:
+        DataVersion.objects.filter(name=name).update(version=version, updated_at=now)
+
+
+def bump_trips_version(sender, **kwargs):
+    """
+    Signal receiver for the trips saved or deleted one by one (e.g. by loaddata). bulk_create doesn't
+    send signals, so the importer bumps the version by itself.
+    """
+    bump_data_version(TRIPS)
+
+
+def bump_stations_version(sender, **kwargs):
+    """
+    Signal receiver for the stations saved or deleted
+    """
+    bump_data_version(STATIONS)
+
+
+def get_summary_cache():
+    return caches[getattr(settings, 'SUMMARY_CACHE', 'summary')]
+
+
+def _normalized_params(request, filter_class, names):
+    """
+    Return the parameters which decide a summary. Filter values are normalized by the filter form
+    (e.g. 'true' and 'True' are the same), and empty ones are dropped as the filters ignore them.
+    """
+    query_params = request.query_params
+    params = {}
+    for name in names:
+        if query_params.get(name):
+            params[name] = query_params[name]
+    if 'agg' in params:
+        params['agg'] = ','.join(sorted(set(params['agg'].split(','))))
+
+    form = filter_class(query_params, queryset=filter_class._meta.model.objects.none(), request=request).form
+    if form.is_valid():
+        values = form.cleaned_data
+    else:
+        values = dict((name, query_params.get(name)) for name in form.fields)
+    for name, value in values.items():
+        if value not in (None, ''):
+            params['filter:' + name] = getattr(value, 'pk', value)
+
+    return params
+
+
+def cached_summary(request, filter_class, summarize, params=SUMMARY_PARAMS):
+    """
+    Return the response of a summary. The summary is computed by summarize() only when it isn't cached
+    for the parameters of the request and the current version of trips. The ETag and Last-Modified headers
+    let clients revalidate their copies with conditional requests.
+
+    Parameters
+    ----------
+    request : Request
+        the request of the summary
+
+    filter_class : FilterSet
+        the filter class whose values are normalized in the cache key
+
+    summarize : function
+        computes the summary data
+
+    params : tuple
+        the names of the query parameters other than the filters which change the summary
+    """
+    version, updated_at = get_data_version(TRIPS)
+    params = _normalized_params(request, filter_class, params)
+
+    # the update time is a part of the key, so a version number reused after a rollback never hits
+    key_source = json.dumps([request.path, version, updated_at.isoformat() if updated_at else None, sorted((k, six.text_type(v)) for k, v in params.items())])
+    key = 'summary:' + hashlib.sha1(key_source.encode('utf-8')).hexdigest()
+
+    renderer_format = getattr(request.accepted_renderer, 'format', '')
+    etag = '"{}"'.format(hashlib.sha1((key + ':' + renderer_format).encode('utf-8')).hexdigest())
+    last_modified = calendar.timegm(updated_at.utctimetuple()) if updated_at else None
+
+    if _not_modified(request, etag, last_modified):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        cache = get_summary_cache()
+        data = cache.get(key)
+        if data is None:
+            data = summarize()
+            cache.set(key, data)
+        response = Response(data)
+
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # browsers have to revalidate, since trips can be imported at any time
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and last_modified is not None and last_modified <= if_modified_since
+
+
+# Global in-memory store of LRUCache. Keyed by name as LocMemCache
+_caches = {}
+_locks = {}
+
+
+class LRUCache(BaseCache):
+    """
+    Thread-safe in-memory cache backend evicting the least recently used entries.
+    Unlike LocMemCache, which culls arbitrary entries when it is full, frequently requested summaries stay cached.
+
+    OPTIONS['MAX_ENTRIES'] limits the number of entries and TIMEOUT is the time to live of them.
+    """
+
+    def __init__(self, name, params):
+        BaseCache.__init__(self, params)
+        self._cache = _caches.setdefault(name, OrderedDict())
+        self._lock = _locks.setdefault(name, threading.Lock())
+
+    def _get(self, key):
+        # return the pickled value of a live entry, marking it as the most recently used
+        item = self._cache.pop(key, None)
+        if item is None:
+            return None
+        expiry, pickled = item
+        if expiry is not None and expiry <= time.time():
+            return None
+        self._cache[key] = item
+        return pickled
+
+    def _set(self, key, pickled, timeout):
+        self._cache.pop(key, None)
+        self._cache[key] = (self.get_backend_timeout(timeout), pickled)
+        while len(self._cache) > self._max_entries:
+            self._cache.popitem(last=False)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, pickled, timeout)
+            return True
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            pickled = self._get(key)
+        return default if pickled is None else pickle.loads(pickled)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._set(key, pickled, timeout)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            return self._get(key) is not None
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        with self._lock:
+            self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+# Redis clients of RedisCache by LOCATION, which share a connection pool among the threads
+_redis_clients = {}
+
+
+class RedisCache(BaseCache):
+    """
+    Cache backend storing the entries in Redis, or in a Redis-compatible server (e.g. the redis service of
+    docker-compose.yml), so that the processes of the application share them. Requires the redis package.
+
+    LOCATION is the URL of the database (e.g. redis://127.0.0.1:6379/1) and TIMEOUT is the time to live of
+    the entries. Redis evicts the least recently used entries by itself when it is started with
+    maxmemory and maxmemory-policy allkeys-lru, so OPTIONS['MAX_ENTRIES'] doesn't apply.
+    """
+
+    def __init__(self, location, params):
+        BaseCache.__init__(self, params)
+        if redis is None:
+            raise ImproperlyConfigured('RedisCache requires the redis package')
+        if location not in _redis_clients:
+            _redis_clients[location] = redis.Redis.from_url(location)
+        self._client = _redis_clients[location]
+
+    def _ttl(self, timeout):
+        # milliseconds to live, None for no expiry
+        if timeout == DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return None if timeout is None else int(timeout * 1000)
+
+    def _store(self, key, value, timeout, only_new):
+        self.validate_key(key)
+        ttl = self._ttl(timeout)
+        if ttl is not None and ttl <= 0:
+            # expired immediately, as in the other backends
+            if not only_new:
+                self._client.delete(key)
+            return False
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return bool(self._client.set(key, pickled, px=ttl, nx=only_new))
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._store(self.make_key(key, version=version), value, timeout, True)
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        pickled = self._client.get(key)
+        return default if pickled is None else pickle.loads(pickled)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._store(self.make_key(key, version=version), value, timeout, False)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self._client.exists(key))
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._client.delete(key)
+
+    def clear(self):
+        # only the keys of this cache, since the database may be shared with other caches
+        keys = list(self._client.scan_iter(match=self.key_prefix + ':*'))
+        if keys:
+            self._client.delete(*keys)
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar store of trips, an optional engine answering the summaries of trips with NumPy.
+
+The Trip table is written to a directory of NumPy arrays (.npy), one file per column, which are opened
+as read-only memory maps, so the worker processes on a host share one copy of them in the page cache.
+The filters of TripFilter are resolved by the bitmap indexes of the low-cardinality columns (see bitmaps.py)
+or evaluated as vectorized masks, and the groups are aggregated by sorting the trips by their groups and
+reducing each segment with ufunc.reduceat.
+
+The store is rebuilt after imports (and by `python manage.py build_columnstore`). It is used only while
+it was built from the current version of trips, so summaries never see stale trips; the database
+answers them until the store is rebuilt.
+"""
+from __future__ import unicode_literals
+
+import datetime, io, itertools, json, operator, os, shutil, threading, time
+
+from django.conf import settings
+from django.core.validators import EMPTY_VALUES
+from django.db.models.functions import ExtractHour
+from django.utils import six, timezone
+
+from .bitmaps import BitmapIndex
+from .buckets import is_time_bucket
+from .caching import TRIPS, get_data_version
+from .exports import fetch_rows
+from .sketches import PERCENTILES
+
+try:
+    import numpy
+except ImportError: # numpy is optional
+    numpy = None
+
+# default settings of the store. They can be overwritten by TRIP_COLUMNSTORE in settings.py
+COLUMNSTORE_DEFAULTS = {
+    'ENABLED': False,
+    'PATH': 'columnstore', # the directory of the store
+    'CHUNK_SIZE': 100000,  # the number of trips written to the arrays at once
+}
+
+# the columns and their types. start_hour is annotated, and values_list returns annotations after fields
+COLUMNS = (
+    ('duration', 'int32'),
+    ('start_time', 'int64'),    # microseconds since 1970-01-01 UTC
+    ('stop_time', 'int64'),
+    ('start_date', 'int32'),    # days since 1970-01-01
+    ('stop_date', 'int32'),
+    ('start_station', 'int16'), # the indexes of the station ids in stations.npy
+    ('stop_station', 'int16'),
+    ('bike_id', 'int32'),
+    ('gender', 'int8'),
+    ('is_subscriber', 'bool'),
+    ('birth_year', 'int16'),    # NULL_YEAR for NULL
+    ('start_hour', 'int8'),     # the local hour of start_time
+)
+
+NULL_YEAR = -1
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# the columns whose filters are resolved by bitmap indexes
+BITMAP_COLUMNS = ('gender', 'is_subscriber', 'start_date', 'start_station', 'birth_year')
+
+# the fields which can be aggregated. Nullable birth_year is left to the database
+VALUE_FIELDS = ('duration', 'bike_id', 'gender')
+
+# the number of the groups whose codes fit in int64. Beyond it, the groups are found by the distinct rows of the grouped values
+MAX_GROUP_CODES = 2 ** 63
+
+# the fields which can be grouped (the time buckets are computed from start_date and start_hour)
+GROUP_FIELDS = ('start_date', 'stop_date', 'start_station', 'stop_station', 'bike_id', 'gender', 'is_subscriber', 'birth_year', 'duration')
+
+FILTER_LOOKUPS = {
+    'exact': operator.eq,
+    'gt': operator.gt,
+    'lt': operator.lt,
+}
+
+HAVING_LOOKUPS = {
+    'exact': operator.eq,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+
+
+def get_columnstore_setting(name):
+    """
+    Return a setting of the columnar store, falling back to COLUMNSTORE_DEFAULTS
+    """
+    return getattr(settings, 'TRIP_COLUMNSTORE', {}).get(name, COLUMNSTORE_DEFAULTS[name])
+
+
+def columnstore_enabled():
+    return numpy is not None and get_columnstore_setting('ENABLED')
+
+
+def _version_key(version):
+    number, updated_at = version
+    return [number, updated_at.isoformat() if updated_at else None]
+
+
+def _microseconds(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _days(value):
+    return value.toordinal() - EPOCH_ORDINAL
+
+
+def build_columnstore(path=None):
+    """
+    Write the Trip table to a new directory of the store and make it current. Returns the number of trips.
+    The directories of the older versions are removed, except the previous one which readers may still open.
+    """
+    from .models import Station, Trip
+
+    path = path or get_columnstore_setting('PATH')
+    chunk_size = get_columnstore_setting('CHUNK_SIZE')
+    # read before the trips, so that the trips changed while building make the store stale
+    version = _version_key(get_data_version(TRIPS))
+
+    station_ids = set(Station.objects.values_list('station_id', flat=True))
+    station_ids.update(Trip.objects.values_list('start_station', flat=True).distinct().order_by())
+    station_ids.update(Trip.objects.values_list('stop_station', flat=True).distinct().order_by())
+    station_ids = numpy.array(sorted(station_ids), dtype='int32')
+
+    queryset = Trip.objects.annotate(start_hour=ExtractHour('start_time')).order_by()
+    size = queryset.count()
+
+    name = 'trips-{}-{}'.format(version[0], int(time.time() * 1000))
+    directory = os.path.join(path, name)
+    os.makedirs(directory)
+    numpy.save(os.path.join(directory, 'stations.npy'), station_ids)
+
+    arrays = []
+    for column, dtype in COLUMNS:
+        filename = os.path.join(directory, column + '.npy')
+        if size:
+            arrays.append(numpy.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(size,)))
+        else: # empty files can't be mapped
+            numpy.save(filename, numpy.zeros(0, dtype=dtype))
+
+    converters = {
+        'start_time': _microseconds,
+        'stop_time': _microseconds,
+        'start_date': _days,
+        'stop_date': _days,
+        'birth_year': lambda value: NULL_YEAR if value is None else value,
+    }
+
+    rows = itertools.islice(fetch_rows(queryset, [column for column, dtype in COLUMNS], chunk_size), size)
+    offset = 0
+    while arrays:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        for (column, dtype), array, values in zip(COLUMNS, arrays, zip(*chunk)):
+            if column in converters:
+                values = [converters[column](value) for value in values]
+            if column in ('start_station', 'stop_station'):
+                values = numpy.searchsorted(station_ids, values)
+            array[offset:offset + len(chunk)] = values
+        offset += len(chunk)
+    for array in arrays:
+        array.flush()
+
+    for column in BITMAP_COLUMNS:
+        values = arrays[[c for c, dtype in COLUMNS].index(column)][:offset] if arrays else numpy.zeros(0, dtype='int64')
+        BitmapIndex.build(values).save(directory, column)
+
+    # trips deleted while building leave the tail of the arrays unused
+    with io.open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+        f.write(six.text_type(json.dumps({'version': version, 'rows': offset})))
+
+    previous = _current_name(path)
+    temporary = os.path.join(path, 'CURRENT.tmp')
+    with io.open(temporary, 'w', encoding='utf-8') as f:
+        f.write(name)
+    os.rename(temporary, os.path.join(path, 'CURRENT')) # atomic on POSIX
+
+    for old in os.listdir(path):
+        if old.startswith('trips-') and old not in (name, previous):
+            shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    return offset
+
+
+def _current_name(path):
+    try:
+        with io.open(os.path.join(path, 'CURRENT'), encoding='utf-8') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+class TripColumns(object):
+    """
+    The arrays of a directory of the store
+
+    Attributes
+    ----------
+    version : list
+        the version number and the update time of trips which the store was built from
+
+    size : int
+        the number of trips
+
+    arrays : dict
+        the column names -> the memory-mapped arrays
+
+    station_ids : ndarray
+        the station ids sorted, which the station columns refer to by indexes
+
+    bitmaps : dict
+        the column names -> BitmapIndex of the column
+    """
+
+    def __init__(self, directory):
+        with io.open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        self.version = manifest['version']
+        self.size = manifest['rows']
+        mmap_mode = 'r' if self.size else None
+        self.arrays = dict((column, numpy.load(os.path.join(directory, column + '.npy'), mmap_mode=mmap_mode)[:self.size]) for column, dtype in COLUMNS)
+        self.station_ids = numpy.load(os.path.join(directory, 'stations.npy'))
+        self.bitmaps = dict((column, BitmapIndex.load(directory, column)) for column in BITMAP_COLUMNS)
+
+    def _encode(self, name, value):
+        # the value of a filter in the representation of the column
+        if name in ('start_time', 'stop_time'):
+            return _microseconds(value)
+        if name in ('start_date', 'stop_date'):
+            return _days(value)
+        if name in ('start_station', 'stop_station'):
+            pk = getattr(value, 'pk', value)
+            index = int(numpy.searchsorted(self.station_ids, pk))
+            return index if index < len(self.station_ids) and self.station_ids[index] == pk else -1
+        if name == 'is_subscriber':
+            return bool(value)
+        return float(value)
+
+    def _bitmap(self, name, lookup, value):
+        # the bitmap of the condition. NULL_YEAR (the smallest year) is excluded by the exclusive lower bound
+        index = self.bitmaps[name]
+        if lookup == 'exact':
+            return index.equal(value)
+        if lookup == 'gt':
+            return index.range(lower=value)
+        return index.range(lower=NULL_YEAR if name == 'birth_year' else None, upper=value)
+
+    def select(self, filterset):
+        """
+        Return the positions of the trips passing the filters in ascending order, or None if some filters
+        can't be evaluated. The conditions on the columns with bitmap indexes are resolved by the bitmaps,
+        and the others are evaluated on the columns of the selected trips only.
+        """
+        form = filterset.form
+        if not form.is_valid():
+            return None
+
+        bitmap = None
+        conditions = []
+        for name, f in filterset.filters.items():
+            value = form.cleaned_data.get(name)
+            if value in EMPTY_VALUES:
+                continue
+            if f.field_name not in self.arrays or f.lookup_expr not in FILTER_LOOKUPS:
+                return None
+            value = self._encode(f.field_name, value)
+            if f.field_name in self.bitmaps:
+                condition = self._bitmap(f.field_name, f.lookup_expr, value)
+                bitmap = condition if bitmap is None else bitmap & condition
+            else:
+                conditions.append((self.arrays[f.field_name], FILTER_LOOKUPS[f.lookup_expr], value))
+
+        if bitmap is None:
+            mask = numpy.ones(self.size, dtype=bool)
+            for column, op, value in conditions:
+                mask &= op(column, value)
+            return numpy.flatnonzero(mask)
+
+        indexes = bitmap.to_positions()
+        for column, op, value in conditions:
+            indexes = indexes[op(column[indexes], value)]
+        return indexes
+
+    def _group_values(self, name):
+        # the values of the groups of all trips, and the function converting them into the values returned
+        dates = self.arrays['start_date']
+        if name == 'start_weekday':
+            return (dates + 4) % 7, int # 1970-01-01 is Thursday (4)
+        if name == 'start_hour':
+            return self.arrays['start_hour'], int
+        if name == 'start_hour_of_week':
+            return (dates + 4) % 7 * 24 + self.arrays['start_hour'], int
+        if name == 'start_month':
+            return dates.astype('datetime64[D]').astype('datetime64[M]').astype('int64') % 12 + 1, int
+        if name == 'start_week':
+            # ISO 8601 week numbers of the distinct dates
+            days, inverse = numpy.unique(dates, return_inverse=True)
+            weeks = numpy.array([datetime.date.fromordinal(int(day) + EPOCH_ORDINAL).isocalendar()[1] for day in days], dtype='int8')
+            return weeks[inverse], int
+        if name in ('start_date', 'stop_date'):
+            return self.arrays[name], lambda value: datetime.date.fromordinal(int(value) + EPOCH_ORDINAL)
+        if name in ('start_station', 'stop_station'):
+            return self.arrays[name], lambda value: int(self.station_ids[value])
+        if name == 'is_subscriber':
+            return self.arrays[name], bool
+        if name == 'birth_year':
+            return self.arrays[name], lambda value: None if value == NULL_YEAR else int(value)
+        return self.arrays[name], int
+
+    def summarize(self, indexes, group_by, aggs, field, having=(), order_by=(), top=None):
+        """
+        Return the summaries of the trips at the positions in the same form as the summaries computed by the database
+        """
+        if not len(indexes):
+            return []
+
+        keys = []
+        inverses = []
+        cardinality = 1
+        for name in group_by:
+            values, convert = self._group_values(name)
+            unique, inverse = numpy.unique(values[indexes], return_inverse=True)
+            keys.append((unique, convert))
+            inverses.append(inverse)
+            cardinality *= len(unique)
+
+        if cardinality <= MAX_GROUP_CODES:
+            # the codes of the groups, whose order is the order of the grouped values
+            codes = numpy.zeros(len(indexes), dtype='int64')
+            for (unique, convert), inverse in zip(keys, inverses):
+                codes = codes * len(unique) + inverse
+            groups, inverse = numpy.unique(codes, return_inverse=True)
+
+            # the indexes of the grouped values of each group
+            key_indexes = []
+            for unique, convert in reversed(keys):
+                key_indexes.insert(0, groups % len(unique))
+                groups = groups // len(unique)
+        else:
+            # the codes would overflow, so the groups are the distinct rows of the indexes of the grouped values,
+            # which are sorted in the same order
+            groups, inverse = numpy.unique(numpy.stack(inverses, axis=1), axis=0, return_inverse=True)
+            key_indexes = [groups[:, i] for i in range(len(keys))]
+
+        counts = numpy.bincount(inverse)
+        starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        results = {'count': counts}
+
+        if field is not None and any(agg != 'count' and agg != 'distinct_bikes' for agg in aggs):
+            values = self.arrays[field][indexes]
+            # the trips sorted by the groups, and by the values in each group for the percentiles
+            order = numpy.lexsort((values, inverse))
+            values = values[order].astype('int64')
+            for agg in aggs:
+                name = agg + '_' + field
+                if agg == 'sum':
+                    results[name] = numpy.add.reduceat(values, starts)
+                elif agg == 'max':
+                    results[name] = numpy.maximum.reduceat(values, starts)
+                elif agg == 'min':
+                    results[name] = numpy.minimum.reduceat(values, starts)
+                elif agg == 'avg':
+                    results[name] = numpy.add.reduceat(values, starts) / counts.astype('float64')
+                elif agg in PERCENTILES:
+                    # interpolated linearly between the closest ranks as sketches.percentile
+                    position = PERCENTILES[agg] * (counts - 1)
+                    lower = numpy.floor(position).astype('int64')
+                    upper = numpy.minimum(lower + 1, counts - 1)
+                    results[name] = values[starts + lower] + (values[starts + upper] - values[starts + lower]) * (position - lower)
+
+        if 'distinct_bikes' in aggs:
+            pairs = numpy.unique((inverse.astype('int64') << 32) | self.arrays['bike_id'][indexes].astype('int64'))
+            results['distinct_bikes'] = numpy.bincount(pairs >> 32, minlength=len(counts))
+
+        selected = numpy.ones(len(counts), dtype=bool)
+        for name, lookup, value in having:
+            selected &= HAVING_LOOKUPS[lookup](results[name], value)
+        selected = numpy.flatnonzero(selected)
+
+        if order_by:
+            sort_keys = []
+            for name in order_by:
+                descending = name.startswith('-')
+                name = name.lstrip('-')
+                values = key_indexes[group_by.index(name)] if name in group_by else results[name]
+                values = values[selected]
+                sort_keys.append(-values if descending else values)
+            # lexsort sorts by the last key first
+            selected = selected[numpy.lexsort(sort_keys[::-1])]
+        if top is not None:
+            selected = selected[:top]
+
+        summary = []
+        for i in selected:
+            row = dict((name, convert(unique[key[i]])) for name, (unique, convert), key in zip(group_by, keys, key_indexes))
+            for agg in aggs:
+                name = agg if agg in ('count', 'distinct_bikes') else agg + '_' + field
+                value = results[name][i]
+                row[name] = float(value) if agg == 'avg' or agg in PERCENTILES else int(value)
+            summary.append(row)
+        return summary
+
+
+_store = None # (directory, TripColumns) opened by this process
+_lock = threading.Lock()
+
+
+def get_trip_columns():
+    """
+    Return the current store, or None if it's disabled, not built, or built from older trips
+    """
+    global _store
+    if not columnstore_enabled():
+        return None
+
+    path = get_columnstore_setting('PATH')
+    name = _current_name(path)
+    if name is None:
+        return None
+
+    directory = os.path.join(path, name)
+    with _lock:
+        if _store is None or _store[0] != directory:
+            _store = (directory, TripColumns(directory))
+        columns = _store[1]
+    if columns.version != _version_key(get_data_version(TRIPS)):
+        return None
+    return columns
+
+
+def summarize(request, filter_class, group_by, aggs, field, having=(), order_by=(), top=None):
+    """
+    Return the summary of trips computed from the store, or None when the store can't answer it.
+    The parameters are the ones of rollups.summarize.
+    """
+    if request.query_params.get('ordering'):
+        return None
+    if any(name not in GROUP_FIELDS and not is_time_bucket(name) for name in group_by):
+        return None
+    if any(agg not in ('count', 'distinct_bikes') for agg in aggs) and field not in VALUE_FIELDS:
+        return None
+
+    columns = get_trip_columns()
+    if columns is None:
+        return None
+
+    filterset = filter_class(request.query_params, queryset=filter_class._meta.model.objects.none(), request=request)
+    indexes = columns.select(filterset)
+    if indexes is None:
+        return None
+    return columns.summarize(indexes, group_by, aggs, field, having, order_by or group_by, top)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming exports of trips as CSV or NDJSON (one JSON object per line).
+
+Rows are fetched as tuples in chunks through a server-side cursor where the database supports it,
+and are written to the response chunk by chunk, so the memory doesn't grow with the number of trips.
+"""
+from __future__ import unicode_literals
+
+import csv, io, json, zlib
+
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, models
+from django.http import StreamingHttpResponse
+from django.utils import six
+
+# the number of rows fetched from the database and written to the response at once
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def fetch_rows(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the values of the fields of each row as tuples. Unlike values_list().iterator(),
+    which fetches 100 rows per round trip, the rows are fetched chunk_size rows at once.
+    """
+    queryset = queryset.values_list(*fields)
+    compiler = queryset.query.get_compiler(using=queryset.db)
+    try:
+        sql, params = compiler.as_sql()
+    except EmptyResultSet: # e.g. filtered by an empty list
+        return
+
+    cursor = connections[queryset.db].chunked_cursor()
+    try:
+        cursor.execute(sql, params)
+        chunks = iter(lambda: cursor.fetchmany(chunk_size), [])
+        # the converters of the backend (e.g. parsing datetimes on SQLite) are applied as usual
+        for row in compiler.results_iter(chunks):
+            yield row
+    finally:
+        cursor.close()
+
+
+def _formatters(model, fields, export_format):
+    """
+    Return the functions converting the values of the fields into the values written to the export.
+    Datetimes are written in ISO 8601 with their UTC offsets.
+    """
+    def isoformat(value):
+        return None if value is None else value.isoformat()
+
+    def boolean(value):
+        return None if value is None else ('true' if value else 'false')
+
+    formatters = []
+    for name in fields:
+        field = model._meta.get_field(name)
+        if isinstance(field, (models.DateTimeField, models.DateField)):
+            formatters.append(isoformat)
+        elif isinstance(field, (models.BooleanField, models.NullBooleanField)) and export_format == 'csv':
+            formatters.append(boolean)
+        else:
+            formatters.append(None)
+    return formatters
+
+
+def _format_rows(rows, formatters):
+    indexes = [i for i, f in enumerate(formatters) if f is not None]
+    for row in rows:
+        row = list(row)
+        for i in indexes:
+            row[i] = formatters[i](row[i])
+        yield row
+
+
+def _chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_chunks(rows, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the header and the rows as CSV bytes, chunk_size rows at once
+    """
+    # csv of Python 2 writes bytes
+    buffer = io.BytesIO() if six.PY2 else io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def flush():
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value if six.PY2 else value.encode('utf-8')
+
+    writer.writerow([str(name) for name in fields])
+    yield flush()
+    for chunk in _chunks(rows, chunk_size):
+        writer.writerows(chunk)
+        yield flush()
+
+
+def ndjson_chunks(rows, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the rows as JSON objects separated by new lines, chunk_size rows at once
+    """
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    for chunk in _chunks(rows, chunk_size):
+        yield ''.join(encoder.encode(dict(zip(fields, row))) + '\n' for row in chunk).encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """
+    Compress the chunks on the fly into a gzip stream
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _accepted_codings(header):
+    """
+    Return the content codings of an Accept-Encoding header -> their q-values. Invalid q-values count as 0
+    """
+    codings = {}
+    for item in header.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if not parts[0]:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value.strip())
+                except ValueError:
+                    quality = 0.0
+        codings[parts[0].lower()] = quality
+    return codings
+
+
+def accepts_gzip(request):
+    """
+    Whether the Accept-Encoding header of the request accepts gzip, by name or by '*', with a q-value above 0
+    """
+    codings = _accepted_codings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    for name in ('gzip', 'x-gzip', '*'):
+        if name in codings:
+            return codings[name] > 0
+    return False
+
+
+def export_response(queryset, fields, export_format, compress=False, filename='trips'):
+    """
+    Return a streaming response exporting the fields of the rows of the queryset
+
+    Parameters
+    ----------
+    queryset : QuerySet
+        the rows to be exported
+
+    fields : list
+        the names of the fields to be exported
+
+    export_format : str
+        csv or ndjson
+
+    compress : bool
+        whether the response is compressed by gzip
+    """
+    formatters = _formatters(queryset.model, fields, export_format)
+    rows = _format_rows(fetch_rows(queryset, fields), formatters)
+    chunks = csv_chunks(rows, fields) if export_format == 'csv' else ndjson_chunks(rows, fields)
+    if compress:
+        chunks = gzip_chunks(chunks)
+
+    response = StreamingHttpResponse(chunks, content_type=EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(filename, export_format)
+    if compress:
+        response['Content-Encoding'] = 'gzip'
+    response['Vary'] = 'Accept-Encoding'
+    return response
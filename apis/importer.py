@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import csv, datetime, glob, gzip, hashlib, io, itertools, multiprocessing, os, time, zipfile
+
+from django.conf import settings
+from django.db import connection, connections, models, transaction
+from django.utils import six
+
+from .apps import make_aware_datetime
+from .caching import TRIPS, bump_data_version
+from .columnstore import build_columnstore, columnstore_enabled
+from .partitions import ensure_partitions, insert_into_partitions, month_of, partitions_enabled
+from .pragmas import bulk_load
+from .rollups import add_trips, keep_rollups_current, rollups_enabled
+from .timestamps import parse_timestamp, parse_timestamps
+
+# default settings of trip import. They can be overwritten by TRIP_IMPORT in settings.py
+IMPORT_DEFAULTS = {
+    'MODE': 'bulk',         # 'bulk' or 'rowwise' (the original one-by-one save)
+    'BATCH_SIZE': 5000,     # number of trips written in one transaction
+    'WORKERS': 1,           # number of processes to parse files
+    'QUEUE_SIZE': 8,        # number of parsed batches which can wait for the writer
+    'COPY': True,           # write trips by COPY FROM STDIN on PostgreSQL instead of INSERT
+}
+
+IMPORT_MODES = ('bulk', 'rowwise')
+
+# monthly trip history files are published as 'YYYYmm-bluebikes-tripdata.zip'
+DATA_FILE_PATTERNS = ('*.csv', '*.csv.gz', '*.zip')
+
+
+def get_import_setting(name):
+    """
+    Return a setting of trip import, falling back to IMPORT_DEFAULTS
+    """
+    return getattr(settings, 'TRIP_IMPORT', {}).get(name, IMPORT_DEFAULTS[name])
+
+
+class ImportStats(object):
+    """
+    The class to collect statistics of a trip import
+
+    Attributes
+    ----------
+    rows : int
+        the number of imported trips
+
+    files : int
+        the number of imported files
+
+    invalid_rows : int
+        the number of skipped rows which couldn't be parsed
+
+    unknown_stations : set
+        the station ids referred by trips but not found in Station table
+
+    skipped_files : list
+        the files skipped because they have already been imported
+
+    changed_files : list
+        the files skipped because their contents have changed since they were imported
+
+    elapsed : float
+        the seconds spent for the import
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.files = 0
+        self.invalid_rows = 0
+        self.unknown_stations = set()
+        self.skipped_files = []
+        self.changed_files = []
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def stop(self):
+        self.elapsed = time.time() - self.started
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of other ImportStats (e.g. the one of a file parsed by a worker process)
+        """
+        self.rows += other.rows
+        self.files += other.files
+        self.invalid_rows += other.invalid_rows
+        self.unknown_stations |= other.unknown_stations
+        self.skipped_files += other.skipped_files
+        self.changed_files += other.changed_files
+        return self
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return 'Loaded {} trips from {} files in {:.1f} sec ({:.0f} rows/sec)'.format(
+            self.rows, self.files, self.elapsed, self.rows_per_sec)
+
+
+def find_data_files(paths):
+    """
+    Return trip history files (csv, csv.gz or zip) found in the given files or directories.
+    """
+    if isinstance(paths, six.string_types):
+        paths = [paths]
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in DATA_FILE_PATTERNS:
+                files.extend(glob.glob(os.path.join(path, pattern)))
+        else:
+            files.append(path)
+
+    return sorted(files)
+
+
+def _text_stream(binary):
+    # csv module of python 2 reads bytes while that of python 3 reads text
+    return binary if six.PY2 else io.TextIOWrapper(binary, encoding='utf-8', newline='')
+
+
+def open_csv_streams(filename):
+    """
+    Yield readable streams of csv data in a file. A zip archive yields each of its csv members,
+    which are decompressed on the fly without being extracted to the disk.
+    """
+    if filename.endswith('.zip'):
+        with zipfile.ZipFile(filename) as archive:
+            for member in archive.namelist():
+                if member.endswith('.csv') and not member.startswith('__MACOSX/'):
+                    with archive.open(member) as f:
+                        yield _text_stream(f)
+    elif filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as f:
+            yield _text_stream(f)
+    else:
+        with io.open(filename, 'rb') as f:
+            yield _text_stream(f)
+
+
+def read_csv_rows(filename):
+    """
+    Yield rows of a trip history file (csv, csv.gz or zip), skipping the header of each csv.
+    """
+    for stream in open_csv_streams(filename):
+        reader = csv.reader(stream, doublequote=True, lineterminator='\r\n', quotechar=str('"'), skipinitialspace=True)
+        next(reader, None) # header
+        for row in reader:
+            yield row
+
+
+def _parse_birth_year(value):
+    # the birth year is missing ('\N' or empty) for some trips
+    return int(value) if value.isdigit() else None
+
+
+def build_trip(row, start_time=None, stop_time=None):
+    """
+    Build an unsaved Trip from a csv row. start_date and stop_date are computed here
+    because bulk_create doesn't call Trip.save(). The timestamps are parsed unless they are given.
+    """
+    from .models import Trip
+
+    start_time = start_time or parse_timestamp(row[1])
+    stop_time = stop_time or parse_timestamp(row[2])
+    return Trip(duration=int(row[0]), start_time=start_time, stop_time=stop_time,
+                start_date=start_time.date(), stop_date=stop_time.date(),
+                start_station_id=int(row[3]), stop_station_id=int(row[7]),
+                bike_id=int(row[11]), is_subscriber=row[12]=='Subscriber', birth_year=_parse_birth_year(row[13]), gender=int(row[14]))
+
+
+def parse_rows(rows, stats):
+    """
+    Pipeline stage to convert a chunk of csv rows into unsaved trips. The timestamps of the chunk
+    are parsed at once. Malformed rows are skipped and counted.
+    """
+    rows = list(rows)
+    try:
+        start_times = parse_timestamps([row[1] for row in rows])
+        stop_times = parse_timestamps([row[2] for row in rows])
+    except (ValueError, TypeError, IndexError):
+        # parse the rows one by one to skip only the malformed ones
+        start_times = stop_times = [None] * len(rows)
+
+    for row, start_time, stop_time in zip(rows, start_times, stop_times):
+        try:
+            trip = build_trip(row, start_time, stop_time)
+        except (ValueError, TypeError, IndexError, AttributeError):
+            stats.invalid_rows += 1
+            continue
+        yield trip
+
+
+def validate_trips(trips, stats, station_ids):
+    """
+    Pipeline stage to check trips. Trips referring to unknown stations are kept as the original
+    import did, but the station ids are recorded. Trips with a negative duration are skipped.
+    """
+    for trip in trips:
+        if trip.duration < 0:
+            stats.invalid_rows += 1
+            continue
+
+        for station_id in (trip.start_station_id, trip.stop_station_id):
+            if station_id not in station_ids:
+                stats.unknown_stations.add(station_id)
+
+        yield trip
+
+
+def batched(items, batch_size):
+    """
+    Pipeline stage to group items into lists of batch_size items.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def trip_batches(rows, stats, station_ids, batch_size):
+    """
+    The pipeline of the batch, parse and validate stages. Rows are batched before being parsed,
+    so the rows consumed so far always correspond to the trips yielded so far.
+    """
+    for chunk in batched(rows, batch_size):
+        yield list(validate_trips(parse_rows(chunk, stats), stats, station_ids))
+
+
+def import_rows_rowwise(rows, stats, batch_size=None, entry=None):
+    """
+    Import trips one by one with Trip.save(). This is the original (slow) behavior kept as a fallback.
+
+    When the ledger entry of the file is given, rows before its row_offset are skipped and
+    the entry is updated every batch_size rows, in the same transaction as the trips of the rows.
+    """
+    from .models import Station, Trip
+
+    batch_size = batch_size or get_import_setting('BATCH_SIZE')
+    rows = RowCounter(rows, entry.row_offset if entry else 0)
+    for chunk in batched(rows, batch_size):
+        trips = []
+        with transaction.atomic():
+            for row in chunk:
+                trip = Trip(duration=int(row[0]), start_time=make_aware_datetime(row[1]), stop_time=make_aware_datetime(row[2]), bike_id=int(row[11]), is_subscriber=row[12]=='Subscriber', birth_year=_parse_birth_year(row[13]), gender=int(row[14]))
+                try:
+                    trip.start_station=Station.objects.get(pk=row[3])
+                except Station.DoesNotExist:
+                    trip.start_station_id = int(row[3])
+                    stats.unknown_stations.add(trip.start_station_id)
+                try:
+                    trip.stop_station=Station.objects.get(pk=row[7])
+                except Station.DoesNotExist:
+                    trip.stop_station_id = int(row[7])
+                    stats.unknown_stations.add(trip.stop_station_id)
+
+                trip.save()
+                trips.append(trip)
+                if rollups_enabled():
+                    add_trips([trip])
+                    keep_rollups_current()
+            if entry:
+                entry.row_offset = rows.offset
+                entry.row_count += len(chunk)
+                _cover_dates(entry, trips)
+                entry.save()
+        stats.rows += len(chunk)
+
+    if entry:
+        _complete_entry(entry, rows.offset)
+
+
+def import_rows_bulk(rows, stats, batch_size=None, entry=None):
+    """
+    Import trips with bulk_create through the batch, parse and validate stages.
+    Each batch of trips is written in its own transaction, so memory usage doesn't depend on the size of files.
+    Station ids are preloaded once instead of being looked up per trip.
+
+    When the ledger entry of the file is given, rows before its row_offset are skipped and
+    the entry is updated in the same transaction as each batch. The version of trips is bumped
+    once at the end, so the cached summaries are kept until the whole file is imported.
+    """
+    from .models import Station, Trip
+
+    batch_size = batch_size or get_import_setting('BATCH_SIZE')
+    station_ids = set(Station.objects.values_list('pk', flat=True))
+
+    rows = RowCounter(rows, entry.row_offset if entry else 0)
+    for batch in trip_batches(rows, stats, station_ids, batch_size):
+        _write_batch(Trip, batch, stats, entry, rows.offset)
+
+    _complete_entry(entry, rows.offset)
+
+
+def _copy_value(value):
+    # a value of the CSV format of COPY, where an unquoted empty value is NULL
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    value = six.text_type(value)
+    if value == '' or any(c in value for c in ',"\r\n'):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def copy_objects(model, objects):
+    """
+    Write unsaved objects by COPY FROM STDIN in the CSV format, which PostgreSQL loads much faster than
+    INSERT statements. The primary keys of the objects are not set, as bulk_create on the other backends.
+    """
+    fields = [f for f in model._meta.concrete_fields if not isinstance(f, models.AutoField)]
+    lines = []
+    for obj in objects:
+        lines.append(','.join(_copy_value(f.get_db_prep_save(f.pre_save(obj, True), connection)) for f in fields))
+    data = io.BytesIO(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        connection.ops.quote_name(model._meta.db_table), ', '.join(connection.ops.quote_name(f.column) for f in fields))
+    with connection.cursor() as cursor:
+        # copy_expert of psycopg2 isn't wrapped by Django
+        cursor.copy_expert(sql, data)
+
+
+def _write_batch(model, batch, stats, entry=None, offset=None):
+    partitioned = partitions_enabled()
+    if partitioned:
+        # the partitions are created before the transaction of the batch, which would lock the Trip table until its end
+        ensure_partitions(set(month_of(trip.start_date) for trip in batch))
+    with transaction.atomic():
+        if partitioned and connection.vendor == 'sqlite':
+            insert_into_partitions(model, batch)
+        elif connection.vendor == 'postgresql' and get_import_setting('COPY'):
+            copy_objects(model, batch)
+        else:
+            model.objects.bulk_create(batch)
+        # the rollup rows of the dates of the batch are locked, so the writers of other months don't wait for them
+        if rollups_enabled():
+            add_trips(batch)
+        if entry:
+            entry.row_offset = offset
+            entry.row_count += len(batch)
+            _cover_dates(entry, batch)
+            entry.save()
+    stats.rows += len(batch)
+
+
+def _cover_dates(entry, trips):
+    # widen the range of start dates of the ledger entry to the trips, by which drop_partition finds the entry
+    dates = [trip.start_date for trip in trips]
+    if dates:
+        entry.first_date = min(dates + ([entry.first_date] if entry.first_date else []))
+        entry.last_date = max(dates + ([entry.last_date] if entry.last_date else []))
+
+
+def _complete_entry(entry, offset):
+    """
+    Record the end of the file in its ledger entry, and bump the version of trips once for the whole file.
+    The version isn't bumped by each batch, whose transactions would queue on its row with parallel writers.
+    """
+    with transaction.atomic():
+        if entry:
+            entry.row_offset = offset
+            entry.completed = True
+            entry.save()
+        bump_data_version(TRIPS)
+        # the rollups have been updated with every batch
+        if rollups_enabled():
+            keep_rollups_current()
+
+
+class RowCounter(object):
+    """
+    The iterator to skip rows which are already imported and to count the rows consumed so far
+    """
+
+    def __init__(self, rows, offset=0):
+        self.rows = itertools.islice(rows, offset, None)
+        self.offset = offset
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.rows)
+        self.offset += 1
+        return row
+
+    next = __next__ # python 2
+
+
+def file_hash(filename):
+    """
+    Return the SHA-1 hash of the content of a file
+    """
+    sha1 = hashlib.sha1()
+    with io.open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_ledger_entry(filename):
+    """
+    Return the ledger entry of a file, creating it for a new file. Files are identified by their names
+    (e.g. 201903-bluebikes-tripdata.zip), so the same file can be moved to another directory.
+    The content is hashed only when the size or the modification time differs from the entry.
+
+    Returns
+    ----------
+    (ImportedFile, bool)
+        the entry and whether the content of the file has changed since it was recorded
+    """
+    from .models import ImportedFile
+
+    size = os.path.getsize(filename)
+    mtime = os.path.getmtime(filename)
+    entry = ImportedFile.objects.filter(name=os.path.basename(filename)).first()
+    if entry is not None and entry.size == size and entry.mtime == mtime:
+        return entry, False
+
+    sha1 = file_hash(filename)
+    if entry is None:
+        return ImportedFile.objects.create(name=os.path.basename(filename), size=size, sha1=sha1, mtime=mtime), False
+    if entry.sha1 != sha1:
+        return entry, True
+    if entry.mtime != mtime:
+        # the same content touched or copied again
+        entry.mtime = mtime
+        entry.save(update_fields=['mtime'])
+    return entry, False
+
+
+def import_file(filename, mode=None, batch_size=None):
+    """
+    Import a trip history file unless the ledger says it has already been imported.
+    A partially imported file is resumed from the last committed row.
+
+    Returns
+    ----------
+    ImportStats
+    """
+    mode = mode or get_import_setting('MODE')
+    stats = ImportStats()
+
+    entry, changed = get_ledger_entry(filename)
+    if changed:
+        # the offset of the ledger doesn't match the content anymore
+        stats.changed_files.append(filename)
+    elif entry.completed:
+        stats.skipped_files.append(filename)
+    elif mode == 'bulk':
+        import_rows_bulk(read_csv_rows(filename), stats, batch_size=batch_size, entry=entry)
+        stats.files = 1
+    else:
+        import_rows_rowwise(read_csv_rows(filename), stats, batch_size=batch_size, entry=entry)
+        stats.files = 1
+
+    return stats.stop()
+
+
+def import_files(files, mode=None, batch_size=None, workers=None, progress=None):
+    """
+    Import trip history data from csv files. Files recorded as imported in the ledger are skipped,
+    so importing the same files again is a no-op.
+
+    Parameters
+    ----------
+    files : list
+        the paths of trip history files (csv, csv.gz or zip)
+
+    mode : str
+        'bulk' or 'rowwise'. Default is TRIP_IMPORT['MODE']
+
+    batch_size : int
+        the number of trips written in one transaction. Default is TRIP_IMPORT['BATCH_SIZE']
+
+    workers : int
+        the number of processes to parse files in parallel for the bulk mode. Default is TRIP_IMPORT['WORKERS']
+
+    progress : function
+        called with the file name and its ImportStats every time a file is imported
+
+    Returns
+    ----------
+    ImportStats
+    """
+    mode = mode or get_import_setting('MODE')
+    if mode not in IMPORT_MODES:
+        raise ValueError("Unknown import mode '{}'".format(mode))
+
+    workers = workers or get_import_setting('WORKERS')
+    # on SQLite, the writing connection switches to SQLITE_BULK_LOAD_PRAGMAS during the import
+    with bulk_load():
+        if mode == 'bulk' and workers > 1 and len(files) > 1:
+            stats = _import_files_parallel(files, batch_size or get_import_setting('BATCH_SIZE'), workers, progress)
+        else:
+            stats = ImportStats()
+            for filename in files:
+                file_stats = import_file(filename, mode=mode, batch_size=batch_size)
+                stats.merge(file_stats)
+
+                if progress and file_stats.files:
+                    progress(filename, file_stats)
+            stats.stop()
+
+    # the columnar store is stale once trips are imported
+    if stats.rows and columnstore_enabled():
+        build_columnstore()
+    return stats
+
+
+def _setup_worker():
+    # worker processes started by 'spawn' (not 'fork') need to set up django by themselves
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
+
+
+def _parse_file_worker(tasks, results, station_ids, batch_size):
+    """
+    Parse files given through the tasks queue, and send batches of unsaved trips to the writer
+    through the results queue. The queue is bounded, so workers wait while the writer is busy.
+    """
+    _setup_worker()
+    for filename, offset in iter(tasks.get, None):
+        stats = ImportStats()
+        try:
+            rows = RowCounter(read_csv_rows(filename), offset)
+            for batch in trip_batches(rows, stats, station_ids, batch_size):
+                results.put(('batch', filename, (batch, rows.offset)))
+            results.put(('done', filename, (stats.stop(), rows.offset)))
+        except Exception as e:
+            results.put(('error', filename, '{}: {}'.format(type(e).__name__, e)))
+
+
+def _import_file_worker(args):
+    """
+    Import a file with its own database connection
+    """
+    filename, batch_size = args
+    _setup_worker()
+    return filename, import_file(filename, mode='bulk', batch_size=batch_size)
+
+
+def _import_files_parallel(files, batch_size, workers, progress):
+    """
+    Import files with a pool of processes. On SQLite, which allows only one writer at a time,
+    workers parse files and the current process writes all the trips. On the other backends,
+    each worker writes trips of its files through its own connection.
+    """
+    from .models import Station, Trip
+
+    stats = ImportStats()
+
+    if connection.vendor != 'sqlite':
+        # connections can't be shared with forked processes
+        connections.close_all()
+        pool = multiprocessing.Pool(min(workers, len(files)))
+        try:
+            for filename, file_stats in pool.imap_unordered(_import_file_worker, [(f, batch_size) for f in files]):
+                stats.merge(file_stats)
+                if progress and file_stats.files:
+                    progress(filename, file_stats)
+        finally:
+            pool.terminate()
+        return stats.stop()
+
+    entries = {}
+    for filename in files:
+        entry, changed = get_ledger_entry(filename)
+        if changed:
+            stats.changed_files.append(filename)
+        elif entry.completed:
+            stats.skipped_files.append(filename)
+        else:
+            entries[filename] = entry
+    if not entries:
+        return stats.stop()
+
+    workers = min(workers, len(entries))
+    station_ids = set(Station.objects.values_list('pk', flat=True))
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue(get_import_setting('QUEUE_SIZE'))
+    for filename, entry in entries.items():
+        tasks.put((filename, entry.row_offset))
+    for _ in range(workers):
+        tasks.put(None)
+
+    processes = [multiprocessing.Process(target=_parse_file_worker, args=(tasks, results, station_ids, batch_size)) for _ in range(workers)]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    written = {}
+    try:
+        remaining = len(entries)
+        while remaining:
+            kind, filename, payload = results.get()
+            if kind == 'batch':
+                batch, offset = payload
+                file_stats = written.setdefault(filename, ImportStats())
+                _write_batch(Trip, batch, file_stats, entries[filename], offset)
+            elif kind == 'done':
+                file_stats, offset = payload
+                _complete_entry(entries[filename], offset)
+                file_stats.rows = written[filename].rows if filename in written else 0
+                file_stats.files = 1
+                stats.merge(file_stats)
+                remaining -= 1
+                if progress:
+                    progress(filename, file_stats)
+            else:
+                raise RuntimeError('Failed to import {}. {}'.format(filename, payload))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    return stats.stop()
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Per-request performance instrumentation.
+
+RequestMetricsMiddleware measures each request: the number of SQL queries and the time spent in them,
+the time to serialize the data (by the serializers) and to render the response (by the renderers), and
+the total time. They are sent back in a Server-Timing header, written as a JSON log line to the
+'apis.requests' logger, and observed by in-process histograms, which /metrics exposes in the
+Prometheus text format.
+
+The queries are timed by the cursors of the connections (see instrument_connection), so they are
+counted whether DEBUG is on or not. The cursors also log the slow queries (see slowqueries.py). Nothing but a few clock readings and counters is added to a
+request, so the instrumentation can be left on in production.
+"""
+from __future__ import unicode_literals
+
+import bisect, json, logging, threading, types
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends.utils import CursorDebugWrapper, CursorWrapper
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from rest_framework.serializers import ListSerializer
+
+from .slowqueries import log_slow_query, slow_query_threshold
+
+logger = logging.getLogger('apis.requests')
+
+# default settings. They can be overwritten by REQUEST_METRICS in settings.py
+METRICS_DEFAULTS = {
+    'ENABLED': True,
+    'SERVER_TIMING': True, # whether the timings are sent to clients
+    'METRICS_IPS': ('127.0.0.1', '::1'), # the client addresses allowed to read /metrics
+    'METRICS_TOKEN': None, # the bearer token allowing the other clients to read /metrics
+}
+
+# the upper bounds of the buckets of the histograms (Prometheus' defaults for seconds)
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# the histograms observed for each request: name -> (help, buckets, the attribute of RequestMetrics)
+REQUEST_HISTOGRAMS = OrderedDict([
+    ('bluebikes_request_duration_seconds', ('The time to respond to a request', SECONDS_BUCKETS, 'total')),
+    ('bluebikes_request_queries', ('The number of SQL queries run for a request', QUERIES_BUCKETS, 'queries')),
+    ('bluebikes_request_db_seconds', ('The time spent in SQL queries for a request', SECONDS_BUCKETS, 'db')),
+    ('bluebikes_request_serialize_seconds', ('The time to serialize the data of a request', SECONDS_BUCKETS, 'serialize')),
+    ('bluebikes_request_render_seconds', ('The time to render the response of a request', SECONDS_BUCKETS, 'render')),
+])
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def get_metrics_setting(name):
+    """
+    Return a setting of the instrumentation, falling back to METRICS_DEFAULTS
+    """
+    return getattr(settings, 'REQUEST_METRICS', {}).get(name, METRICS_DEFAULTS[name])
+
+
+class RequestMetrics(object):
+    """
+    The measurements of a request. Times are in seconds
+
+    Attributes
+    ----------
+    request : HttpRequest
+        the request measured
+
+    queries : int
+        the number of SQL queries
+
+    db : float
+        the time spent in SQL queries
+
+    serialize : float
+        the time to serialize the data, excluding the queries run meanwhile
+
+    render : float
+        the time to render the response, excluding the queries run meanwhile
+
+    total : float
+        the time from the middleware receiving the request to returning the response
+    """
+
+    def __init__(self, request=None):
+        self.request = request
+        self.start = default_timer()
+        self.queries = 0
+        self.db = 0.0
+        self.serialize = 0.0
+        self.render = 0.0
+        self.total = 0.0
+
+    def add_query(self, elapsed):
+        self.queries += 1
+        self.db += elapsed
+
+    def server_timing(self):
+        """
+        Return the value of the Server-Timing header. 'app' is the time spent in neither of the others
+        """
+        app = max(self.total - self.db - self.serialize - self.render, 0.0)
+        return ', '.join([
+            'db;dur={:.3f};desc="{} queries"'.format(self.db * 1000, self.queries),
+            'serialize;dur={:.3f}'.format(self.serialize * 1000),
+            'render;dur={:.3f}'.format(self.render * 1000),
+            'app;dur={:.3f}'.format(app * 1000),
+            'total;dur={:.3f}'.format(self.total * 1000),
+        ])
+
+
+# the metrics of the request handled by each thread
+_local = threading.local()
+
+
+def current_metrics():
+    """
+    Return the RequestMetrics of the request handled by the thread, or None out of requests
+    """
+    return getattr(_local, 'metrics', None)
+
+
+@contextmanager
+def timed(name):
+    """
+    Add the time of the block to the attribute of the current RequestMetrics. The queries run in the block
+    are not counted twice.
+    """
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    start, db = default_timer(), metrics.db
+    try:
+        yield
+    finally:
+        setattr(metrics, name, getattr(metrics, name) + default_timer() - start - (metrics.db - db))
+
+
+class _TimedCursorMixin(object):
+    # counts and times the queries of the current request, and logs the slow queries (see slowqueries.py)
+
+    def _record(self, sql, params, elapsed, many=False):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.add_query(elapsed)
+        threshold = slow_query_threshold()
+        if threshold is not None and elapsed >= threshold:
+            view = _view_name(metrics.request) if metrics is not None else None
+            log_slow_query(self.db, sql, params, elapsed, view=view, many=many)
+
+    def execute(self, sql, params=None):
+        start = default_timer()
+        result = super(_TimedCursorMixin, self).execute(sql, params)
+        self._record(sql, params, default_timer() - start)
+        return result
+
+    def executemany(self, sql, param_list):
+        start = default_timer()
+        result = super(_TimedCursorMixin, self).executemany(sql, param_list)
+        # param_list can be an iterator, whose rows are already consumed
+        first = param_list[0] if isinstance(param_list, (list, tuple)) and param_list else None
+        self._record(sql, first, default_timer() - start, many=True)
+        return result
+
+
+class TimedCursorWrapper(_TimedCursorMixin, CursorWrapper):
+    pass
+
+
+class TimedCursorDebugWrapper(_TimedCursorMixin, CursorDebugWrapper):
+    pass
+
+
+def _make_cursor(self, cursor):
+    return TimedCursorWrapper(cursor, self)
+
+
+def _make_debug_cursor(self, cursor):
+    return TimedCursorDebugWrapper(cursor, self)
+
+
+def instrument_connection(sender, connection, **kwargs):
+    """
+    Signal receiver of connection_created, which makes the connection time its queries
+    """
+    if getattr(connection, 'timed_cursors', False) or not get_metrics_setting('ENABLED'):
+        return
+    connection.make_cursor = types.MethodType(_make_cursor, connection)
+    connection.make_debug_cursor = types.MethodType(_make_debug_cursor, connection)
+    connection.timed_cursors = True
+
+
+class TimedSerializerMixin(object):
+    """
+    Serializer mixin timing the serialization of the data. Set TimedListSerializer as the list_serializer_class
+    of the serializer to time the lists as well.
+    """
+
+    @property
+    def data(self):
+        with timed('serialize'):
+            return super(TimedSerializerMixin, self).data
+
+
+class TimedListSerializer(TimedSerializerMixin, ListSerializer):
+    pass
+
+
+class Histogram(object):
+    """
+    A histogram of cumulative buckets, as the histograms of Prometheus
+
+    Attributes
+    ----------
+    buckets : tuple
+        the upper bounds of the buckets in ascending order. The last bucket (+Inf) is implicit
+
+    counts : list
+        the number of the observed values in each bucket (not cumulative)
+
+    sum : float
+        the sum of the observed values
+
+    count : int
+        the number of the observed values
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self):
+        """
+        Return (the upper bound, the number of values less than or equal to it) of the buckets, ending with +Inf
+        """
+        total, counts = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else '{}'.format(value)
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry(object):
+    """
+    Thread-safe registry of the histograms of a process, labeled by the views
+    """
+
+    def __init__(self, histograms=REQUEST_HISTOGRAMS):
+        self.histograms = histograms
+        self._lock = threading.Lock()
+        self._series = {} # (name, view) -> Histogram
+
+    def observe(self, view, metrics):
+        """
+        Observe the RequestMetrics of a request to the view
+        """
+        with self._lock:
+            for name, (help_text, buckets, attribute) in self.histograms.items():
+                histogram = self._series.get((name, view))
+                if histogram is None:
+                    histogram = self._series[(name, view)] = Histogram(buckets)
+                histogram.observe(getattr(metrics, attribute))
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        """
+        Return the histograms in the Prometheus text exposition format
+        """
+        with self._lock:
+            series = sorted((key, (list(histogram.cumulative_counts()), histogram.sum, histogram.count)) for key, histogram in self._series.items())
+
+        lines = []
+        for name, (help_text, buckets, attribute) in self.histograms.items():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} histogram'.format(name))
+            for (series_name, view), (counts, total, count) in series:
+                if series_name != name:
+                    continue
+                label = 'view="{}"'.format(_escape_label(view))
+                for bound, cumulative in counts:
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, _format_value(bound), cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(name, label, _format_value(total)))
+                lines.append('{}_count{{{}}} {}'.format(name, label, count))
+        return '\n'.join(lines) + '\n'
+
+
+# the histograms of this process. Each worker process exposes its own
+REGISTRY = MetricsRegistry()
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return (match.view_name or match.func.__name__) if match is not None else 'unmatched'
+
+
+class RequestMetricsMiddleware(object):
+    """
+    Middleware measuring each request (see RequestMetrics). Put it first in MIDDLEWARE to include the time
+    of the other middleware. The total time of a streaming response (e.g. the exports) ends when its
+    streaming starts.
+    """
+
+    def __init__(self, get_response):
+        if not get_metrics_setting('ENABLED'):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.server_timing = get_metrics_setting('SERVER_TIMING')
+
+    def __call__(self, request):
+        metrics = _local.metrics = RequestMetrics(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.metrics = None
+        metrics.total = default_timer() - metrics.start
+
+        view = _view_name(request)
+        REGISTRY.observe(view, metrics)
+        if self.server_timing:
+            response['Server-Timing'] = metrics.server_timing()
+        if logger.isEnabledFor(logging.INFO):
+            record = OrderedDict([
+                ('method', request.method),
+                ('path', request.path),
+                ('view', view),
+                ('status', response.status_code),
+                ('queries', metrics.queries),
+                ('db_ms', round(metrics.db * 1000, 3)),
+                ('serialize_ms', round(metrics.serialize * 1000, 3)),
+                ('render_ms', round(metrics.render * 1000, 3)),
+                ('total_ms', round(metrics.total * 1000, 3)),
+            ])
+            logger.info(json.dumps(record), extra={'metrics': record})
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this, and the callback is called when the rendering ends
+        metrics = current_metrics()
+        if metrics is not None:
+            start, db = default_timer(), metrics.db
+
+            def rendered(response):
+                metrics.render += default_timer() - start - (metrics.db - db)
+
+            response.add_post_render_callback(rendered)
+        return response
+
+
+def metrics_allowed(request):
+    """
+    Whether the request comes from METRICS_IPS or carries METRICS_TOKEN in its Authorization header
+    (e.g. bearer_token of a Prometheus scrape config)
+    """
+    if request.META.get('REMOTE_ADDR') in get_metrics_setting('METRICS_IPS'):
+        return True
+    token = get_metrics_setting('METRICS_TOKEN')
+    scheme, _, credentials = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return bool(token) and scheme.lower() == 'bearer' and constant_time_compare(credentials.strip(), token)
+
+
+def metrics_view(request):
+    """
+    Return the histograms of the requests in the Prometheus text format, to the clients allowed by metrics_allowed
+    """
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.render(), content_type=PROMETHEUS_CONTENT_TYPE)
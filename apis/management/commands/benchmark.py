@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json, platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from apis.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = 'Run benchmarks and print their results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help='benchmarks to run ({}). Default is all of them'.format(', '.join(sorted(BENCHMARKS))))
+        parser.add_argument('--rows', type=int, default=100000, help='the number of rows to process')
+        parser.add_argument('--repeat', type=int, default=3, help='the number of runs. The best one is reported')
+        parser.add_argument('--data', help='the directory written by gen_synthetic_trips for the load benchmark. Default is generating --rows trips')
+        parser.add_argument('--requests', type=int, default=20, help='the number of requests to each endpoint for the load benchmark')
+        parser.add_argument('--readers', type=int, default=4, help='the number of concurrent readers for the concurrent_reads benchmark')
+
+    def handle(self, *args, **options):
+        names = options['names'] or sorted(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError('Unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+        results = {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+            },
+            'benchmarks': {},
+        }
+        for name in names:
+            kwargs = {'rows': options['rows'], 'repeat': options['repeat']}
+            if name == 'load':
+                kwargs.update(data=options['data'], requests=options['requests'])
+            elif name == 'concurrent_reads':
+                kwargs.update(readers=options['readers'])
+            try:
+                results['benchmarks'][name] = BENCHMARKS[name](**kwargs)
+            except ValueError as e:
+                raise CommandError(e)
+
+        self.stdout.write(json.dumps(results, indent=2, sort_keys=True, separators=(',', ': ')))
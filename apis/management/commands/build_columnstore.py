@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apis.columnstore import build_columnstore, get_columnstore_setting, numpy
+
+
+class Command(BaseCommand):
+    help = 'Build the columnar store of trips from the Trip table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help="the directory of the store. Default is TRIP_COLUMNSTORE['PATH']")
+
+    def handle(self, *args, **options):
+        if numpy is None:
+            raise CommandError('The columnar store requires numpy')
+
+        path = options['path'] or get_columnstore_setting('PATH')
+        rows = build_columnstore(path)
+        self.stdout.write('Built the columnar store of {} trips in {}'.format(rows, path))
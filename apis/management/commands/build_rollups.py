@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apis.models import DailyTripRollup, HourlyTripRollup
+from apis.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the rollups of trips from the Trip table'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rebuild_rollups()
+
+        self.stdout.write('Built {} daily and {} hourly rollups'.format(DailyTripRollup.objects.count(), HourlyTripRollup.objects.count()))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apis.synthetic import load_synthetic_stations, write_synthetic_data
+
+
+class Command(BaseCommand):
+    help = 'Write synthetic trip history files, stations and regions (GBFS json) for load tests and benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='the directory to write the files')
+        parser.add_argument('--trips', type=int, default=1000000, help='the number of trips. Default is 1000000')
+        parser.add_argument('--start', default='2019-01', help='the first month (YYYY-MM). Default is 2019-01')
+        parser.add_argument('--months', type=int, default=12, help='the number of monthly files. Default is 12')
+        parser.add_argument('--stations', type=int, default=350, help='the number of stations. Default is 350')
+        parser.add_argument('--bikes', type=int, default=3500, help='the number of bikes. Default is 3500')
+        parser.add_argument('--seed', type=int, default=0, help='the seed of the random generator. Default is 0')
+        parser.add_argument('--gzip', action='store_true', help='write the trip files as csv.gz')
+        parser.add_argument('--load-stations', action='store_true', help='also save the stations and the regions to the database')
+
+    def handle(self, *args, **options):
+        match = re.match(r'^(\d{4})-(\d{2})$', options['start'])
+        if match is None or not 1 <= int(match.group(2)) <= 12:
+            raise CommandError('Specify --start as YYYY-MM')
+        for name in ('trips', 'months', 'stations', 'bikes'):
+            if options[name] < 1:
+                raise CommandError('Specify a positive number as --{}'.format(name))
+
+        files = write_synthetic_data(options['directory'], trips=options['trips'], start=(int(match.group(1)), int(match.group(2))),
+                                     months=options['months'], stations=options['stations'], bikes=options['bikes'],
+                                     seed=options['seed'], compress=options['gzip'])
+        self.stdout.write('Wrote {} trips to {} files in {}'.format(options['trips'], len(files), options['directory']))
+
+        if options['load_stations']:
+            self.stdout.write('Saved {} stations'.format(load_synthetic_stations(options['directory'])))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apis.importer import IMPORT_MODES, find_data_files, import_files
+
+
+class Command(BaseCommand):
+    help = 'Import trip history data from csv, csv.gz or zip files (e.g. YYYYmm-bluebikes-tripdata.zip)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', default=['./data'],
+                            help='trip history files or directories containing them. Default is ./data')
+        parser.add_argument('--mode', choices=IMPORT_MODES,
+                            help="'bulk' or 'rowwise'. Default is TRIP_IMPORT['MODE']")
+        parser.add_argument('--batch-size', type=int,
+                            help="the number of trips written in one transaction. Default is TRIP_IMPORT['BATCH_SIZE']")
+        parser.add_argument('--workers', type=int,
+                            help="the number of processes to parse files in parallel. Default is TRIP_IMPORT['WORKERS']")
+
+    def progress(self, filename, stats):
+        self.stdout.write('{}: {} trips ({:.0f} rows/sec)'.format(filename, stats.rows, stats.rows_per_sec))
+
+    def handle(self, *args, **options):
+        files = find_data_files(options['paths'])
+        if not files:
+            raise CommandError('No trip history files found in {}'.format(', '.join(options['paths'])))
+
+        stats = import_files(files, mode=options['mode'], batch_size=options['batch_size'],
+                             workers=options['workers'], progress=self.progress)
+
+        self.stdout.write(str(stats))
+        if stats.skipped_files:
+            self.stdout.write('{} files are skipped because they have already been imported'.format(len(stats.skipped_files)))
+        for filename in stats.changed_files:
+            self.stderr.write('{} is skipped because it has changed since it was imported'.format(filename))
+        if stats.invalid_rows:
+            self.stdout.write('{} invalid rows are skipped'.format(stats.invalid_rows))
+        if stats.unknown_stations:
+            self.stdout.write('{} stations referred by trips are not found'.format(len(stats.unknown_stations)))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from apis.partitions import convert_to_partitions, drop_partition, is_partitioned, list_partitions, parse_month, partition_name, partitions_enabled
+
+
+class Command(BaseCommand):
+    help = 'Convert the Trip table to monthly partitions, list them, or drop the trips of months'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--list', action='store_true', help='list the partitions and the number of their trips')
+        parser.add_argument('--drop', action='append', default=[], metavar='YYYY-MM',
+                            help='drop the trips, the rollups and the ledger entries of the month, so that its file can be imported again')
+
+    def handle(self, *args, **options):
+        if not partitions_enabled():
+            raise CommandError("Set TRIP_PARTITIONS['ENABLED'] to True in settings.py to partition trips")
+
+        if options['drop']:
+            try:
+                months = [parse_month(value) for value in options['drop']]
+            except ValueError as e:
+                raise CommandError(e)
+            for month in months:
+                if drop_partition(month):
+                    self.stdout.write('Dropped {}'.format(partition_name(month)))
+                else:
+                    self.stdout.write('{} has no partition'.format(month.strftime('%Y-%m')))
+            return
+
+        if not options['list']:
+            if is_partitioned():
+                self.stdout.write('Trips are already partitioned')
+            else:
+                self.stdout.write('Converted trips to {} partitions'.format(len(convert_to_partitions())))
+
+        with connection.cursor() as cursor:
+            for month in list_partitions():
+                name = partition_name(month)
+                cursor.execute('SELECT COUNT(*) FROM {}'.format(connection.ops.quote_name(name)))
+                self.stdout.write('{} {} trips'.format(name, cursor.fetchone()[0]))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json, os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apis.slowqueries import get_slow_query_setting, read_slow_queries, summarize_slow_queries
+
+
+class Command(BaseCommand):
+    help = 'Report the shapes of the slow queries taking the longest time in total'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help="the slow-query log. Default is SLOW_QUERY_LOG['PATH']")
+        parser.add_argument('--top', type=int, default=10, help='the number of shapes to report')
+        parser.add_argument('--view', help='report only the queries run by the view (e.g. trip-summary)')
+        parser.add_argument('--json', action='store_true', help='print the shapes as JSON')
+
+    def handle(self, *args, **options):
+        path = options['path'] or get_slow_query_setting('PATH')
+        if not os.path.exists(path):
+            raise CommandError('No slow queries are logged in {}'.format(path))
+
+        entries = read_slow_queries(path)
+        if options['view']:
+            entries = [entry for entry in entries if entry.get('view') == options['view']]
+        shapes = summarize_slow_queries(entries)
+        count = len(shapes)
+        shapes = shapes[:options['top']]
+
+        if options['json']:
+            self.stdout.write(json.dumps(shapes, indent=2, sort_keys=True, separators=(',', ': ')))
+            return
+
+        self.stdout.write('{} slow queries of {} shapes in {}'.format(len(entries), count, path))
+        for rank, shape in enumerate(shapes, 1):
+            self.stdout.write('')
+            self.stdout.write('#{} {}: {} queries, total {} ms, mean {} ms, max {} ms, views: {}'.format(
+                rank, shape['fingerprint'], shape['count'], shape['total_ms'], shape['mean_ms'], shape['max_ms'], ', '.join(shape['views']) or '-'))
+            self.stdout.write('    ' + shape['sql'])
+            self.stdout.write('    params of the slowest: {}'.format(json.dumps(shape['params'])))
+            for line in shape['plan'] or []:
+                self.stdout.write('    plan: ' + line)
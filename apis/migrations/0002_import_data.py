@@ -31,8 +31,7 @@ def import_data(*args):
     print('-- importing region data --')
     response = urllib.urlopen('https://gbfs.bluebikes.com/gbfs/en/system_regions.json')
     data = json.loads(response.read(), object_hook=encode_utf8)
-    for r in data['data']['regions']:
-        Region(**r).save()
+    Region.objects.bulk_create([Region(**r) for r in data['data']['regions']])
 
     if 'test' not in sys.argv:    
         print('-- importing station data --')
@@ -40,13 +39,17 @@ def import_data(*args):
         response = urllib.urlopen('https://gbfs.bluebikes.com/gbfs/en/station_information.json')
         data = json.loads(response.read(), object_hook=encode_utf8)
 
+        stations = []
         for s in data['data']['stations']:
             station = Station(station_id=s['station_id'], short_name=s['short_name'], name=s['name'], lat=s['lat'], lon=s['lon'], capacity=s['capacity'], electric_bike_surcharge_waiver=s['electric_bike_surcharge_waiver'], eightd_has_key_dispenser=s['eightd_has_key_dispenser'], has_kiosk=s['has_kiosk'])
 
             if 'region_id' in s:
                 station.region_id = s['region_id']
 
-            station.save()
+            stations.append(station)
+
+        # in one INSERT per batch instead of a round trip per station
+        Station.objects.bulk_create(stations, batch_size=500)
 
 class Migration(migrations.Migration):
 
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import ExtractHour
+import django.db.models.deletion
+
+# the rollups of this migration and their dimensions. The aggregation is kept here as it is at this migration,
+# so later changes of apis.rollups don't change what this migration does
+ROLLUP_DIMENSIONS = (
+    ('DailyTripRollup', ('start_date', 'gender', 'is_subscriber', 'birth_year')),
+    ('HourlyTripRollup', ('start_date', 'start_hour', 'start_station', 'gender', 'is_subscriber', 'birth_year')),
+)
+
+
+def build_rollups(apps, schema_editor):
+    # summarize the trips imported before the rollups existed. The hours are of the current time zone
+    Trip = apps.get_model('apis', 'Trip')
+    for model_name, dimensions in ROLLUP_DIMENSIONS:
+        model = apps.get_model('apis', model_name)
+        trips = Trip.objects.all()
+        if 'start_hour' in dimensions:
+            trips = trips.annotate(start_hour=ExtractHour('start_time'))
+        rows = list(trips.values(*dimensions).annotate(
+            count=Count('pk'), duration_sum=Sum('duration'), duration_min=Min('duration'), duration_max=Max('duration')
+        ).order_by())
+        for row in rows:
+            if 'start_station' in row:
+                row['start_station_id'] = row.pop('start_station')
+        model.objects.bulk_create([model(**row) for row in rows], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0004_trip_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTripRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField()),
+                ('gender', models.IntegerField()),
+                ('is_subscriber', models.BooleanField()),
+                ('birth_year', models.IntegerField(null=True)),
+                ('count', models.IntegerField()),
+                ('duration_sum', models.BigIntegerField()),
+                ('duration_min', models.IntegerField()),
+                ('duration_max', models.IntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='HourlyTripRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateField()),
+                ('gender', models.IntegerField()),
+                ('is_subscriber', models.BooleanField()),
+                ('birth_year', models.IntegerField(null=True)),
+                ('count', models.IntegerField()),
+                ('duration_sum', models.BigIntegerField()),
+                ('duration_min', models.IntegerField()),
+                ('duration_max', models.IntegerField()),
+                ('start_hour', models.IntegerField()),
+                ('start_station', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='apis.Station')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailytriprollup',
+            unique_together=set([('start_date', 'gender', 'is_subscriber', 'birth_year')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='hourlytriprollup',
+            unique_together=set([('start_date', 'start_hour', 'start_station', 'gender', 'is_subscriber', 'birth_year')]),
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.utils import timezone
+
+# the rollups of this migration and their dimensions, as the columns of the rollups
+ROLLUP_DIMENSIONS = (
+    ('DailyTripRollup', ('start_date', 'gender', 'is_subscriber', 'birth_year')),
+    ('HourlyTripRollup', ('start_date', 'start_hour', 'start_station_id', 'gender', 'is_subscriber', 'birth_year')),
+)
+
+TRIP_FIELDS = ('start_time', 'start_station_id', 'gender', 'is_subscriber', 'birth_year', 'duration', 'bike_id')
+
+
+def build_sketches(apps, schema_editor):
+    # fill only the new columns of the existing rollups, reading the trips date by date.
+    # The sketch classes define the format of the columns
+    from apis.sketches import HyperLogLog, TDigest
+
+    Trip = apps.get_model('apis', 'Trip')
+    dates = list(Trip.objects.order_by('start_date').values_list('start_date', flat=True).distinct())
+    for date in dates:
+        sketches = {} # (model name, key) -> (TDigest of durations, HyperLogLog of bike ids)
+        for values in Trip.objects.filter(start_date=date).values(*TRIP_FIELDS).iterator():
+            values['start_date'] = date
+            values['start_hour'] = timezone.localtime(values['start_time']).hour
+            for model_name, dimensions in ROLLUP_DIMENSIONS:
+                digest, bikes = sketches.setdefault((model_name,) + tuple(values[d] for d in dimensions), (TDigest(), HyperLogLog()))
+                digest.add(values['duration'])
+                bikes.add(values['bike_id'])
+
+        for model_name, dimensions in ROLLUP_DIMENSIONS:
+            model = apps.get_model('apis', model_name)
+            for row in model.objects.filter(start_date=date):
+                sketch = sketches.get((model_name,) + tuple(getattr(row, d) for d in dimensions))
+                if sketch is not None:
+                    model.objects.filter(pk=row.pk).update(duration_digest=sketch[0].to_bytes(), bike_sketch=sketch[1].to_bytes())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0006_dataversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dailytriprollup',
+            name='bike_sketch',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='dailytriprollup',
+            name='duration_digest',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='hourlytriprollup',
+            name='bike_sketch',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='hourlytriprollup',
+            name='duration_digest',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(build_sketches, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+FIELDS = (
+    ('start_station', 'start_station_id'),
+    ('stop_station', 'stop_station_id'),
+)
+
+
+def _foreign_key(Trip, Station, name, related_name, constraint):
+    field = models.ForeignKey(Station, on_delete=django.db.models.deletion.DO_NOTHING, related_name=related_name, db_constraint=constraint)
+    field.set_attributes_from_name(name)
+    field.model = Trip
+    return field
+
+
+def _set_constraints(apps, schema_editor, constraint):
+    # SQLite doesn't enforce the constraints, and altering them would copy the whole Trip table
+    if schema_editor.connection.vendor == 'sqlite':
+        return
+    Trip = apps.get_model('apis', 'Trip')
+    Station = apps.get_model('apis', 'Station')
+    for name, related_name in FIELDS:
+        schema_editor.alter_field(Trip, _foreign_key(Trip, Station, name, related_name, not constraint), _foreign_key(Trip, Station, name, related_name, constraint))
+
+
+def drop_constraints(apps, schema_editor):
+    _set_constraints(apps, schema_editor, False)
+
+
+def add_constraints(apps, schema_editor):
+    _set_constraints(apps, schema_editor, True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0007_rollup_sketches'),
+    ]
+
+    operations = [
+        # trips referring to the stations missing in the station feed are imported as they are on SQLite
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(drop_constraints, add_constraints)],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='trip',
+                    name='start_station',
+                    field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='start_station_id', to='apis.Station'),
+                ),
+                migrations.AlterField(
+                    model_name='trip',
+                    name='stop_station',
+                    field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='stop_station_id', to='apis.Station'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def record_rollups_version(apps, schema_editor):
+    # the rollups built so far summarize the current trips
+    DataVersion = apps.get_model('apis', 'DataVersion')
+    trips = DataVersion.objects.filter(name='trips').first()
+    if trips:
+        DataVersion.objects.update_or_create(name='rollups', defaults={'version': trips.version, 'updated_at': timezone.now()})
+
+
+def forget_rollups_version(apps, schema_editor):
+    DataVersion = apps.get_model('apis', 'DataVersion')
+    DataVersion.objects.filter(name='rollups').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0008_trip_station_constraints'),
+    ]
+
+    operations = [
+        migrations.RunPython(record_rollups_version, forget_rollups_version),
+    ]
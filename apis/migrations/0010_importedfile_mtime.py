@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0009_rollups_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importedfile',
+            name='mtime',
+            field=models.FloatField(null=True),
+        ),
+    ]
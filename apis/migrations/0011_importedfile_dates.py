@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime, re
+
+from django.db import migrations, models
+
+_MONTH_PREFIX = re.compile(r'^(\d{4})(\d{2})')
+
+
+def record_file_months(apps, schema_editor):
+    # the trips don't record their files, so the dates of the files imported so far are taken from their names
+    # (e.g. 201903-bluebikes-tripdata.zip). The entries of other names are left without dates
+    ImportedFile = apps.get_model('apis', 'ImportedFile')
+    for entry in ImportedFile.objects.filter(row_count__gt=0):
+        match = _MONTH_PREFIX.match(entry.name)
+        if not match or not 1 <= int(match.group(2)) <= 12:
+            continue
+        first = datetime.date(int(match.group(1)), int(match.group(2)), 1)
+        entry.first_date = first
+        entry.last_date = (first.replace(day=28) + datetime.timedelta(days=4)).replace(day=1) - datetime.timedelta(days=1)
+        entry.save(update_fields=['first_date', 'last_date'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('apis', '0010_importedfile_mtime'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importedfile',
+            name='first_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.AddField(
+            model_name='importedfile',
+            name='last_date',
+            field=models.DateField(null=True),
+        ),
+        migrations.RunPython(record_file_months, migrations.RunPython.noop),
+    ]
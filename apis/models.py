@@ -114,13 +114,28 @@ class Trip(models.Model):
     stop_time = models.DateTimeField()
     start_date = models.DateField()
     stop_date = models.DateField()
-    start_station = models.ForeignKey(Station, on_delete=models.DO_NOTHING, related_name='start_station_id')
-    stop_station = models.ForeignKey(Station, on_delete=models.DO_NOTHING, related_name='stop_station_id')
+    # trips can refer to stations which are not in the station feed, so the foreign keys are not constrained
+    start_station = models.ForeignKey(Station, on_delete=models.DO_NOTHING, related_name='start_station_id', db_constraint=False)
+    stop_station = models.ForeignKey(Station, on_delete=models.DO_NOTHING, related_name='stop_station_id', db_constraint=False)
     bike_id = models.IntegerField()
     is_subscriber = models.BooleanField()
     birth_year = models.IntegerField(null=True)
     gender = models.IntegerField()
 
+    class Meta:
+        # indexes for the filters of TripFilter and the groupings of the summary
+        indexes = [
+            models.Index(fields=['start_time'], name='trip_start_time_idx'),
+            models.Index(fields=['stop_time'], name='trip_stop_time_idx'),
+            models.Index(fields=['start_date', 'gender'], name='trip_start_date_gender_idx'),
+            models.Index(fields=['start_date', 'is_subscriber'], name='trip_start_date_subscr_idx'),
+            models.Index(fields=['start_date', 'duration'], name='trip_start_date_duration_idx'),
+            models.Index(fields=['stop_date'], name='trip_stop_date_idx'),
+            models.Index(fields=['start_station', 'start_time'], name='trip_start_station_time_idx'),
+            models.Index(fields=['birth_year'], name='trip_birth_year_idx'),
+            models.Index(fields=['duration'], name='trip_duration_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         """
             Create a trip. Calcurate date from datetime fields
@@ -129,4 +144,160 @@ class Trip(models.Model):
         self.stop_date = self.stop_time.date()
         return super(Trip, self).save(*args, **kwargs)
 
-    
\ No newline at end of file
+    
+
+class ImportedFile(models.Model):
+    """
+    The class for the ledger of imported trip history files
+
+    Attributes
+    ----------
+    name : str
+        the file name (e.g. 201903-bluebikes-tripdata.zip)
+
+    size : int
+        the size of the file in bytes
+
+    sha1 : str
+        the SHA-1 hash of the content of the file
+
+    mtime : float
+        the modification time of the file when it was hashed, in seconds since the epoch
+
+    row_offset : int
+        the number of csv rows committed so far, including skipped invalid rows
+
+    row_count : int
+        the number of trips imported from the file
+
+    completed : boolean
+        whether the whole file has been imported
+
+    first_date : ISODate
+        the first start date of the trips imported from the file
+
+    last_date : ISODate
+        the last start date of the trips imported from the file
+
+    updated_at : ISODatetime
+        the date time of the last commit
+    """
+
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField()
+    sha1 = models.CharField(max_length=40)
+    mtime = models.FloatField(null=True)
+    row_offset = models.IntegerField(default=0)
+    row_count = models.IntegerField(default=0)
+    completed = models.BooleanField(default=False)
+    first_date = models.DateField(null=True)
+    last_date = models.DateField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class TripRollup(models.Model):
+    """
+    The base class for pre-aggregated trips. Each row summarizes the trips sharing the same values of the dimensions.
+
+    Attributes
+    ----------
+    start_date : ISODate
+        the date to start the trips
+
+    gender: int
+        the users' gender (0 = unknown, 1 = man, 2 = woman)
+
+    is_subscriber:  boolean
+        whether the users have subscriber or not
+
+    birth_year: int
+        the users' birth year
+
+    count : int
+        the number of the trips
+
+    duration_sum : int
+        the sum of the durations of the trips
+
+    duration_min : int
+        the minimum duration of the trips
+
+    duration_max : int
+        the maximum duration of the trips
+
+    duration_digest : bytes
+        the serialized t-digest of the durations of the trips, which estimates their percentiles
+
+    bike_sketch : bytes
+        the serialized HyperLogLog of the bike ids of the trips, which estimates the number of distinct bikes
+    """
+
+    start_date = models.DateField()
+    gender = models.IntegerField()
+    is_subscriber = models.BooleanField()
+    birth_year = models.IntegerField(null=True)
+    count = models.IntegerField()
+    duration_sum = models.BigIntegerField()
+    duration_min = models.IntegerField()
+    duration_max = models.IntegerField()
+    duration_digest = models.BinaryField(null=True)
+    bike_sketch = models.BinaryField(null=True)
+
+    class Meta:
+        abstract = True
+
+
+class DailyTripRollup(TripRollup):
+    """
+    The class for trips aggregated by date, gender, subscriber flag and birth year
+    """
+
+    class Meta:
+        unique_together = ('start_date', 'gender', 'is_subscriber', 'birth_year')
+
+
+class HourlyTripRollup(TripRollup):
+    """
+    The class for trips aggregated by date, hour, start station, gender, subscriber flag and birth year
+
+    Attributes
+    ----------
+    start_hour : int
+        the local hour (0-23) to start the trips
+
+    start_station: Station
+        the station to start the trips
+    """
+
+    start_hour = models.IntegerField()
+    start_station = models.ForeignKey(Station, on_delete=models.DO_NOTHING, related_name='+', db_constraint=False)
+
+    class Meta:
+        unique_together = ('start_date', 'start_hour', 'start_station', 'gender', 'is_subscriber', 'birth_year')
+
+
+class DataVersion(models.Model):
+    """
+    The class for the versions of data, which are incremented every time the data change
+
+    Attributes
+    ----------
+    name : str
+        the name of the data (e.g. trips)
+
+    version : int
+        the version number
+
+    updated_at : ISODatetime
+        the date time of the last change
+    """
+
+    name = models.CharField(max_length=20, primary_key=True)
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return '{} v{}'.format(self.name, self.version)
@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+"""
+Partitioning of trips by the month of start_date.
+
+Trip history files are published a month at a time, so the trips are stored a month per table, and a month
+can be dropped (and imported again) by dropping its table, without deleting its trips row by row.
+
+On PostgreSQL (11 or later), apis_trip is a table partitioned by the range of start_date, whose partitions
+are apis_trip_YYYYmm. The queries filtering start_date read only the partitions of the range.
+
+SQLite has no partitioned tables, so the trips are stored in the tables apis_trip_YYYYmm, and apis_trip
+is a view of the union of them, with triggers routing the trips saved through the ORM to the table of their
+month. The importer writes the trips directly to the tables of their months. The view reads every table,
+so PartitionPruningFilter replaces apis_trip in the queries of TripViewSet with the tables of the months
+in the range of the start_date and start_time filters. The empty table apis_trip_template keeps the
+columns and the indexes the tables of new months are created with.
+
+Partitioning is turned on by TRIP_PARTITIONS['ENABLED'] in settings.py. The Trip table is converted by
+`python manage.py partition_trips` (or at the first import), which refuses while migrations are unapplied.
+
+Limitations:
+
+- Migrations altering the Trip table (AddField, AlterField, indexes, ...) can't be applied after the
+  conversion: the schema editor of Django alters apis_trip, which is a view on SQLite and a partitioned table
+  on PostgreSQL. Such migrations need the trips exported, the table recreated and the trips imported again.
+- PartitionTable replaces the base table of a query through the internals of the ORM (Query.alias_map and
+  BaseTable), which are not a public API. It is written for the Django version in requirements.txt, and
+  TripPartitionTests checks the SQL it compiles to.
+"""
+from __future__ import unicode_literals
+
+import datetime, re
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection as default_connection, connections, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models.sql.datastructures import BaseTable
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils import timezone
+
+from rest_framework.filters import BaseFilterBackend
+
+from .caching import TRIPS, bump_data_version
+from .models import DailyTripRollup, HourlyTripRollup, ImportedFile, Trip
+from .rollups import keep_rollups_current
+
+# default settings. They can be overwritten by TRIP_PARTITIONS in settings.py
+PARTITION_DEFAULTS = {
+    'ENABLED': False,
+}
+
+TRIP_TABLE = Trip._meta.db_table
+# the empty table keeping the schema of the partitions on SQLite
+TEMPLATE_TABLE = TRIP_TABLE + '_template'
+# the Trip table while it is converted on PostgreSQL
+UNPARTITIONED_TABLE = TRIP_TABLE + '_unpartitioned'
+PARTITION_KEY = 'start_date'
+
+_PARTITION_NAME = re.compile(r'^' + TRIP_TABLE + r'_(\d{4})(\d{2})$')
+_MONTH = re.compile(r'^(\d{4})-?(\d{2})$')
+_CREATE_TABLE = re.compile(r'^CREATE TABLE "?' + TEMPLATE_TABLE + r'"?', re.IGNORECASE)
+_CREATE_INDEX = re.compile(r'^CREATE (UNIQUE )?INDEX "?(\w+)"? ON "?' + TEMPLATE_TABLE + r'"?', re.IGNORECASE)
+_ON_UNPARTITIONED = re.compile(r' ON (?:\S+\.)?' + UNPARTITIONED_TABLE + r' ')
+
+
+def get_partition_setting(name):
+    """
+    Return a setting of the partitioning, falling back to PARTITION_DEFAULTS
+    """
+    return getattr(settings, 'TRIP_PARTITIONS', {}).get(name, PARTITION_DEFAULTS[name])
+
+
+def partitions_enabled():
+    return get_partition_setting('ENABLED')
+
+
+def configure_trip_saves():
+    """
+    Make Trip.save() select whether the trip exists before updating it when the trips are partitioned on SQLite,
+    where the number of the rows updated through the triggers of the view isn't reported, so that Django doesn't
+    insert the trip again. The other configurations don't pay for the select. Called when the app is ready.
+    """
+    Trip._meta.select_on_save = bool(partitions_enabled()) and default_connection.vendor == 'sqlite'
+
+
+@receiver(setting_changed)
+def _configure_trip_saves(setting, **kwargs):
+    if setting == 'TRIP_PARTITIONS':
+        configure_trip_saves()
+
+
+def month_of(date):
+    return date.replace(day=1)
+
+
+def next_month(month):
+    return (month.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+
+
+def parse_month(value):
+    """
+    Return the first date of the month given as YYYY-MM or YYYYmm (as the names of trip history files)
+    """
+    match = _MONTH.match(value.strip())
+    if not match:
+        raise ValueError('Invalid month {} (expected YYYY-MM)'.format(value))
+    return datetime.date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def partition_name(month):
+    return '{}_{:04d}{:02d}'.format(TRIP_TABLE, month.year, month.month)
+
+
+def _quote(connection, name):
+    return connection.ops.quote_name(name)
+
+
+def _range_condition(connection, column, month):
+    # the dates are formatted by the code, so they can be literals of the DDL
+    return "{} >= '{}' AND {} < '{}'".format(column, month.isoformat(), column, next_month(month).isoformat())
+
+
+def is_partitioned(connection=None):
+    """
+    Return whether the Trip table has been converted to partitions
+    """
+    connection = connection or default_connection
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('SELECT type FROM sqlite_master WHERE name = %s', [TRIP_TABLE])
+            row = cursor.fetchone()
+            return row is not None and row[0] == 'view'
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', [TRIP_TABLE])
+            row = cursor.fetchone()
+            return row is not None and row[0] == 'p'
+    return False
+
+
+def list_partitions(connection=None):
+    """
+    Return the first dates of the months which have partitions, in ascending order
+    """
+    connection = connection or default_connection
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            # '_' of LIKE matches any character, and the names are matched again below
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE %s", [TRIP_TABLE + '_%'])
+        elif connection.vendor == 'postgresql':
+            cursor.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)', [TRIP_TABLE])
+        else:
+            return []
+        names = [row[0] for row in cursor.fetchall()]
+    matches = [_PARTITION_NAME.match(name) for name in names]
+    return sorted(datetime.date(int(m.group(1)), int(m.group(2)), 1) for m in matches if m)
+
+
+def overlapping_months(months, start=None, stop=None):
+    """
+    Return the months overlapping the range of dates. start and stop are inclusive, and None is unbounded
+    """
+    return [month for month in months
+            if (start is None or next_month(month) > start) and (stop is None or month <= stop)]
+
+
+# SQLite
+
+def _sqlite_schema(cursor):
+    # the DDL of the template table and its indexes
+    cursor.execute("SELECT type, sql FROM sqlite_master WHERE tbl_name = %s AND sql IS NOT NULL", [TEMPLATE_TABLE])
+    rows = cursor.fetchall()
+    table = [sql for kind, sql in rows if kind == 'table'][0]
+    indexes = [sql for kind, sql in rows if kind == 'index']
+    return table, indexes
+
+
+def _sqlite_columns(cursor):
+    cursor.execute('PRAGMA table_info({})'.format(TEMPLATE_TABLE))
+    return [row[1] for row in cursor.fetchall()]
+
+
+def _sqlite_create_partition(cursor, month, indexes=True):
+    name = partition_name(month)
+    table_sql, index_sqls = _sqlite_schema(cursor)
+    cursor.execute(_CREATE_TABLE.sub('CREATE TABLE "{}"'.format(name), table_sql))
+    if indexes:
+        _sqlite_create_indexes(cursor, month, index_sqls)
+
+
+def _sqlite_create_indexes(cursor, month, index_sqls):
+    name = partition_name(month)
+    for sql in index_sqls:
+        cursor.execute(_CREATE_INDEX.sub(
+            lambda m: 'CREATE {}INDEX "{}_{}" ON "{}"'.format(m.group(1) or '', name, m.group(2), name), sql))
+
+
+def _sqlite_next_id(connection, months):
+    # the maximum of each table is read from the end of its primary key
+    tables = [TEMPLATE_TABLE] + [partition_name(month) for month in months]
+    return '(SELECT COALESCE(MAX(m), 0) + 1 FROM ({}))'.format(
+        ' UNION ALL '.join('SELECT MAX("id") AS m FROM {}'.format(_quote(connection, table)) for table in tables))
+
+
+def _sqlite_rebuild_view(connection, cursor, months):
+    """
+    Recreate the view apis_trip of the union of the partitions and the triggers routing the changes through it
+    """
+    quote = lambda name: _quote(connection, name)
+    tables = [partition_name(month) for month in months] or [TEMPLATE_TABLE]
+    columns = _sqlite_columns(cursor)
+    key = quote(PARTITION_KEY)
+
+    # dropping the view drops its triggers
+    cursor.execute('DROP VIEW IF EXISTS {}'.format(quote(TRIP_TABLE)))
+    cursor.execute('CREATE VIEW {} AS {}'.format(quote(TRIP_TABLE), ' UNION ALL '.join('SELECT * FROM {}'.format(quote(table)) for table in tables)))
+
+    next_id = _sqlite_next_id(connection, months)
+    values = ', '.join(('COALESCE(NEW."id", {})'.format(next_id) if column == 'id' else 'NEW.{}'.format(quote(column))) for column in columns)
+    inserts = ''.join('INSERT INTO {} ({}) SELECT {} WHERE {};\n'.format(
+        quote(partition_name(month)), ', '.join(quote(column) for column in columns), values, _range_condition(connection, 'NEW.' + key, month)) for month in months)
+    # a trip out of the partitions is refused (route_trip creates the partition of a trip saved through the ORM)
+    refused = 'NOT ({})'.format(' OR '.join('({})'.format(_range_condition(connection, 'NEW.' + key, month)) for month in months)) if months else '1'
+    inserts += "SELECT RAISE(ABORT, 'No partition of {} for the {}') WHERE {};\n".format(TRIP_TABLE, PARTITION_KEY, refused)
+    deletes = ''.join('DELETE FROM {} WHERE "id" = OLD."id";\n'.format(quote(table)) for table in tables)
+
+    trigger = 'CREATE TRIGGER {} INSTEAD OF {} ON {} BEGIN\n{}END'
+    cursor.execute(trigger.format(quote(TRIP_TABLE + '_insert'), 'INSERT', quote(TRIP_TABLE), inserts))
+    cursor.execute(trigger.format(quote(TRIP_TABLE + '_delete'), 'DELETE', quote(TRIP_TABLE), deletes))
+    # an updated trip moves to the partition of its new start_date
+    cursor.execute(trigger.format(quote(TRIP_TABLE + '_update'), 'UPDATE', quote(TRIP_TABLE), deletes + inserts))
+
+
+def _sqlite_convert(connection, cursor, months):
+    cursor.execute('ALTER TABLE {} RENAME TO {}'.format(_quote(connection, TRIP_TABLE), _quote(connection, TEMPLATE_TABLE)))
+    table_sql, index_sqls = _sqlite_schema(cursor)
+    for month in months:
+        # the indexes are built after the trips are copied, which is faster than updating them row by row
+        _sqlite_create_partition(cursor, month, indexes=False)
+        cursor.execute('INSERT INTO {} SELECT * FROM {} WHERE {}'.format(
+            _quote(connection, partition_name(month)), _quote(connection, TEMPLATE_TABLE), _range_condition(connection, _quote(connection, PARTITION_KEY), month)))
+        _sqlite_create_indexes(cursor, month, index_sqls)
+    cursor.execute('DELETE FROM {}'.format(_quote(connection, TEMPLATE_TABLE)))
+    _sqlite_rebuild_view(connection, cursor, months)
+
+
+# PostgreSQL
+
+def _postgresql_create_partition(connection, cursor, month):
+    # the indexes of the parent table are created on the partition as well
+    cursor.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+        _quote(connection, partition_name(month)), _quote(connection, TRIP_TABLE), month.isoformat(), next_month(month).isoformat()))
+
+
+def _postgresql_convert(connection, cursor, months):
+    quote = lambda name: _quote(connection, name)
+    cursor.execute('ALTER TABLE {} RENAME TO {}'.format(quote(TRIP_TABLE), quote(UNPARTITIONED_TABLE)))
+    cursor.execute('ALTER INDEX {} RENAME TO {}'.format(quote(TRIP_TABLE + '_pkey'), quote(UNPARTITIONED_TABLE + '_pkey')))
+    cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexdef NOT LIKE 'CREATE UNIQUE INDEX%%'", [UNPARTITIONED_TABLE])
+    index_sqls = [row[0] for row in cursor.fetchall()]
+    cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [UNPARTITIONED_TABLE, 'id'])
+    sequence = cursor.fetchone()[0]
+
+    # the primary key of a partitioned table has to include the partition key
+    cursor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY RANGE ({})'.format(quote(TRIP_TABLE), quote(UNPARTITIONED_TABLE), quote(PARTITION_KEY)))
+    cursor.execute('ALTER TABLE {} ADD PRIMARY KEY ("id", {})'.format(quote(TRIP_TABLE), quote(PARTITION_KEY)))
+    cursor.execute('ALTER SEQUENCE {} OWNED BY {}."id"'.format(sequence, quote(TRIP_TABLE)))
+    for month in months:
+        _postgresql_create_partition(connection, cursor, month)
+    cursor.execute('INSERT INTO {} SELECT * FROM {}'.format(quote(TRIP_TABLE), quote(UNPARTITIONED_TABLE)))
+    cursor.execute('DROP TABLE {}'.format(quote(UNPARTITIONED_TABLE)))
+    # the indexes are created after the trips are copied, with the same names
+    for sql in index_sqls:
+        cursor.execute(_ON_UNPARTITIONED.sub(' ON {} '.format(quote(TRIP_TABLE)), sql))
+
+
+def convert_to_partitions(connection=None):
+    """
+    Convert the Trip table to the partitions of the months of its trips. Returns the months, or None if the
+    table has already been converted. The trips are copied in one transaction, which takes a while for a large table.
+
+    Raises
+    ----------
+    ImproperlyConfigured
+        if some migrations are unapplied
+    """
+    connection = connection or default_connection
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        raise NotImplementedError('Trips can be partitioned only on SQLite and PostgreSQL')
+
+    with transaction.atomic(using=connection.alias):
+        if is_partitioned(connection):
+            return None
+        # the migrations can't alter the Trip table once it's converted
+        executor = MigrationExecutor(connection)
+        if executor.migration_plan(executor.loader.graph.leaf_nodes()):
+            raise ImproperlyConfigured('Apply the migrations before partitioning trips')
+        months = [month_of(date) for date in Trip.objects.using(connection.alias).dates(PARTITION_KEY, 'month')]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                _sqlite_convert(connection, cursor, months)
+            else:
+                _postgresql_convert(connection, cursor, months)
+    return months
+
+
+def ensure_partitions(months, connection=None):
+    """
+    Create the partitions of the months unless they exist, converting the Trip table first if it hasn't been.
+    Returns the months whose partitions are created.
+    """
+    connection = connection or default_connection
+    months = set(month_of(month) for month in months)
+    with transaction.atomic(using=connection.alias):
+        convert_to_partitions(connection)
+        new_months = sorted(months - set(list_partitions(connection)))
+        if not new_months:
+            return []
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                for month in new_months:
+                    _sqlite_create_partition(cursor, month)
+                _sqlite_rebuild_view(connection, cursor, list_partitions(connection))
+            else:
+                for month in new_months:
+                    _postgresql_create_partition(connection, cursor, month)
+    return new_months
+
+
+def drop_partition(month, connection=None):
+    """
+    Drop the trips of the month with their partition, and the rollups and the ledger entries of the files
+    which trips of the month were imported from, so that the file of the month can be imported again.
+    A file covering other months too would import their trips again, so drop those months as well.
+    Returns False if the month has no partition.
+    """
+    connection = connection or default_connection
+    month = month_of(month)
+    with transaction.atomic(using=connection.alias):
+        months = list_partitions(connection)
+        if month not in months:
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE {}'.format(_quote(connection, partition_name(month))))
+            if connection.vendor == 'sqlite':
+                _sqlite_rebuild_view(connection, cursor, [m for m in months if m != month])
+
+        for model in (DailyTripRollup, HourlyTripRollup):
+            model.objects.using(connection.alias).filter(start_date__gte=month, start_date__lt=next_month(month)).delete()
+        ImportedFile.objects.using(connection.alias).filter(first_date__lt=next_month(month), last_date__gte=month).delete()
+        bump_data_version(TRIPS)
+        keep_rollups_current()
+    return True
+
+
+def next_trip_id(connection=None):
+    """
+    Return the next id of trips on SQLite, where the ids are assigned over the partitions
+    """
+    connection = connection or default_connection
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT ' + _sqlite_next_id(connection, list_partitions(connection)))
+        return cursor.fetchone()[0]
+
+
+def insert_into_partitions(model, objects, connection=None):
+    """
+    Write unsaved trips to the tables of their months on SQLite, instead of through the triggers of the view.
+    The partitions have to exist (see ensure_partitions). The ids are assigned to the objects.
+    """
+    connection = connection or default_connection
+    fields = model._meta.concrete_fields
+    sql = 'INSERT INTO {{}} ({}) VALUES ({})'.format(', '.join(_quote(connection, f.column) for f in fields), ', '.join(['%s'] * len(fields)))
+
+    pk = next_trip_id(connection)
+    months = {}
+    for obj in objects:
+        obj.pk, pk = pk, pk + 1
+        months.setdefault(month_of(obj.start_date), []).append(obj)
+    with connection.cursor() as cursor:
+        for month, trips in sorted(months.items()):
+            cursor.executemany(sql.format(_quote(connection, partition_name(month))),
+                               [[f.get_db_prep_save(f.pre_save(obj, True), connection) for f in fields] for obj in trips])
+
+
+def route_trip(sender, instance, using, raw=False, **kwargs):
+    """
+    Signal receiver of pre_save of Trip, which creates the partition of the trip, and assigns the id
+    of a new trip on SQLite (the id inserted by the triggers of the view can't be read back)
+    """
+    if not partitions_enabled() or raw:
+        return
+    connection = connections[using]
+    ensure_partitions([instance.start_date], connection)
+    if instance.pk is None and connection.vendor == 'sqlite':
+        instance.pk = next_trip_id(connection)
+
+
+class PartitionTable(BaseTable):
+    """
+    The base table of a query reading the partitions of some months instead of the view of all of them on SQLite.
+    The union of the partitions keeps the alias of the view, so the rest of the query refers to it as it is.
+    """
+
+    def __init__(self, table_name, alias, partitions):
+        super(PartitionTable, self).__init__(table_name, alias)
+        self.partitions = partitions
+
+    def as_sql(self, compiler, connection):
+        alias = compiler.quote_name_unless_alias(self.table_alias)
+        if len(self.partitions) == 1:
+            return '{} {}'.format(_quote(connection, self.partitions[0]), alias), []
+        union = ' UNION ALL '.join('SELECT * FROM {}'.format(_quote(connection, name)) for name in self.partitions)
+        return '({}) {}'.format(union, alias), []
+
+    def relabeled_clone(self, change_map):
+        return self.__class__(self.table_name, change_map.get(self.table_alias, self.table_alias), self.partitions)
+
+
+def prune_partitions(queryset, start=None, stop=None):
+    """
+    Make the query of trips read only the partitions overlapping the range of start_date. start and stop are
+    inclusive, and None is unbounded. The query has to filter the range itself.
+    """
+    if (start is None and stop is None) or not partitions_enabled():
+        return queryset
+    connection = connections[queryset.db]
+
+    if connection.vendor == 'postgresql':
+        # PostgreSQL prunes the partitions by the conditions of start_date, which the time filters don't give
+        if start is not None:
+            queryset = queryset.filter(**{PARTITION_KEY + '__gte': start})
+        if stop is not None:
+            queryset = queryset.filter(**{PARTITION_KEY + '__lte': stop})
+        return queryset
+
+    if connection.vendor != 'sqlite' or not is_partitioned(connection):
+        return queryset
+    months = overlapping_months(list_partitions(connection), start, stop)
+    if not months:
+        return queryset.none()
+    queryset = queryset.all()
+    query = queryset.query
+    alias = query.get_initial_alias()
+    query.alias_map[alias] = PartitionTable(TRIP_TABLE, alias, [partition_name(month) for month in months])
+    return queryset
+
+
+def filter_date_bounds(values):
+    """
+    Return the inclusive range (start, stop) of start_date given by the cleaned values of TripFilter.
+    start_date is the local date of start_time
+    """
+    starts, stops = [], []
+    if values.get('start_date'):
+        starts.append(values['start_date'])
+        stops.append(values['start_date'])
+    if values.get('start_date_gt'):
+        starts.append(values['start_date_gt'] + datetime.timedelta(days=1))
+    if values.get('start_date_lt'):
+        stops.append(values['start_date_lt'] - datetime.timedelta(days=1))
+    if values.get('start_time'):
+        starts.append(timezone.localtime(values['start_time']).date())
+        stops.append(timezone.localtime(values['start_time']).date())
+    if values.get('start_time_gt'):
+        starts.append(timezone.localtime(values['start_time_gt']).date())
+    if values.get('start_time_lt'):
+        stops.append(timezone.localtime(values['start_time_lt']).date())
+    return (max(starts) if starts else None), (min(stops) if stops else None)
+
+
+class PartitionPruningFilter(BaseFilterBackend):
+    """
+    Filter backend making the queries of trips read only the partitions of the months in the range of
+    the start_date and start_time filters of the filter_class of the view. Put it after DjangoFilterBackend.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        if not partitions_enabled():
+            return queryset
+        filter_class = view.filter_class
+        form = filter_class(request.query_params, queryset=filter_class._meta.model.objects.none(), request=request).form
+        if not form.is_valid():
+            return queryset
+        start, stop = filter_date_bounds(form.cleaned_data)
+        return prune_partitions(queryset, start, stop)
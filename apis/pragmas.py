@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Tuning of SQLite connections by PRAGMA statements.
+
+configure_connection, a receiver of connection_created, applies SQLITE_PRAGMAS to every new SQLite
+connection. The defaults put the database in WAL mode, in which readers don't wait for the transactions
+of writers (e.g. the batches of a trip import), and let the summaries scan the database through a
+memory map and a large page cache.
+
+bulk_load switches the connection to SQLITE_BULK_LOAD_PRAGMAS while trips are imported, which give it
+a larger page cache and fewer checkpoints, and restores the pragmas afterwards. synchronous stays NORMAL:
+in WAL mode, the transactions committed since the last checkpoint may be lost on a power failure, but the
+database stays consistent. With synchronous=OFF, a power failure or an OS crash can corrupt it.
+"""
+from __future__ import unicode_literals
+
+import re
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection as default_connection
+
+# applied to every connection. They can be overwritten by SQLITE_PRAGMAS in settings.py
+SQLITE_PRAGMA_DEFAULTS = {
+    'busy_timeout': 5000,        # milliseconds to wait for a lock before 'database is locked'
+    'journal_mode': 'WAL',       # persisted in the database file
+    'synchronous': 'NORMAL',     # WAL is synced at checkpoints, not at every commit
+    'cache_size': -65536,        # negative sizes are in KiB (64 MiB)
+    'mmap_size': 268435456,      # bytes of the database read through a memory map (256 MiB)
+    'temp_store': 'MEMORY',      # temporary tables and indexes (e.g. of GROUP BY and ORDER BY) in memory
+}
+
+# applied while trips are imported. They can be overwritten by SQLITE_BULK_LOAD_PRAGMAS in settings.py
+SQLITE_BULK_LOAD_DEFAULTS = {
+    'synchronous': 'NORMAL',     # OFF would be faster, but the database could be corrupted on a power failure
+    'cache_size': -262144,       # 256 MiB, which holds the pages of the indexes being updated
+    'wal_autocheckpoint': 100000, # pages of WAL before a checkpoint (1000 by default)
+}
+
+# the pragmas which can't be changed in a transaction. They are left as they are in bulk_load called in one
+TRANSACTION_PRAGMAS = ('journal_mode', 'synchronous')
+
+_NAME = re.compile(r'^[a-z_]+$')
+_VALUE = re.compile(r'^-?\w+$')
+
+
+def get_sqlite_pragmas():
+    return getattr(settings, 'SQLITE_PRAGMAS', SQLITE_PRAGMA_DEFAULTS)
+
+
+def get_bulk_load_pragmas():
+    return getattr(settings, 'SQLITE_BULK_LOAD_PRAGMAS', SQLITE_BULK_LOAD_DEFAULTS)
+
+
+def _ordered(pragmas):
+    # the busy timeout comes first, since changing journal_mode waits for the other connections
+    return sorted(pragmas.items(), key=lambda item: (item[0] != 'busy_timeout', item[0]))
+
+
+def apply_pragmas(raw_connection, pragmas):
+    """
+    Run the PRAGMA statements on a DB-API connection of sqlite3 (not a Django connection, so they are not
+    timed as queries). Returns the values of the pragmas after running them.
+    """
+    values = {}
+    for name, value in _ordered(pragmas):
+        value = '{}'.format(value)
+        if not _NAME.match(name) or not _VALUE.match(value):
+            raise ImproperlyConfigured('Invalid SQLite pragma {}={}'.format(name, value))
+        row = raw_connection.execute('PRAGMA {} = {}'.format(name, value)).fetchone()
+        values[name] = row[0] if row else value
+    return values
+
+
+def read_pragmas(raw_connection, names):
+    """
+    Return the current values of the pragmas
+    """
+    values = {}
+    for name in names:
+        if not _NAME.match(name):
+            raise ImproperlyConfigured('Invalid SQLite pragma {}'.format(name))
+        row = raw_connection.execute('PRAGMA {}'.format(name)).fetchone()
+        values[name] = row[0] if row else None
+    return values
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    Signal receiver of connection_created, which applies SQLITE_PRAGMAS to new SQLite connections
+    """
+    if connection.vendor == 'sqlite':
+        apply_pragmas(connection.connection, get_sqlite_pragmas())
+
+
+@contextmanager
+def bulk_load(connection=None):
+    """
+    Apply SQLITE_BULK_LOAD_PRAGMAS to the connection in the block, and restore the previous values after it.
+    The WAL written in the block is checkpointed at the end. Other backends are left as they are.
+    """
+    connection = connection or default_connection
+    if connection.vendor != 'sqlite':
+        yield
+        return
+
+    connection.ensure_connection()
+    raw_connection = connection.connection
+    pragmas = dict(get_bulk_load_pragmas())
+    if connection.in_atomic_block:
+        for name in TRANSACTION_PRAGMAS:
+            pragmas.pop(name, None)
+    previous = read_pragmas(raw_connection, pragmas)
+    apply_pragmas(raw_connection, pragmas)
+    try:
+        yield
+    finally:
+        # the connection may have been closed (e.g. by close_old_connections) in the block
+        if connection.connection is raw_connection:
+            apply_pragmas(raw_connection, previous)
+            if not connection.in_atomic_block and read_pragmas(raw_connection, ['journal_mode'])['journal_mode'] == 'wal':
+                # a passive checkpoint doesn't wait for readers. The pages they still read are checkpointed later
+                raw_connection.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
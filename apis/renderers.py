@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime, decimal, struct
+
+from django.utils import six
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+class ExportRenderer(BaseRenderer):
+    """
+    The base class of the renderers which let content negotiation choose the formats of exports.
+    The exports are streamed by the views themselves, so these renderers only render errors (as JSON).
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return JSONRenderer().render(data, renderer_context=renderer_context)
+
+
+class CSVRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONRenderer(ExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class Columns(object):
+    """
+    Column-oriented data, which ColumnarRenderer writes without building a dict per row
+
+    Attributes
+    ----------
+    names : list
+        the names of the columns
+
+    columns : list
+        the lists of the values of each column
+
+    length : int
+        the number of rows
+    """
+
+    def __init__(self, names, columns, length):
+        self.names = list(names)
+        self.columns = [list(column) for column in columns]
+        self.length = length
+
+    def tolist(self):
+        """
+        Return the dict of the names and the values of the columns, as which JSONEncoder of DRF encodes the columns
+        """
+        return dict(zip(self.names, self.columns))
+
+    @classmethod
+    def from_tuples(cls, names, rows):
+        """
+        Return the columns of the rows given as tuples (e.g. by values_list). Extra values at the end of the rows are ignored
+        """
+        rows = list(rows)
+        columns = list(zip(*rows)) if rows else [[] for _ in names]
+        return cls(names, columns[:len(names)], len(rows))
+
+    @classmethod
+    def from_dicts(cls, rows):
+        """
+        Return the columns of the rows given as dicts, in the order of the keys of the first row
+        """
+        names = list(rows[0].keys()) if rows else []
+        return cls(names, [[row.get(name) for row in rows] for name in names], len(rows))
+
+
+class ColumnarRenderer(BaseRenderer):
+    """
+    Render a list of rows (or the 'results' of a page) as typed arrays per column.
+    All the numbers are little-endian, and every array starts at a multiple of 8 bytes
+    so that clients can view it as a typed array without copying.
+
+        'BBCF' 1 0 0 0                  magic and version (8 bytes)
+        uint32 length, JSON, padding    metadata (e.g. count, next and previous of pages, or errors)
+        uint32 rows, uint32 columns
+        for each column:
+            uint32 length, name (UTF-8), uint8 type, padding
+            int32[rows] (type 1), float64[rows] (type 2), or uint8[rows] (type 3), padding
+            or uint32[rows + 1] offsets, padding, UTF-8 strings, padding (type 4)
+
+    Missing integers and numbers are NaN in float64 columns, missing booleans are 255,
+    and dates and datetimes are ISO 8601 strings. Columns without any value are float64 NaN.
+    """
+    media_type = 'application/vnd.bluebikes.columnar'
+    format = 'columnar'
+    charset = None
+    render_style = 'binary'
+
+    MAGIC = b'BBCF\x01\x00\x00\x00'
+
+    INT32, FLOAT64, BOOL, STRING = 1, 2, 3, 4
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        metadata = {}
+        if isinstance(data, dict):
+            metadata = dict((key, value) for key, value in data.items() if key != 'results')
+            data = data.get('results', [])
+        if not isinstance(data, Columns):
+            data = Columns.from_dicts(list(data))
+
+        chunks = [self.MAGIC]
+        self._write_bytes(chunks, JSONRenderer().render(metadata))
+        self._pad(chunks)
+        chunks.append(struct.pack('<II', data.length, len(data.names)))
+        for name, values in zip(data.names, data.columns):
+            self._write_bytes(chunks, six.text_type(name).encode('utf-8'))
+            self._write_column(chunks, values)
+        return b''.join(chunks)
+
+    def _pad(self, chunks):
+        size = sum(len(chunk) for chunk in chunks)
+        chunks.append(b'\x00' * (-size % 8))
+
+    def _write_bytes(self, chunks, value):
+        chunks.append(struct.pack('<I', len(value)))
+        chunks.append(value)
+
+    def _write_column(self, chunks, values):
+        present = [value for value in values if value is not None]
+        if not present:
+            # the type of an empty or all missing column is unknown, and NaN is missing in any numeric view
+            chunks.append(struct.pack('<B', self.FLOAT64))
+            self._pad(chunks)
+            chunks.append(struct.pack('<{}d'.format(len(values)), *[float('nan')] * len(values)))
+        elif all(isinstance(v, six.integer_types) and not isinstance(v, bool) and -2 ** 31 <= v < 2 ** 31 for v in present) and len(present) == len(values):
+            chunks.append(struct.pack('<B', self.INT32))
+            self._pad(chunks)
+            chunks.append(struct.pack('<{}i'.format(len(values)), *values))
+        elif all(isinstance(v, bool) for v in present):
+            chunks.append(struct.pack('<B', self.BOOL))
+            self._pad(chunks)
+            chunks.append(struct.pack('<{}B'.format(len(values)), *[255 if v is None else int(v) for v in values]))
+        elif all(isinstance(v, (six.integer_types, float, decimal.Decimal)) and not isinstance(v, bool) for v in present):
+            chunks.append(struct.pack('<B', self.FLOAT64))
+            self._pad(chunks)
+            chunks.append(struct.pack('<{}d'.format(len(values)), *[float('nan') if v is None else float(v) for v in values]))
+        else:
+            chunks.append(struct.pack('<B', self.STRING))
+            self._pad(chunks)
+            strings = [self._string(v).encode('utf-8') for v in values]
+            offsets = [0]
+            for s in strings:
+                offsets.append(offsets[-1] + len(s))
+            chunks.append(struct.pack('<{}I'.format(len(offsets)), *offsets))
+            self._pad(chunks)
+            chunks.append(b''.join(strings))
+        self._pad(chunks)
+
+    def _string(self, value):
+        if value is None:
+            return ''
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        return six.text_type(value)
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.db import IntegrityError, connections, transaction
+from django.db.models import ExpressionWrapper, FloatField, Max, Min, Sum, Value
+from django.utils import timezone
+
+from .buckets import annotate_bucket, bucket_columns
+from .caching import ROLLUPS, TRIPS, get_data_version, set_data_version
+from .sketches import PERCENTILES, HyperLogLog, TDigest
+
+# the rollup models and their dimensions, from the smallest rollup to the largest one
+ROLLUP_DIMENSIONS = (
+    ('DailyTripRollup', ('start_date', 'gender', 'is_subscriber', 'birth_year')),
+    ('HourlyTripRollup', ('start_date', 'start_hour', 'start_station', 'gender', 'is_subscriber', 'birth_year')),
+)
+
+# the annotations to summarize rollups, keyed by the aggregation names of the summary
+ROLLUP_ANNOTATIONS = {
+    'count': lambda: Sum('count'),
+    'max': lambda: Max('duration_max'),
+    'min': lambda: Min('duration_min'),
+    'sum': lambda: Sum('duration_sum'),
+}
+
+# the field which rollups summarize other than count
+ROLLUP_FIELD = 'duration'
+
+# the aggregation names answered by merging the sketches of the rollups
+ROLLUP_SKETCHES = tuple(PERCENTILES) + ('distinct_bikes',)
+
+# the default of TRIP_ROLLUP_SKETCH_ROWS, the number of rollup rows whose sketches can be merged for a summary.
+# The sketches are merged in Python, so the summaries of more rows are left to the columnar store or the database
+ROLLUP_SKETCH_ROWS = 50000
+
+# the number of times to merge buckets when concurrent writers insert the same rollup rows
+MERGE_ATTEMPTS = 3
+
+# the number of rollup rows updated by one statement
+UPDATE_BATCH_SIZE = 100
+
+# the fields of trips read to rebuild the rollups
+REBUILD_FIELDS = ('start_time', 'start_date', 'start_station', 'gender', 'is_subscriber', 'birth_year', 'duration', 'bike_id')
+
+
+def rollups_enabled():
+    return getattr(settings, 'TRIP_ROLLUPS', True)
+
+
+def rollups_current():
+    """
+    Return whether the rollups summarize the current trips. The trips saved or deleted one by one
+    (e.g. by loaddata or the admin site) bump the version of trips without updating the rollups.
+    """
+    from .models import DataVersion
+
+    versions = dict(DataVersion.objects.filter(name__in=[TRIPS, ROLLUPS]).values_list('name', 'version'))
+    return versions.get(ROLLUPS, 0) == versions.get(TRIPS, 0)
+
+
+def keep_rollups_current():
+    """
+    Record that the rollups still summarize the trips, after bumping the version of trips in the transaction
+    which added the trips to the rollups. The rollups which were already stale are left stale.
+    """
+    version = get_data_version(TRIPS)[0]
+    if get_data_version(ROLLUPS)[0] == version - 1:
+        set_data_version(ROLLUPS, version)
+
+
+def sketch_rows_limit():
+    return getattr(settings, 'TRIP_ROLLUP_SKETCH_ROWS', ROLLUP_SKETCH_ROWS)
+
+
+def _columns(dimensions):
+    return [d + '_id' if d == 'start_station' else d for d in dimensions]
+
+
+def _trip_key(trip, dimensions):
+    key = []
+    for dimension in dimensions:
+        if dimension == 'start_hour':
+            key.append(timezone.localtime(trip.start_time).hour)
+        elif dimension == 'start_station':
+            key.append(trip.start_station_id)
+        else:
+            key.append(getattr(trip, dimension))
+    return tuple(key)
+
+
+def add_trips(trips, apps=django_apps):
+    """
+    Add trips to the rollups. This is called in the same transaction as the one writing the trips,
+    so that the rollups are always consistent with the Trip table.
+    """
+    for model_name, dimensions in ROLLUP_DIMENSIONS:
+        model = apps.get_model('apis', model_name)
+        # the rollups of the migrations before the sketches have no columns for them
+        sketches = any(f.name == 'duration_digest' for f in model._meta.get_fields())
+
+        buckets = {}
+        for trip in trips:
+            key = _trip_key(trip, dimensions)
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [1, trip.duration, trip.duration, trip.duration, None, None]
+                if sketches:
+                    bucket[4], bucket[5] = TDigest(), HyperLogLog()
+            else:
+                bucket[0] += 1
+                bucket[1] += trip.duration
+                bucket[2] = min(bucket[2], trip.duration)
+                bucket[3] = max(bucket[3], trip.duration)
+            if sketches:
+                bucket[4].add(trip.duration)
+                bucket[5].add(trip.bike_id)
+
+        _merge_buckets(model, dimensions, buckets, sketches)
+
+
+def _merge_buckets(model, dimensions, buckets, sketches=True):
+    """
+    Update the existing rollup rows with the buckets of new trips, and insert the other buckets.
+    The existing rows are locked until the end of the transaction, so concurrent writers don't lose
+    their updates. When another writer inserts some of the new rows first, the buckets are merged again
+    into them.
+    """
+    if not buckets:
+        return
+
+    for attempt in range(MERGE_ATTEMPTS):
+        try:
+            # the savepoint keeps the transaction usable after the conflict on PostgreSQL
+            with transaction.atomic():
+                _merge_buckets_once(model, dimensions, buckets, sketches)
+            return
+        except IntegrityError:
+            if attempt == MERGE_ATTEMPTS - 1:
+                raise
+
+
+def _merge_buckets_once(model, dimensions, buckets, sketches):
+    columns = _columns(dimensions)
+    fields = ['count', 'duration_sum', 'duration_min', 'duration_max']
+    if sketches:
+        fields += ['duration_digest', 'bike_sketch']
+
+    # trips are imported in the order of time, so only a few rows of the same dates (and hours) can exist.
+    # The rows are locked in the order of their ids, so that concurrent writers don't deadlock
+    lookups = {'start_date__in': set(key[0] for key in buckets)}
+    if 'start_hour' in dimensions:
+        index = dimensions.index('start_hour')
+        lookups['start_hour__in'] = set(key[index] for key in buckets)
+    rows = model.objects.select_for_update().filter(**lookups).order_by('pk')
+    existing = dict((tuple(getattr(row, c) for c in columns), row) for row in rows)
+
+    new_rows = []
+    updated_rows = []
+    for key, (count, duration_sum, duration_min, duration_max, digest, bikes) in buckets.items():
+        row = existing.get(key)
+        if row is None:
+            row = model(count=count, duration_sum=duration_sum, duration_min=duration_min, duration_max=duration_max, **dict(zip(columns, key)))
+            if sketches:
+                row.duration_digest, row.bike_sketch = digest.to_bytes(), bikes.to_bytes()
+            new_rows.append(row)
+        else:
+            row.count += count
+            row.duration_sum += duration_sum
+            row.duration_min = min(row.duration_min, duration_min)
+            row.duration_max = max(row.duration_max, duration_max)
+            if sketches and row.duration_digest is not None and row.bike_sketch is not None:
+                row.duration_digest = TDigest.from_bytes(row.duration_digest).merge(digest).to_bytes()
+                row.bike_sketch = HyperLogLog.from_bytes(row.bike_sketch).merge(bikes).to_bytes()
+            updated_rows.append(row)
+
+    _update_rows(model, updated_rows, fields)
+    model.objects.bulk_create(new_rows)
+
+
+def _update_rows(model, rows, fields):
+    """
+    Write the fields of the rows by their ids with an UPDATE ... FROM (VALUES ...) statement per UPDATE_BATCH_SIZE rows.
+    The rows are saved one by one on the backends without UPDATE ... FROM (e.g. SQLite before 3.33).
+    """
+    connection = connections[model.objects.db]
+    if not (connection.vendor == 'postgresql' or (connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 33))):
+        for row in rows:
+            row.save(update_fields=fields)
+        return
+
+    qn = connection.ops.quote_name
+    table = qn(model._meta.db_table)
+    model_fields = [model._meta.get_field(name) for name in fields]
+    # the columns of VALUES are named column1, column2, ... on both backends. They are cast since a column of NULLs has no type
+    assignments = ', '.join('{} = CAST(v.column{} AS {})'.format(qn(f.column), i + 2, f.db_type(connection)) for i, f in enumerate(model_fields))
+    for start in range(0, len(rows), UPDATE_BATCH_SIZE):
+        chunk = rows[start:start + UPDATE_BATCH_SIZE]
+        values = ', '.join(['(' + ', '.join(['%s'] * (len(model_fields) + 1)) + ')'] * len(chunk))
+        params = []
+        for row in chunk:
+            params.append(row.pk)
+            params.extend(f.get_db_prep_save(getattr(row, f.attname), connection) for f in model_fields)
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE {0} SET {1} FROM (VALUES {2}) AS v WHERE {0}.{3} = v.column1'.format(
+                table, assignments, values, qn(model._meta.pk.column)), params)
+
+
+def rebuild_rollups(apps=django_apps):
+    """
+    Rebuild the rollups from the Trip table, and record the version of trips they summarize.
+    Trips are read date by date, since the sketches of the buckets are built in Python as the importer does.
+    """
+    Trip = apps.get_model('apis', 'Trip')
+
+    for model_name, dimensions in ROLLUP_DIMENSIONS:
+        apps.get_model('apis', model_name).objects.all().delete()
+
+    dates = list(Trip.objects.order_by('start_date').values_list('start_date', flat=True).distinct())
+    for date in dates:
+        add_trips(list(Trip.objects.filter(start_date=date).only(*REBUILD_FIELDS).iterator()), apps)
+    set_data_version(ROLLUPS, get_data_version(TRIPS)[0])
+
+
+def summarize(request, filter_class, group_by, aggs, field, having=(), order_by=(), top=None):
+    """
+    Return the summary of trips computed from the smallest rollup which covers the grouping fields,
+    the aggregations and the filters of the request. Return None when no rollup covers them,
+    or when the rollups are older than the trips.
+
+    Parameters
+    ----------
+    request : Request
+        the request whose query parameters are given to the filter class
+
+    filter_class : FilterSet
+        the filter class of trips. Its filters are applied to the rollup as they are
+
+    group_by : list
+        the fields or the time buckets to be grouped
+
+    aggs : list
+        the aggregation names
+
+    field : str
+        the field to be aggregated
+
+    having : list
+        the conditions on the aggregated values as (name, lookup, value)
+
+    order_by : list
+        the grouped fields or the names of the aggregated values, with '-' for descending order
+
+    top : int
+        the number of the summaries to be returned
+    """
+    if not rollups_enabled():
+        return None
+
+    query_params = request.query_params
+    if query_params.get('ordering'):
+        return None
+
+    if any(agg not in ROLLUP_ANNOTATIONS and agg not in ROLLUP_SKETCHES and agg != 'avg' for agg in aggs):
+        return None
+    if any(agg not in ('count', 'distinct_bikes') for agg in aggs) and field != ROLLUP_FIELD:
+        return None
+    # the merged sketches can't be filtered nor ordered in the database
+    if any(name in ROLLUP_SKETCHES for name, lookup, value in having) or any(name.lstrip('-') in ROLLUP_SKETCHES for name in order_by):
+        return None
+
+    # the fields filtered by the request. Empty values are ignored by the filters
+    filtered = set(f.field_name for name, f in filter_class.base_filters.items() if query_params.get(name) not in (None, ''))
+    columns = set(column for name in group_by for column in bucket_columns(name))
+
+    for model_name, dimensions in ROLLUP_DIMENSIONS:
+        if columns.issubset(dimensions) and filtered.issubset(dimensions):
+            model = django_apps.get_model('apis', model_name)
+            if rollups_current() and model.objects.exists():
+                return _summarize(model, filter_class, request, group_by, aggs, field, having, order_by, top)
+
+    return None
+
+
+def _summarize(model, filter_class, request, group_by, aggs, field, having, order_by, top):
+    # the annotations are aliased since 'count' is also a column of the rollups.
+    # rollup_count also groups the rows when only the sketches are requested
+    annotations = {'rollup_count': Sum('count')}
+    aliases = {}
+    for agg in aggs:
+        if agg in ROLLUP_SKETCHES:
+            continue
+        elif agg == 'count':
+            name = 'count'
+        else:
+            name = agg + '_' + field
+
+        if agg == 'avg':
+            annotations['rollup_count'] = Sum('count')
+            annotations['rollup_sum'] = Sum('duration_sum')
+            # only for having and order_by. The averages returned are computed from the sums and the counts
+            annotations['rollup_avg'] = ExpressionWrapper(Sum('duration_sum') * Value(1.0) / Sum('count'), output_field=FloatField())
+        else:
+            annotations['rollup_' + agg] = ROLLUP_ANNOTATIONS[agg]()
+        aliases[name] = 'rollup_' + agg
+
+    queryset = filter_class(request.query_params, queryset=model.objects.all(), request=request).qs
+    for name in group_by:
+        queryset = annotate_bucket(queryset, name)
+    rows = queryset.values(*group_by).annotate(**annotations)
+
+    for name, lookup, value in having:
+        rows = rows.filter(**{aliases[name] + '__' + lookup: value})
+    ordering = []
+    for name in order_by or group_by:
+        prefix = '-' if name.startswith('-') else ''
+        ordering.append(prefix + aliases.get(name.lstrip('-'), name.lstrip('-')))
+    rows = rows.order_by(*ordering)
+    if top is not None:
+        rows = rows[:top]
+
+    results = []
+    for row in rows.iterator():
+        result = dict((name, row[name]) for name in group_by)
+        for agg in aggs:
+            if agg in ROLLUP_SKETCHES:
+                continue
+            elif agg == 'count':
+                result['count'] = row['rollup_count']
+            elif agg == 'avg':
+                result['avg_' + field] = float(row['rollup_sum']) / row['rollup_count']
+            else:
+                result[agg + '_' + field] = row['rollup_' + agg]
+        results.append(result)
+
+    if any(agg in ROLLUP_SKETCHES for agg in aggs):
+        sketches = _merge_sketches(queryset, group_by, aggs, set(tuple(r[name] for name in group_by) for r in results))
+        if sketches is None:
+            return None
+        for result in results:
+            digest, bikes = sketches[tuple(result[name] for name in group_by)]
+            for agg in aggs:
+                if agg in PERCENTILES:
+                    result[agg + '_' + field] = digest.quantile(PERCENTILES[agg])
+                elif agg == 'distinct_bikes':
+                    result['distinct_bikes'] = bikes.cardinality()
+    return results
+
+
+def _merge_sketches(queryset, group_by, aggs, keys):
+    """
+    Return the groups -> (TDigest, HyperLogLog) merged from the sketches of the rollup rows of the groups,
+    or None if some rows have no sketches or the rows are more than TRIP_ROLLUP_SKETCH_ROWS
+    """
+    percentiles = any(agg in PERCENTILES for agg in aggs)
+    distinct = 'distinct_bikes' in aggs
+    columns = (['duration_digest'] if percentiles else []) + (['bike_sketch'] if distinct else [])
+
+    limit = sketch_rows_limit()
+    # the rows are counted in the database up to the limit before any sketch is merged
+    if limit is not None and queryset.order_by()[limit:limit + 1].exists():
+        return None
+
+    sketches = dict((key, (TDigest(), HyperLogLog())) for key in keys)
+    for row in queryset.values_list(*(group_by + columns)).order_by().iterator():
+        key = row[:len(group_by)]
+        if key not in sketches:
+            continue
+        values = list(row[len(group_by):])
+        if any(value is None for value in values):
+            return None
+        digest, bikes = sketches[key]
+        if percentiles:
+            digest.merge(TDigest.from_bytes(values.pop(0)))
+        if distinct:
+            bikes.merge(HyperLogLog.from_bytes(values.pop(0)))
+    return sketches
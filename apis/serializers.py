@@ -1,20 +1,23 @@
 from rest_framework import serializers
 from drf_dynamic_fields import DynamicFieldsMixin
+from .instrumentation import TimedListSerializer, TimedSerializerMixin
 from .models import Station, Trip
 
-class StationSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+class StationSerializer(TimedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
     region = serializers.StringRelatedField(many=False)
 
     class Meta:
         model = Station
+        list_serializer_class = TimedListSerializer
         fields = ('station_id', 'short_name', 'name', 'lat', 'lon', 'region', 'capacity', 'electric_bike_surcharge_waiver', 'eightd_has_key_dispenser', 'has_kiosk')
 
 
-class TripSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+class TripSerializer(TimedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
     start_station = StationSerializer(many=False)
     stop_station = StationSerializer(many=False)
 
     class Meta:
         model = Trip
+        list_serializer_class = TimedListSerializer
         fields = '__all__' 
 
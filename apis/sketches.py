@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable sketches stored in the rollups of trips.
+
+TDigest estimates the percentiles of durations and HyperLogLog estimates the number of distinct bikes.
+Both are built per rollup bucket when trips are imported, and the sketches of the buckets are merged
+when a summary is requested, so the percentiles and the distinct counts of any group of buckets cost
+about the same as their counts.
+"""
+from __future__ import unicode_literals
+
+import bisect, math, struct
+
+MASK64 = (1 << 64) - 1
+
+# the aggregation names of the percentiles -> the quantiles
+PERCENTILES = {
+    'p50': 0.5,
+    'p95': 0.95,
+    'p99': 0.99,
+}
+
+
+def percentile(values, q):
+    """
+    Return the exact percentile of the sorted values, interpolated linearly between the closest ranks
+    """
+    if not values:
+        return None
+    position = q * (len(values) - 1)
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+class TDigest(object):
+    """
+    Merging t-digest (Dunning and Ertl), which keeps the tails of the distribution in small centroids
+
+    Attributes
+    ----------
+    compression : int
+        the parameter bounding the number of centroids (about compression / 2 after compression)
+
+    centroids : list
+        (mean, weight) sorted by means
+
+    min, max : float
+        the minimum and the maximum values
+    """
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.centroids = []
+        self.min = None
+        self.max = None
+        self._buffer = []
+
+    @property
+    def count(self):
+        self._compress()
+        return sum(weight for mean, weight in self.centroids)
+
+    def add(self, value, weight=1):
+        self._buffer.append((value, weight))
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self._buffer) >= 10 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        other._compress()
+        self._buffer.extend(other.centroids)
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        if len(self._buffer) >= 10 * self.compression:
+            self._compress()
+        return self
+
+    def _k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _q(self, k):
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        items = sorted(self.centroids + self._buffer)
+        self._buffer = []
+        total = float(sum(weight for mean, weight in items))
+
+        centroids = []
+        mean, weight = items[0]
+        cumulative = 0
+        limit = self._q(self._k(0) + 1) * total
+        for next_mean, next_weight in items[1:]:
+            if cumulative + weight + next_weight <= limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / float(weight)
+            else:
+                centroids.append((mean, weight))
+                cumulative += weight
+                limit = self._q(self._k(cumulative / total) + 1) * total
+                mean, weight = next_mean, next_weight
+        centroids.append((mean, weight))
+        self.centroids = centroids
+
+    def quantile(self, q):
+        """
+        Return the estimated value at the quantile q (0 - 1)
+        """
+        self._compress()
+        if not self.centroids:
+            return None
+
+        total = float(sum(weight for mean, weight in self.centroids))
+        index = q * total
+        # the centers of the centroids in the cumulative weights
+        centers = []
+        cumulative = 0
+        for mean, weight in self.centroids:
+            centers.append(cumulative + weight / 2.0)
+            cumulative += weight
+
+        if index <= centers[0]:
+            first = self.centroids[0][0]
+            return self.min + (first - self.min) * (index / centers[0]) if centers[0] > 0.5 else first
+        if index >= centers[-1]:
+            last = self.centroids[-1][0]
+            return last + (self.max - last) * ((index - centers[-1]) / (total - centers[-1])) if total - centers[-1] > 0.5 else last
+
+        i = bisect.bisect_right(centers, index) - 1
+        (left, _), (right, _) = self.centroids[i], self.centroids[i + 1]
+        return left + (right - left) * (index - centers[i]) / (centers[i + 1] - centers[i])
+
+    def to_bytes(self):
+        """
+        Serialize the digest as min, max, the number of centroids, and their means and weights (little-endian float64)
+        """
+        self._compress()
+        n = len(self.centroids)
+        values = [mean for mean, weight in self.centroids] + [weight for mean, weight in self.centroids]
+        return struct.pack('<ddI{}d'.format(2 * n), self.min or 0, self.max or 0, n, *values)
+
+    @classmethod
+    def from_bytes(cls, data, compression=100):
+        data = bytes(data)
+        digest = cls(compression)
+        min_value, max_value, n = struct.unpack_from('<ddI', data)
+        values = struct.unpack_from('<{}d'.format(2 * n), data, struct.calcsize('<ddI'))
+        digest.centroids = list(zip(values[:n], values[n:]))
+        if n:
+            digest.min, digest.max = min_value, max_value
+        return digest
+
+
+def _hash64(value):
+    # splitmix64 of integers, which spreads consecutive ids over the registers
+    z = (value + 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+class HyperLogLog(object):
+    """
+    HyperLogLog of integers (e.g. bike ids) with 2 ** precision registers. The standard error is
+    1.04 / sqrt(2 ** precision), about 1.6% for the default precision, and small sets are counted
+    almost exactly by linear counting. Registers are kept sparse while few of them are set.
+
+    Attributes
+    ----------
+    precision : int
+        the number of the bits of hashes choosing registers
+
+    registers : dict
+        the index of the register -> the position of the first 1 bit of the hashes
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = {}
+
+    def add(self, value):
+        h = _hash64(value)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers.get(index, 0):
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for index, rank in other.registers.items():
+            if rank > self.registers.get(index, 0):
+                self.registers[index] = rank
+        return self
+
+    def cardinality(self):
+        m = 1 << self.precision
+        zeros = m - len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / (sum(2.0 ** -rank for rank in self.registers.values()) + zeros)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting for small cardinalities
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        """
+        Serialize the registers as (index uint16, rank uint8) pairs while they are sparse, or as the dense array of ranks
+        """
+        m = 1 << self.precision
+        if len(self.registers) * 3 < m:
+            items = sorted(self.registers.items())
+            return b'S' + struct.pack('<B', self.precision) + b''.join(struct.pack('<HB', index, rank) for index, rank in items)
+        return b'D' + struct.pack('<B', self.precision) + bytes(bytearray(self.registers.get(i, 0) for i in range(m)))
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        sketch = cls(bytearray(data[1:2])[0])
+        if data[:1] == b'S':
+            for offset in range(2, len(data), 3):
+                index, rank = struct.unpack_from('<HB', data, offset)
+                sketch.registers[index] = rank
+        else:
+            sketch.registers = dict((i, rank) for i, rank in enumerate(bytearray(data[2:])) if rank)
+        return sketch
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Slow-query log.
+
+The cursors timing the queries (see instrumentation.py) pass every query taking longer than
+SLOW_QUERY_LOG['THRESHOLD_MS'] to log_slow_query, which appends a JSON line to the log file with
+the view of the request running it, the normalized SQL and its fingerprint, the bound parameters and,
+with SLOW_QUERY_LOG['EXPLAIN'], the plan of the query explained right after it ran (EXPLAIN QUERY PLAN on
+SQLite, EXPLAIN on the others). The EXPLAIN runs in the request which ran the slow query and delays it,
+so it is off by default and meant for development.
+
+The fingerprint is the same for the queries differing only in their literals and parameters, so
+summarize_slow_queries aggregates the entries by the shapes of the queries, and
+`python manage.py slow_queries` reports the shapes taking the longest time in total.
+"""
+from __future__ import unicode_literals
+
+import hashlib, io, json, re, threading
+
+from django.conf import settings
+from django.utils import six, timezone
+
+# default settings of the log. They can be overwritten by SLOW_QUERY_LOG in settings.py
+SLOW_QUERY_DEFAULTS = {
+    'ENABLED': True,
+    'THRESHOLD_MS': 500,
+    'PATH': 'slow_queries.log', # the file the entries are appended to
+    'EXPLAIN': False,           # whether the plans of the queries are logged, explained in the request
+}
+
+# the maximum number of parameters logged for a query (e.g. of long IN lists)
+MAX_PARAMS = 50
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+# the name of the savepoint explaining queries in transactions
+EXPLAIN_SAVEPOINT = 'slow_query_explain'
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER = re.compile(r'%s|\?')
+_IN_LIST = re.compile(r'\(\?(?:, \?)+\)')
+_SPACES = re.compile(r'\s+')
+
+_lock = threading.Lock()
+
+
+def get_slow_query_setting(name):
+    """
+    Return a setting of the slow-query log, falling back to SLOW_QUERY_DEFAULTS
+    """
+    return getattr(settings, 'SLOW_QUERY_LOG', {}).get(name, SLOW_QUERY_DEFAULTS[name])
+
+
+def slow_query_threshold():
+    """
+    Return the threshold of slow queries in seconds, or None when the log is disabled
+    """
+    if not get_slow_query_setting('ENABLED'):
+        return None
+    return get_slow_query_setting('THRESHOLD_MS') / 1000.0
+
+
+def normalize_sql(sql):
+    """
+    Return the SQL whose literals and placeholders are replaced with '?' and whose lists of them are
+    collapsed, so the queries of the same shape are normalized to the same SQL
+    """
+    sql = _SPACES.sub(' ', sql).strip()
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _PLACEHOLDER.sub('?', sql)
+    return _IN_LIST.sub('(...)', sql)
+
+
+def fingerprint(normalized_sql):
+    return hashlib.sha1(normalized_sql.encode('utf-8')).hexdigest()[:16]
+
+
+def _loggable(value):
+    if value is None or isinstance(value, (bool, float, six.text_type) + six.integer_types):
+        return value
+    if isinstance(value, (six.binary_type, bytearray, memoryview)) or type(value).__name__ == 'buffer':
+        return '<{} bytes>'.format(len(value))
+    return six.text_type(value)
+
+
+def _loggable_params(params):
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return dict((six.text_type(key), _loggable(value)) for key, value in params.items())
+    return [_loggable(value) for value in list(params)[:MAX_PARAMS]]
+
+
+def explain(connection, sql, params):
+    """
+    Return the lines of the plan of the query, or None if it can't be explained
+    """
+    words = sql.split(None, 1)
+    if not words or words[0].upper() not in ('SELECT', 'WITH'):
+        return None
+    # in a transaction, a failing EXPLAIN would abort it on PostgreSQL, so it's run in a savepoint.
+    # The savepoint is made by the same cursor, which isn't timed, so that it isn't logged either
+    savepoint = connection.features.uses_savepoints and connection.in_atomic_block
+    cursor = connection.create_cursor() # not timed, so the EXPLAIN isn't logged itself
+    try:
+        if savepoint:
+            cursor.execute(connection.ops.savepoint_create_sql(EXPLAIN_SAVEPOINT))
+        try:
+            cursor.execute(EXPLAIN_PREFIXES.get(connection.vendor, 'EXPLAIN ') + sql, params)
+            rows = cursor.fetchall()
+        except Exception: # the plan is only for information
+            if savepoint:
+                cursor.execute(connection.ops.savepoint_rollback_sql(EXPLAIN_SAVEPOINT))
+            return None
+        finally:
+            if savepoint:
+                cursor.execute(connection.ops.savepoint_commit_sql(EXPLAIN_SAVEPOINT))
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+    if connection.vendor == 'sqlite':
+        # (id, parent, notused, detail)
+        return [six.text_type(row[-1]) for row in rows]
+    return [' '.join(six.text_type(column) for column in row) for row in rows]
+
+
+def log_slow_query(connection, sql, params, elapsed, view=None, many=False):
+    """
+    Append the entry of a slow query to the log
+
+    Parameters
+    ----------
+    connection : DatabaseWrapper
+        the connection which ran the query
+
+    sql : str
+        the SQL with placeholders
+
+    params : list or dict
+        the parameters of the query (of the first row for executemany)
+
+    elapsed : float
+        the time of the query in seconds
+
+    view : str
+        the name of the view of the request running the query, or None out of requests
+
+    many : bool
+        whether the query was run by executemany, which is not explained
+    """
+    normalized = normalize_sql(sql)
+    entry = {
+        'time': timezone.now().isoformat(),
+        'fingerprint': fingerprint(normalized),
+        'sql': normalized,
+        'params': _loggable_params(params),
+        'duration_ms': round(elapsed * 1000, 3),
+        'view': view,
+        'vendor': connection.vendor,
+        'plan': explain(connection, sql, params) if get_slow_query_setting('EXPLAIN') and not many else None,
+    }
+    line = json.dumps(entry, sort_keys=True)
+    with _lock:
+        with io.open(get_slow_query_setting('PATH'), 'a', encoding='utf-8') as f:
+            f.write(six.text_type(line) + '\n')
+    return entry
+
+
+def read_slow_queries(path=None):
+    """
+    Return the entries of the log. Broken lines (e.g. of a process killed while writing) are skipped
+    """
+    entries = []
+    with io.open(path or get_slow_query_setting('PATH'), encoding='utf-8') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+def summarize_slow_queries(entries):
+    """
+    Aggregate the entries by their fingerprints. Returns the shapes of the queries ordered by the total time,
+    each with the parameters and the plan of its slowest query
+    """
+    shapes = {}
+    for entry in entries:
+        shape = shapes.get(entry['fingerprint'])
+        if shape is None:
+            shape = shapes[entry['fingerprint']] = {
+                'fingerprint': entry['fingerprint'],
+                'sql': entry['sql'],
+                'count': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'views': set(),
+                'last_seen': entry['time'],
+            }
+        shape['count'] += 1
+        shape['total_ms'] += entry['duration_ms']
+        shape['last_seen'] = max(shape['last_seen'], entry['time'])
+        if entry.get('view'):
+            shape['views'].add(entry['view'])
+        if entry['duration_ms'] >= shape['max_ms']:
+            shape['max_ms'] = entry['duration_ms']
+            shape['params'] = entry.get('params')
+            shape['plan'] = entry.get('plan')
+
+    results = sorted(shapes.values(), key=lambda shape: (-shape['total_ms'], shape['fingerprint']))
+    for shape in results:
+        shape['total_ms'] = round(shape['total_ms'], 3)
+        shape['mean_ms'] = round(shape['total_ms'] / shape['count'], 3)
+        shape['views'] = sorted(shape['views'])
+    return results
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+In-process spatial index of stations for the bounding box and nearby queries of /apis/stations/.
+
+Stations are put into a grid of fixed-size cells of latitude and longitude. A bounding box only visits
+the cells overlapping it, and a nearby query visits the cells ring by ring around the point until no station
+in the farther rings can be closer than the ones found. The rings are clamped to the rows and the columns
+of the occupied cells, so the empty rings between a far point and the stations are skipped at once. The index is rebuilt when the version of
+stations changes, which is bumped whenever a station is saved or deleted.
+"""
+from __future__ import unicode_literals
+
+import heapq, math, threading
+
+from django.db.models import Case, IntegerField, When
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+from .caching import STATIONS, get_data_version
+
+EARTH_RADIUS = 6371008.8 # meters
+
+# the size of cells in degrees, about 1.1km x 0.8km in Boston
+CELL_SIZE = 0.01
+
+# the maximum number of stations found by a query. Their ids are given to SQL as parameters
+MAX_RESULTS = 500
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Return the great-circle distance in meters between two points
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi, dlambda = phi2 - phi1, math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GridIndex(object):
+    """
+    The grid index of points
+
+    Attributes
+    ----------
+    cell_size : float
+        the size of cells in degrees
+
+    cells : dict
+        (row, column) of cells -> list of (id, lat, lon)
+
+    bounds : tuple
+        (min row, min column, max row, max column) of the occupied cells, or None without points
+
+    max_lat : float
+        the largest absolute latitude of the occupied cells
+    """
+
+    def __init__(self, points, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.size = 0
+        for pk, lat, lon in points:
+            self.cells.setdefault(self._cell(lat, lon), []).append((pk, lat, lon))
+            self.size += 1
+
+        self.bounds = None
+        self.max_lat = 0.0
+        if self.cells:
+            rows = [row for row, col in self.cells]
+            cols = [col for row, col in self.cells]
+            self.bounds = (min(rows), min(cols), max(rows), max(cols))
+            self.max_lat = max(abs(min(rows)), abs(max(rows) + 1)) * cell_size
+
+    def _cell(self, lat, lon):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """
+        Return the ids of the points in the bounding box
+        """
+        (min_row, min_col), (max_row, max_col) = self._cell(min_lat, min_lon), self._cell(max_lat, max_lon)
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cells):
+            # the box is larger than the area of the points
+            cells = [points for (row, col), points in self.cells.items() if min_row <= row <= max_row and min_col <= col <= max_col]
+        else:
+            cells = [self.cells.get((row, col), ()) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+        return [pk for points in cells for pk, lat, lon in points if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon]
+
+    def nearest(self, lat, lon, k=None, radius=None):
+        """
+        Return (id, distance) of the k nearest points (within the radius in meters), ordered by distance
+        """
+        k = min(k or self.size, self.size)
+        if not k:
+            return []
+
+        center_row, center_col = self._cell(lat, lon)
+        min_row, min_col, max_row, max_col = self.bounds
+        # the rings from the first one reaching the occupied cells to the last one covering them
+        first = max(min_row - center_row, center_row - max_row, min_col - center_col, center_col - max_col, 0)
+        last = max(center_row - min_row, max_row - center_row, center_col - min_col, max_col - center_col)
+        # the shortest distance between a point and the cells r rings away is longer than (r - 1) cell heights and widths
+        max_lat = max(abs(lat), self.max_lat)
+        cell_meters = self.cell_size * math.radians(EARTH_RADIUS) * min(1.0, math.cos(math.radians(min(max_lat, 89.9))))
+
+        found = [] # heap of (-distance, id) of the k nearest points found so far
+        for ring in range(first, last + 1):
+            bound = (ring - 1) * cell_meters
+            if (radius is not None and bound > radius) or (len(found) == k and bound > -found[0][0]):
+                break
+
+            for points in self._ring_cells(center_row, center_col, ring):
+                for pk, plat, plon in points:
+                    d = distance(lat, lon, plat, plon)
+                    if radius is not None and d > radius:
+                        continue
+                    if len(found) < k:
+                        heapq.heappush(found, (-d, pk))
+                    elif d < -found[0][0]:
+                        heapq.heapreplace(found, (-d, pk))
+
+        return [(pk, -d) for d, pk in sorted(found, reverse=True)]
+
+    def _ring_cells(self, center_row, center_col, ring):
+        """
+        Yield the points of the occupied cells in the ring around the center cell, within the bounds of the grid
+        """
+        min_row, min_col, max_row, max_col = self.bounds
+        first_col, last_col = max(center_col - ring, min_col), min(center_col + ring, max_col)
+        for row in range(max(center_row - ring, min_row), min(center_row + ring, max_row) + 1):
+            if abs(row - center_row) == ring:
+                cols = range(first_col, last_col + 1)
+            else:
+                # only the left and right sides of the ring
+                cols = [col for col in set([center_col - ring, center_col + ring]) if first_col <= col <= last_col]
+            for col in cols:
+                points = self.cells.get((row, col))
+                if points:
+                    yield points
+
+
+_index = None # (version, GridIndex) of stations
+_lock = threading.Lock()
+
+
+def get_station_index():
+    """
+    Return the grid index of stations, building it again when stations have changed
+    """
+    global _index
+    from .models import Station
+
+    version = get_data_version(STATIONS)
+    with _lock:
+        if _index is None or _index[0] != version:
+            _index = (version, GridIndex(Station.objects.values_list('station_id', 'lat', 'lon')))
+        return _index[1]
+
+
+def _parse_floats(request, name, count):
+    value = request.query_params.get(name)
+    try:
+        values = [float(v) for v in value.split(',')]
+    except ValueError:
+        values = []
+    if len(values) != count or any(math.isnan(v) or math.isinf(v) for v in values):
+        raise ValidationError({name: 'Specify {} numbers separated by comma (,).'.format(count)})
+    return values
+
+
+def parse_positive(request, name, type_):
+    """
+    Return the positive number of the query parameter, or None if it isn't given
+
+    Raises
+    ----------
+    ValidationError
+        if the value is not a positive number
+    """
+    value = request.query_params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        value = type_(value)
+    except ValueError:
+        value = 0
+    if not value > 0:
+        raise ValidationError({name: 'Specify a positive number.'})
+    return value
+
+
+class StationSpatialFilter(BaseFilterBackend):
+    """
+    Filter backend for the locations of stations
+
+    bbox=minLon,minLat,maxLon,maxLat
+        the stations in the bounding box
+
+    near=lat,lon, radius=meters, k=number
+        the stations within the radius from the point and/or the k nearest ones, ordered by distance.
+        Either radius or k is required
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        query_params = request.query_params
+        index = None
+
+        if query_params.get('bbox'):
+            min_lon, min_lat, max_lon, max_lat = _parse_floats(request, 'bbox', 4)
+            index = get_station_index()
+            ids = index.bbox(min_lon, min_lat, max_lon, max_lat)
+            if len(ids) > MAX_RESULTS:
+                # too many parameters for SQL, while the range is as selective as the ids
+                queryset = queryset.filter(lat__range=(min_lat, max_lat), lon__range=(min_lon, max_lon))
+            else:
+                queryset = queryset.filter(pk__in=ids)
+
+        if query_params.get('near'):
+            lat, lon = _parse_floats(request, 'near', 2)
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise ValidationError({'near': 'Specify a latitude between -90 and 90 and a longitude between -180 and 180.'})
+            radius = parse_positive(request, 'radius', float)
+            k = parse_positive(request, 'k', int)
+            if radius is None and k is None:
+                raise ValidationError({'near': 'Specify radius or k with near.'})
+
+            index = index or get_station_index()
+            nearest = index.nearest(lat, lon, k=min(k or MAX_RESULTS, MAX_RESULTS), radius=radius)
+            ids = [pk for pk, d in nearest]
+            queryset = queryset.filter(pk__in=ids).annotate(
+                distance_rank=Case(*[When(pk=pk, then=rank) for rank, pk in enumerate(ids)], output_field=IntegerField())
+            ).order_by('distance_rank') if ids else queryset.none()
+
+        return queryset
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic trip history data for load tests and benchmarks.
+
+The trips are written as monthly files in the layout of the trip history data published by Bluebikes
+(the 15 columns read by the importer), and the stations and the regions as the GBFS feeds
+(station_information.json and system_regions.json). Every value is drawn from a random generator
+seeded by the seed, so the same arguments always write the same files.
+
+The distributions follow the shape of the real data: more trips in summer and on weekdays, commute
+peaks at 8:00 and 17:30 on weekdays, log-normal durations, a few stations taking most of the trips,
+and trips mostly ending at stations near the start.
+"""
+from __future__ import unicode_literals
+
+import bisect, calendar, csv, datetime, gzip, io, json, math, os, random
+
+from django.utils import six
+
+# the ids of synthetic stations and regions start from these, so they don't collide with the real ones
+STATION_ID_BASE = 500000
+
+# (region id, name, latitude and longitude of the center, the share of stations)
+REGIONS = (
+    (901, 'Boston', 42.355, -71.065, 0.55),
+    (902, 'Cambridge', 42.373, -71.110, 0.25),
+    (903, 'Somerville', 42.390, -71.100, 0.12),
+    (904, 'Brookline', 42.335, -71.125, 0.08),
+)
+
+HEADER = ('tripduration', 'starttime', 'stoptime', 'start station id', 'start station name', 'start station latitude', 'start station longitude',
+          'end station id', 'end station name', 'end station latitude', 'end station longitude', 'bikeid', 'usertype', 'birth year', 'gender')
+
+# the number of the nearest stations where most trips end
+NEAR_STATIONS = 15
+
+
+def _weighted_index(generator, cumulative):
+    return bisect.bisect_right(cumulative, generator.random() * cumulative[-1])
+
+
+def _cumulative(weights):
+    total, cumulative = 0.0, []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return cumulative
+
+
+def generate_stations(count, generator):
+    """
+    Return the GBFS records of the stations and the weights of their popularity
+    """
+    cumulative = _cumulative([share for region_id, name, lat, lon, share in REGIONS])
+    stations, weights = [], []
+    for i in range(count):
+        region_id, region, lat, lon, share = REGIONS[_weighted_index(generator, cumulative)]
+        stations.append({
+            'station_id': STATION_ID_BASE + i,
+            'short_name': 'S{:05d}'.format(i),
+            'name': '{} Synthetic Station {}'.format(region, i),
+            'lat': round(generator.gauss(lat, 0.012), 6),
+            'lon': round(generator.gauss(lon, 0.016), 6),
+            'region_id': region_id,
+            'capacity': generator.choice((11, 15, 19, 23, 27)),
+            'electric_bike_surcharge_waiver': False,
+            'eightd_has_key_dispenser': generator.random() < 0.3,
+            'has_kiosk': generator.random() < 0.9,
+        })
+        # a few stations take most of the trips
+        weights.append(generator.paretovariate(1.2))
+    return stations, weights
+
+
+def _near_stations(stations):
+    # the indexes of the nearest stations of each station, by the squared distances in degrees
+    near = []
+    for s in stations:
+        scale = math.cos(math.radians(s['lat']))
+        distances = sorted(((t['lat'] - s['lat']) ** 2 + ((t['lon'] - s['lon']) * scale) ** 2, j) for j, t in enumerate(stations))
+        near.append([j for d, j in distances[1:NEAR_STATIONS + 1]] or [0])
+    return near
+
+
+def _months(start, months):
+    year, month = start
+    for _ in range(months):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _day_weight(date):
+    # more trips in summer (peak in mid July) and on weekdays
+    season = 1.0 + 0.6 * math.cos(2 * math.pi * (date.timetuple().tm_yday - 196) / 365.0)
+    return season * (1.0 if date.weekday() < 5 else 0.75)
+
+
+def _day_counts(dates, trips):
+    weights = [_day_weight(date) for date in dates]
+    total = sum(weights)
+    counts = [int(trips * weight / total) for weight in weights]
+    for i in range(trips - sum(counts)):
+        counts[i % len(counts)] += 1
+    return counts
+
+
+def _format_time(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S.') + '{:04d}'.format(value.microsecond // 100)
+
+
+class TripGenerator(object):
+    """
+    The generator of the trips of each day
+
+    Attributes
+    ----------
+    stations : list
+        the GBFS records of the stations
+
+    bikes : int
+        the number of bikes
+    """
+
+    def __init__(self, stations, weights, bikes, generator):
+        self.stations = stations
+        self.bikes = bikes
+        self.generator = generator
+        self.cumulative = _cumulative(weights)
+        self.near = _near_stations(stations)
+        self.near_cumulative = [_cumulative([weights[j] for j in near]) for near in self.near]
+
+    def _seconds(self, weekday):
+        # the seconds from the local midnight to start a trip
+        g = self.generator
+        if weekday:
+            r = g.random()
+            hour = g.gauss(8.2, 1.0) if r < 0.3 else g.gauss(17.5, 1.3) if r < 0.6 else g.uniform(6, 23)
+        else:
+            hour = g.gauss(14, 3.5)
+        return min(max(hour, 0.0), 23.9999) * 3600
+
+    def _station(self, start):
+        g = self.generator
+        if start is not None and g.random() < 0.75:
+            near = self.near[start]
+            return near[_weighted_index(g, self.near_cumulative[start])]
+        return _weighted_index(g, self.cumulative)
+
+    def trips(self, date, count):
+        """
+        Return the rows of the trips starting on the date, ordered by start time
+        """
+        g = self.generator
+        weekday = date.weekday() < 5
+        midnight = datetime.datetime(date.year, date.month, date.day)
+        rows = []
+        for _ in range(count):
+            start_time = midnight + datetime.timedelta(seconds=self._seconds(weekday))
+            start_time = start_time.replace(microsecond=start_time.microsecond // 100 * 100)
+            subscriber = g.random() < (0.85 if weekday else 0.65)
+            duration = int(g.lognormvariate(math.log(600 if subscriber else 1200), 0.6)) + 61
+            if g.random() < 0.01:
+                duration *= 10 # bikes returned late
+            stop_time = start_time + datetime.timedelta(seconds=duration, microseconds=g.randint(0, 9999) * 100)
+
+            if subscriber:
+                birth_year = min(max(int(g.gauss(1984, 11)), 1940), 2003)
+                gender = 1 if g.random() < 0.68 else 2 if g.random() < 0.9 else 0
+            elif g.random() < 0.4:
+                # customers who don't tell their profiles
+                birth_year, gender = 1969, 0
+            else:
+                birth_year = '\\N' if g.random() < 0.05 else min(max(int(g.gauss(1990, 12)), 1940), 2003)
+                gender = 1 if g.random() < 0.55 else 2 if g.random() < 0.8 else 0
+
+            start = self._station(None)
+            stop = self._station(start)
+            s, t = self.stations[start], self.stations[stop]
+            rows.append((
+                duration, _format_time(start_time), _format_time(stop_time),
+                s['station_id'], s['name'], s['lat'], s['lon'], t['station_id'], t['name'], t['lat'], t['lon'],
+                g.randint(1, self.bikes), 'Subscriber' if subscriber else 'Customer', birth_year, gender,
+            ))
+        rows.sort(key=lambda row: row[1])
+        return rows
+
+
+def _open_csv(filename, compress):
+    # csv of Python 2 writes bytes
+    if six.PY2:
+        return gzip.open(filename, 'wb') if compress else io.open(filename, 'wb')
+    return gzip.open(filename, 'wt', newline='') if compress else io.open(filename, 'w', newline='')
+
+
+def _write_json(filename, data):
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        f.write(six.text_type(json.dumps({'last_updated': 0, 'ttl': 10, 'data': data}, indent=1, sort_keys=True)))
+
+
+def write_synthetic_data(directory, trips=1000000, start=(2019, 1), months=12, stations=350, bikes=3500, seed=0, compress=False):
+    """
+    Write the synthetic stations, regions and trips into the directory. Returns the paths of the trip files.
+
+    Parameters
+    ----------
+    directory : str
+        the directory to write the files
+
+    trips : int
+        the number of trips, which are distributed to the days by season and weekday
+
+    start : tuple
+        (year, month) of the first monthly file
+
+    months : int
+        the number of monthly files
+
+    stations : int
+        the number of stations
+
+    bikes : int
+        the number of bikes
+
+    seed : int
+        the seed of the random generator
+
+    compress : bool
+        whether the trip files are written as csv.gz
+    """
+    generator = random.Random(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    records, weights = generate_stations(stations, generator)
+    _write_json(os.path.join(directory, 'system_regions.json'), {'regions': [{'region_id': region_id, 'name': name} for region_id, name, lat, lon, share in REGIONS]})
+    _write_json(os.path.join(directory, 'station_information.json'), {'stations': records})
+
+    dates = [datetime.date(year, month, day) for year, month in _months(start, months) for day in range(1, calendar.monthrange(year, month)[1] + 1)]
+    counts = dict(zip(dates, _day_counts(dates, trips)))
+    trip_generator = TripGenerator(records, weights, bikes, generator)
+
+    files = []
+    for year, month in _months(start, months):
+        filename = os.path.join(directory, '{:04d}{:02d}-bluebikes-tripdata.csv{}'.format(year, month, '.gz' if compress else ''))
+        with _open_csv(filename, compress) as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+            writer.writerow([str(name) for name in HEADER])
+            for day in range(1, calendar.monthrange(year, month)[1] + 1):
+                date = datetime.date(year, month, day)
+                writer.writerows(trip_generator.trips(date, counts[date]))
+        files.append(filename)
+    return files
+
+
+def load_synthetic_stations(directory):
+    """
+    Save the regions and the stations written by write_synthetic_data which don't exist yet. Returns the number of new stations.
+    """
+    from .caching import STATIONS, bump_data_version
+    from .models import Region, Station
+
+    with io.open(os.path.join(directory, 'system_regions.json'), encoding='utf-8') as f:
+        regions = json.load(f)['data']['regions']
+    with io.open(os.path.join(directory, 'station_information.json'), encoding='utf-8') as f:
+        stations = json.load(f)['data']['stations']
+
+    existing = set(Region.objects.values_list('region_id', flat=True))
+    Region.objects.bulk_create([Region(**r) for r in regions if r['region_id'] not in existing])
+    existing = set(Station.objects.values_list('station_id', flat=True))
+    new_stations = [Station(**s) for s in stations if s['station_id'] not in existing]
+    Station.objects.bulk_create(new_stations)
+    # bulk_create doesn't send the signals bumping the version
+    bump_data_version(STATIONS)
+    return len(new_stations)
@@ -1,14 +1,41 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import datetime
+import bisect, csv, datetime, gzip, io, json, logging, os, random, shutil, sqlite3, struct, tempfile, threading, time, unittest, zipfile
 
-from django.test import TestCase
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.migrations.recorder import MigrationRecorder
+from django.db.models import Max, Min, Sum
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
 
 # Create your tests here.
 from rest_framework import status
 from rest_framework.test import APITestCase
-from .models import Station
+from .models import DailyTripRollup, HourlyTripRollup, ImportedFile, Station, Trip
+from .apps import IteratorPaginator, make_aware_datetime
+from .benchmarks import bench_concurrent_reads, bench_load, bench_sketches
+from .bitmaps import Bitmap, BitmapIndex
+from .caching import LRUCache, RedisCache, bump_data_version, get_data_version, get_summary_cache, redis
+from . import columnstore
+from .columnstore import build_columnstore, get_trip_columns
+from .exports import accepts_gzip, csv_chunks, fetch_rows
+from .importer import find_data_files, import_files
+from .instrumentation import REGISTRY, Histogram
+from .partitions import convert_to_partitions, drop_partition, is_partitioned, list_partitions, partition_name
+from .pragmas import SQLITE_BULK_LOAD_DEFAULTS, SQLITE_PRAGMA_DEFAULTS, apply_pragmas, bulk_load, read_pragmas
+from .renderers import ColumnarRenderer
+from .rollups import add_trips, rebuild_rollups
+from .slowqueries import explain, fingerprint, normalize_sql, read_slow_queries, summarize_slow_queries
+from .sketches import HyperLogLog, TDigest, percentile
+from .spatial import GridIndex, distance
+from .synthetic import STATION_ID_BASE
+from .timestamps import NUMPY_MIN_SIZE, numpy, parse_timestamp, parse_timestamps
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
 
 class StationDetailTests(APITestCase):
     fixtures = ['StationDetailTests/stations']
@@ -450,6 +477,108 @@ class StationListTests(APITestCase):
         self.assertEqual(response.data['count'], 1)
 
 
+class StationSpatialTests(APITestCase):
+    fixtures = ['StationListTests/stations']
+
+    def _ids(self, params, status_code=status.HTTP_200_OK):
+        params = dict(params, limit=1000, fields='station_id')
+        response = self.client.get('/apis/stations/', params, format='json')
+        self.assertEqual(response.status_code, status_code)
+        return [row['station_id'] for row in response.data['results']] if status_code == status.HTTP_200_OK else response.data
+
+    def _distances(self, lat, lon):
+        return sorted((distance(lat, lon, s.lat, s.lon), s.pk) for s in Station.objects.all())
+
+    def test_bbox(self):
+        bbox = (-71.1, 42.34, -71.06, 42.36)
+        expected = Station.objects.filter(lon__range=bbox[0::2], lat__range=bbox[1::2]).values_list('pk', flat=True)
+        self.assertTrue(0 < len(expected) < Station.objects.count())
+        self.assertEqual(sorted(self._ids({'bbox': ','.join(str(v) for v in bbox)})), sorted(expected))
+
+        self.assertEqual(self._ids({'bbox': '0,0,1,1'}), [])
+        self.assertEqual(len(self._ids({'bbox': '-180,-90,180,90'})), Station.objects.count())
+
+    def test_bbox_with_filter(self):
+        ids = self._ids({'bbox': '-71.1,42.34,-71.06,42.36', 'capacity_gt': 15})
+        expected = Station.objects.filter(lon__range=(-71.1, -71.06), lat__range=(42.34, 42.36), capacity__gt=15).values_list('pk', flat=True)
+        self.assertEqual(sorted(ids), sorted(expected))
+
+    def test_near_k(self):
+        expected = [pk for d, pk in self._distances(42.355, -71.065)]
+        self.assertEqual(self._ids({'near': '42.355,-71.065', 'k': 5}), expected[:5])
+        self.assertEqual(self._ids({'near': '42.355,-71.065', 'k': 100}), expected)
+        # far away from all the stations
+        self.assertEqual(self._ids({'near': '42.0,-70.0', 'k': 3}), [pk for d, pk in self._distances(42.0, -70.0)][:3])
+
+    def test_near_radius(self):
+        distances = self._distances(42.355, -71.065)
+        self.assertEqual(self._ids({'near': '42.355,-71.065', 'radius': 2000}), [pk for d, pk in distances if d <= 2000])
+        self.assertEqual(self._ids({'near': '42.355,-71.065', 'radius': 2000, 'k': 2}), [pk for d, pk in distances if d <= 2000][:2])
+        self.assertEqual(self._ids({'near': '42.355,-71.065', 'radius': 1}), [])
+
+    def test_index_rebuilt(self):
+        self.assertEqual(self._ids({'near': '42.0,-70.0', 'k': 1}), [self._distances(42.0, -70.0)[0][1]])
+
+        Station.objects.filter(pk=3).update(lat=42.0, lon=-70.0)
+        Station.objects.get(pk=3).save()
+        self.assertEqual(self._ids({'near': '42.0,-70.0', 'k': 1}), [3])
+
+        Station.objects.get(pk=3).delete()
+        self.assertNotEqual(self._ids({'near': '42.0,-70.0', 'k': 1}), [3])
+
+    def test_invalid_params(self):
+        self.assertIn('bbox', self._ids({'bbox': '1,2,3'}, status.HTTP_400_BAD_REQUEST))
+        self.assertIn('near', self._ids({'near': 'a,b', 'k': 1}, status.HTTP_400_BAD_REQUEST))
+        self.assertIn('near', self._ids({'near': '42.3,-71.0'}, status.HTTP_400_BAD_REQUEST))
+        self.assertIn('k', self._ids({'near': '42.3,-71.0', 'k': -1}, status.HTTP_400_BAD_REQUEST))
+        self.assertIn('near', self._ids({'near': '91,0', 'k': 1}, status.HTTP_400_BAD_REQUEST))
+
+    def test_grid_index(self):
+        generator = random.Random(0)
+        points = [(i, generator.uniform(42.2, 42.5), generator.uniform(-71.3, -70.9)) for i in range(500)]
+        index = GridIndex(points)
+        for lat, lon in [(42.35, -71.1), (42.6, -71.5), (42.2, -70.9)]:
+            expected = sorted((distance(lat, lon, plat, plon), pk) for pk, plat, plon in points)
+            self.assertEqual([pk for pk, d in index.nearest(lat, lon, k=10)], [pk for d, pk in expected[:10]])
+            self.assertEqual([pk for pk, d in index.nearest(lat, lon, radius=3000)], [pk for d, pk in expected if d <= 3000])
+        self.assertEqual(sorted(index.bbox(-71.2, 42.3, -71.0, 42.4)), sorted(pk for pk, lat, lon in points if 42.3 <= lat <= 42.4 and -71.2 <= lon <= -71.0))
+
+    def test_grid_index_far_away(self):
+        generator = random.Random(0)
+        points = [(i, generator.uniform(42.2, 42.5), generator.uniform(-71.3, -70.9)) for i in range(300)]
+        index = GridIndex(points)
+        started = time.time()
+        for lat, lon in [(0.0, 0.0), (-89.0, 179.0), (30.0, -71.0)]:
+            expected = sorted((distance(lat, lon, plat, plon), pk) for pk, plat, plon in points)
+            self.assertEqual([pk for pk, d in index.nearest(lat, lon, k=1)], [expected[0][1]])
+            self.assertEqual(index.nearest(lat, lon, radius=1000), [])
+        # the empty rings between the point and the stations are not visited
+        self.assertLess(time.time() - started, 1.0)
+
+    def test_grid_index_visited_cells(self):
+        class CountingCells(dict):
+            lookups = 0
+
+            def get(self, key, default=None):
+                CountingCells.lookups += 1
+                return dict.get(self, key, default)
+
+        generator = random.Random(0)
+        points = [(i, generator.uniform(42.2, 42.5), generator.uniform(-71.3, -70.9)) for i in range(2000)]
+        index = GridIndex(points)
+        index.cells = CountingCells(index.cells)
+        min_row, min_col, max_row, max_col = index.bounds
+        rows, cols = max_row - min_row + 1, max_col - min_col + 1
+        self.assertGreater(len(index.cells), 900)
+
+        # the cells of the rings around the point, clamped to the rows and the columns of the grid
+        for lat, lon, k, cells in [(42.35, -71.1, 5, 5 * 5), (42.35, -71.1, 50, 9 * 9), (42.2, -70.9, 5, 4 * 3), (42.35, 10.0, 1, rows), (0.0, 0.0, 1, rows * cols)]:
+            CountingCells.lookups = 0
+            expected = sorted((distance(lat, lon, plat, plon), pk) for pk, plat, plon in points)
+            self.assertEqual([pk for pk, d in index.nearest(lat, lon, k=k)], [pk for d, pk in expected[:k]])
+            self.assertLessEqual(CountingCells.lookups, cells, (lat, lon))
+
+
 class TripDetailTests(APITestCase):
     fixtures = ['TripDetailTests/stations', 'TripDetailTests/trips']
 
@@ -1005,6 +1134,485 @@ class TripListTests(APITestCase):
         self.assertEqual(response.data['count'], 2)
 
 
+class TripKeysetPaginationTests(APITestCase):
+    fixtures = ['TripListTests/stations', 'TripListTests/trips']
+
+    def _get(self, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params or {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse([q for q in queries if 'COUNT(' in q['sql']])
+        return response
+
+    def _walk(self, params, link='next'):
+        # follow the links from the first page and return the ids of the pages
+        pages = []
+        response = self._get('/apis/trips/', params)
+        while True:
+            pages.append([t['id'] for t in response.data['results']])
+            if response.data[link] is None:
+                return pages
+            response = self._get(response.data[link])
+
+    def test_get_trips_by_cursor(self):
+        response = self._get('/apis/trips/', {'cursor': '', 'limit': 5})
+        self.assertNotIn('count', response.data)
+        self.assertIsNone(response.data['previous'])
+
+        expected = list(Trip.objects.order_by('start_time', 'id').values_list('id', flat=True))
+        pages = self._walk({'cursor': '', 'limit': 5})
+        self.assertEqual([len(page) for page in pages], [5, 5, 5, 5, 1])
+        self.assertEqual(sum(pages, []), expected)
+
+    def test_get_trips_by_cursor_same_start_time(self):
+        # the trips starting at the same time are ordered by ids
+        start_time = Trip.objects.get(pk=3940).start_time
+        Trip.objects.filter(pk__in=[175, 522, 575, 787, 931, 1582]).update(start_time=start_time)
+
+        expected = list(Trip.objects.order_by('start_time', 'id').values_list('id', flat=True))
+        self.assertEqual(sum(self._walk({'cursor': '', 'limit': 2}), []), expected)
+
+    def test_get_trips_previous_cursor(self):
+        pages = self._walk({'cursor': '', 'limit': 4})
+
+        response = self._get('/apis/trips/', {'cursor': '', 'limit': 4})
+        while response.data['next'] is not None:
+            response = self._get(response.data['next'])
+        backward = []
+        while True:
+            backward.insert(0, [t['id'] for t in response.data['results']])
+            if response.data['previous'] is None:
+                break
+            response = self._get(response.data['previous'])
+        self.assertEqual(backward, pages)
+
+    def test_get_trips_by_cursor_with_filter(self):
+        params = {'start_time_gt': '2019-03-02', 'duration_lt': 2000}
+        expected = list(Trip.objects.filter(start_time__gt=make_aware_datetime('2019-03-02T00:00:00'), duration__lt=2000)
+                        .order_by('start_time', 'id').values_list('id', flat=True))
+        self.assertTrue(expected)
+
+        params.update({'cursor': '', 'limit': 2})
+        self.assertEqual(sum(self._walk(params), []), expected)
+
+    def test_get_trips_invalid_cursor(self):
+        response = self.client.get('/apis/trips/', {'cursor': 'invalid'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class TripExportTests(APITestCase):
+    fixtures = ['TripListTests/stations', 'TripListTests/trips']
+
+    def _export(self, params, **headers):
+        response = self.client.get('/apis/trips/export/', params, **headers)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content)
+        if response.get('Content-Encoding') == 'gzip':
+            content = gzip.GzipFile(fileobj=six.BytesIO(content)).read()
+        return response, content.decode('utf-8')
+
+    def test_export_csv(self):
+        with CaptureQueriesContext(connection) as queries:
+            response, content = self._export({})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(len(queries), 1)
+
+        lines = content.splitlines()
+        self.assertEqual(lines[0], 'id,duration,start_time,stop_time,start_date,stop_date,start_station,stop_station,bike_id,is_subscriber,birth_year,gender')
+        self.assertEqual(lines[1], '175,1171,2019-03-01T12:22:57.543000+00:00,2019-03-01T12:42:29.141000+00:00,2019-03-01,2019-03-01,190,3,3571,true,1984,1')
+        self.assertEqual([int(line.split(',')[0]) for line in lines[1:]], list(Trip.objects.order_by('pk').values_list('id', flat=True)))
+
+    def test_export_ndjson(self):
+        response, content = self._export({'format': 'ndjson', 'fields': 'id,duration,is_subscriber', 'duration_gt': 1000})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+
+        rows = [json.loads(line) for line in content.splitlines()]
+        expected = Trip.objects.filter(duration__gt=1000).order_by('pk')
+        self.assertEqual(rows, [{'id': t.id, 'duration': t.duration, 'is_subscriber': t.is_subscriber} for t in expected])
+
+    def test_export_accept_header(self):
+        response, content = self._export({'omit': 'start_time,stop_time'}, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertNotIn('start_time', json.loads(content.splitlines()[0]))
+
+    def test_export_gzip(self):
+        response, content = self._export({'start_station': 190}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(len(content.splitlines()), Trip.objects.filter(start_station=190).count() + 1)
+
+    def test_export_gzip_refused(self):
+        response, content = self._export({'start_station': 190}, HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(len(content.splitlines()), Trip.objects.filter(start_station=190).count() + 1)
+
+    def test_accepts_gzip(self):
+        factory = RequestFactory()
+        for header, accepted in [
+                ('gzip', True),
+                ('deflate, GZIP;q=0.5', True),
+                ('br;q=1.0, gzip; q=0.001', True),
+                ('*', True),
+                ('gzip;q=0', False),
+                ('gzip;q=0.0, *;q=1', False),
+                ('*;q=0', False),
+                ('gzip;q=x', False),
+                ('gzipped, deflate', False),
+                ('', False)]:
+            self.assertEqual(accepts_gzip(factory.get('/', HTTP_ACCEPT_ENCODING=header)), accepted, header)
+
+    def test_export_nothing(self):
+        response, content = self._export({'start_date': '2020-03-01'})
+        self.assertEqual(content.splitlines(), [content.splitlines()[0]])
+
+    def test_export_in_chunks(self):
+        fields = ['id', 'start_time', 'is_subscriber']
+        rows = list(fetch_rows(Trip.objects.order_by('pk'), fields, chunk_size=2))
+        self.assertEqual(rows, list(Trip.objects.order_by('pk').values_list(*fields)))
+
+        chunks = list(csv_chunks(rows, fields, chunk_size=5))
+        self.assertEqual(len(chunks), 1 + 5)
+        self.assertEqual(b''.join(chunks), b''.join(csv_chunks(rows, fields)))
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'Server-side cursors are used only on PostgreSQL')
+    def test_export_server_side_cursor(self):
+        cursor = connection.chunked_cursor()
+        self.assertTrue(cursor.cursor.name)
+        cursor.close()
+
+        response, content = self._export({})
+        self.assertEqual(len(content.splitlines()), 1 + Trip.objects.count())
+
+
+def decode_columnar(content):
+    """
+    Decode the columnar format into the metadata and the list of rows as dicts
+    """
+    def unpack(fmt, offset):
+        return struct.unpack_from(str(fmt), content, offset), offset + struct.calcsize(str(fmt))
+
+    def align(offset):
+        return offset + (-offset % 8)
+
+    assert content[:8] == b'BBCF\x01\x00\x00\x00'
+    (size,), offset = unpack('<I', 8)
+    metadata = json.loads(content[offset:offset + size].decode('utf-8'))
+    (length, count), offset = unpack('<II', align(offset + size))
+
+    columns = []
+    for _ in range(count):
+        (size,), offset = unpack('<I', offset)
+        name = content[offset:offset + size].decode('utf-8')
+        (column_type,), offset = unpack('<B', offset + size)
+        offset = align(offset)
+        if column_type == 4:
+            offsets, offset = unpack('<{}I'.format(length + 1), offset)
+            offset = align(offset)
+            values = [content[offset + offsets[i]:offset + offsets[i + 1]].decode('utf-8') for i in range(length)]
+            offset = align(offset + offsets[-1])
+        else:
+            values, offset = unpack('<{}{}'.format(length, {1: 'i', 2: 'd', 3: 'B'}[column_type]), offset)
+            if column_type == 3:
+                values = [None if v == 255 else bool(v) for v in values]
+            offset = align(offset)
+        columns.append((name, values))
+
+    assert offset == len(content)
+    return metadata, [dict((name, values[i]) for name, values in columns) for i in range(length)]
+
+
+class ColumnarRendererTests(APITestCase):
+    fixtures = ['TripSummaryTests/stations', 'TripSummaryTests/trips']
+
+    def _get(self, path, params, **headers):
+        response = self.client.get(path, params, **headers)
+        self.assertEqual(response['Content-Type'], 'application/vnd.bluebikes.columnar')
+        return response, decode_columnar(response.content)
+
+    def test_stations(self):
+        params = {'limit': 300, 'fields': 'lat,lon,station_id,capacity,name,region,has_kiosk'}
+        expected = self.client.get('/apis/stations/', params, format='json').data
+
+        params['format'] = 'columnar'
+        response, (metadata, rows) = self._get('/apis/stations/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(metadata, {'count': expected['count'], 'next': expected['next'], 'previous': expected['previous']})
+        self.assertEqual(rows, [dict(row) for row in expected['results']])
+
+    def test_stations_next_page(self):
+        expected = self.client.get('/apis/stations/', {'page': 2}, format='json').data
+
+        response, (metadata, rows) = self._get('/apis/stations/', {'page': 2}, HTTP_ACCEPT='application/vnd.bluebikes.columnar')
+        self.assertEqual(metadata['previous'], expected['previous'])
+        self.assertEqual([row['station_id'] for row in rows], [row['station_id'] for row in expected['results']])
+        self.assertEqual(set(rows[0].keys()), set(expected['results'][0].keys()))
+
+    def test_stations_empty_fields(self):
+        response, (metadata, rows) = self._get('/apis/stations/', {'format': 'columnar', 'fields': ''})
+        self.assertEqual(rows, [{}] * min(Station.objects.count(), 10))
+
+    def test_summary(self):
+        params = {'group_by': 'start_date', 'agg': 'count,avg,max', 'field': 'duration'}
+        expected = self.client.get('/apis/trips/summary/', params, format='json').data
+
+        params['format'] = 'columnar'
+        response, (metadata, rows) = self._get('/apis/trips/summary/', params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(rows, [dict(row, start_date=row['start_date'].isoformat()) for row in expected])
+
+    def test_summary_nulls(self):
+        params = {'group_by': 'birth_year', 'agg': 'count', 'format': 'columnar'}
+        response, (metadata, rows) = self._get('/apis/trips/summary/', params)
+        expected = Trip.objects.values_list('birth_year', flat=True)
+        self.assertEqual(sum(row['count'] for row in rows), len(expected))
+        # birth_year is float64 with NaN for the missing years
+        self.assertEqual(sorted(row['birth_year'] for row in rows if row['birth_year'] == row['birth_year']), sorted(set(y for y in expected if y is not None)))
+
+    def test_missing_column(self):
+        content = ColumnarRenderer().render([{'birth_year': None, 'count': 1}, {'birth_year': None, 'count': 2}])
+        self.assertEqual(content[content.index(b'birth_year') + len('birth_year'):][:1], struct.pack('<B', ColumnarRenderer.FLOAT64))
+        metadata, rows = decode_columnar(content)
+        self.assertEqual([row['count'] for row in rows], [1, 2])
+        self.assertTrue(all(row['birth_year'] != row['birth_year'] for row in rows))
+
+    def test_summary_error(self):
+        response, (metadata, rows) = self._get('/apis/trips/summary/', {'format': 'columnar'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('group_by', metadata['detail'])
+        self.assertEqual(rows, [])
+
+
+class TripQueryCountTests(APITestCase):
+    fixtures = ['TripListTests/stations', 'TripListTests/trips']
+
+    def _get(self, path, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path, params or {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, [q['sql'] for q in queries]
+
+    def test_list_queries_per_page(self):
+        # one count and one select joining stations and regions, whatever the page size is
+        response, queries = self._get('/apis/trips/', {'limit': 1000})
+        self.assertEqual(len(response.data['results']), 21)
+        self.assertEqual(len(queries), 2)
+        self.assertIn('"apis_region"', queries[1])
+
+    def test_retrieve_queries(self):
+        response, queries = self._get('/apis/trips/175/')
+        self.assertEqual(response.data['start_station']['region'], 'Boston')
+        self.assertEqual(len(queries), 1)
+
+    def test_list_queries_with_fields_filter(self):
+        response, queries = self._get('/apis/trips/', {'limit': 1000, 'fields': 'id,duration'})
+        self.assertEqual(response.data['results'][0], {'id': 175, 'duration': 1171})
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('"apis_station"', queries[1])
+        self.assertNotIn('"bike_id"', queries[1])
+
+    def test_list_queries_with_station_fields_filter(self):
+        response, queries = self._get('/apis/trips/', {'limit': 1000, 'fields': 'stop_station'})
+        self.assertEqual(response.data['results'][0]['stop_station']['region'], 'Boston')
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('"start_station_id"', queries[1])
+
+    def test_iterator_paginator(self):
+        queryset = Trip.objects.order_by('pk')
+        page = IteratorPaginator(queryset, 5).page(2)
+        self.assertIsInstance(page.object_list, list)
+        self.assertEqual(page.object_list, list(queryset[5:10]))
+        self.assertTrue(page.has_next())
+
+    def test_list_queries_with_omit_filter(self):
+        response, queries = self._get('/apis/trips/', {'limit': 1000, 'omit': 'start_station,stop_station'})
+        self.assertNotIn('start_station', response.data['results'][0])
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('"apis_station"', queries[1])
+
+
+class RequestMetricsTests(APITestCase):
+    fixtures = ['TripListTests/stations', 'TripListTests/trips']
+
+    def setUp(self):
+        REGISTRY.clear()
+
+    def _timings(self, response):
+        # name -> (duration, description) of the Server-Timing header
+        timings = {}
+        for metric in response['Server-Timing'].split(', '):
+            name, params = metric.split(';', 1)
+            params = dict(param.split('=', 1) for param in params.split(';'))
+            timings[name] = (float(params['dur']), params.get('desc'))
+        return timings
+
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/apis/trips/', {'limit': 5}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        timings = self._timings(response)
+        self.assertEqual(sorted(timings), ['app', 'db', 'render', 'serialize', 'total'])
+        self.assertEqual(timings['db'][1], '"{} queries"'.format(len(queries)))
+        self.assertTrue(timings['serialize'][0] > 0)
+        self.assertTrue(timings['render'][0] > 0)
+        self.assertTrue(timings['total'][0] >= timings['db'][0] + timings['serialize'][0] + timings['render'][0])
+
+    def test_queries_counted_without_debug_cursor(self):
+        response = self.client.get('/apis/trips/175/', format='json')
+        self.assertEqual(self._timings(response)['db'][1], '"1 queries"')
+
+    def test_log_line(self):
+        logger = logging.getLogger('apis.requests')
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        handlers, level = logger.handlers, logger.level
+        logger.handlers = [handler]
+        logger.setLevel(logging.INFO)
+        try:
+            self.client.get('/apis/trips/summary/', {'group_by': 'gender'}, format='json')
+        finally:
+            logger.handlers = handlers
+            logger.setLevel(level)
+
+        self.assertEqual(len(records), 1)
+        line = json.loads(records[0].getMessage())
+        self.assertEqual(line['view'], 'trip-summary')
+        self.assertEqual(line['path'], '/apis/trips/summary/')
+        self.assertEqual(line['status'], 200)
+        self.assertTrue(line['queries'] > 0)
+        self.assertEqual(records[0].metrics, line)
+
+    def test_metrics_endpoint(self):
+        for _ in range(3):
+            self.client.get('/apis/trips/', {'limit': 5}, format='json')
+        self.client.get('/apis/trips/175/', format='json')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.content.decode('utf-8').splitlines()
+        self.assertIn('# TYPE bluebikes_request_duration_seconds histogram', lines)
+        self.assertIn('bluebikes_request_duration_seconds_count{view="trip-list"} 3', lines)
+        self.assertIn('bluebikes_request_duration_seconds_bucket{view="trip-list",le="+Inf"} 3', lines)
+        self.assertIn('bluebikes_request_queries_bucket{view="trip-detail",le="1"} 1', lines)
+        self.assertIn('bluebikes_request_queries_bucket{view="trip-detail",le="0"} 0', lines)
+        self.assertIn('bluebikes_request_queries_sum{view="trip-detail"} 1.0', lines)
+
+    def test_metrics_restricted(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        with self.settings(REQUEST_METRICS={'METRICS_IPS': (), 'METRICS_TOKEN': 's3cret'}):
+            self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_403_FORBIDDEN)
+            response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.5', HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.5', HTTP_AUTHORIZATION='Bearer s3cret')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with self.settings(REQUEST_METRICS={'METRICS_IPS': ('203.0.113.5',)}):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.5').status_code, status.HTTP_200_OK)
+            # no token is set, so no bearer is accepted
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_histogram(self):
+        histogram = Histogram((1, 5, 10))
+        for value in (0.5, 1, 3, 7, 20):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative_counts(), [(1, 2), (5, 3), (10, 4), (float('inf'), 5)])
+        self.assertEqual((histogram.sum, histogram.count), (31.5, 5))
+
+    @override_settings(REQUEST_METRICS={'ENABLED': False})
+    def test_disabled(self):
+        response = self.client.get('/apis/trips/', {'limit': 5}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertNotIn('trip-list', REGISTRY.render())
+
+    @override_settings(REQUEST_METRICS={'SERVER_TIMING': False})
+    def test_server_timing_disabled(self):
+        response = self.client.get('/apis/trips/', {'limit': 5}, format='json')
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertIn('trip-list', REGISTRY.render())
+
+
+class SlowQueryLogTests(APITestCase):
+    fixtures = ['TripListTests/stations', 'TripListTests/trips']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'slow_queries.log')
+        self.settings = override_settings(SLOW_QUERY_LOG={'THRESHOLD_MS': 0, 'PATH': self.path, 'EXPLAIN': True})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.directory)
+
+    def test_normalize_sql(self):
+        self.assertEqual(
+            normalize_sql("SELECT  \"apis_trip\".\"id\" FROM \"apis_trip\"\n WHERE (\"gender\" = %s AND \"bike_id\" IN (%s, %s, %s) AND \"usertype\" = 'x''y') LIMIT 21"),
+            'SELECT "apis_trip"."id" FROM "apis_trip" WHERE ("gender" = ? AND "bike_id" IN (...) AND "usertype" = ?) LIMIT ?')
+        self.assertEqual(fingerprint(normalize_sql('SELECT 1 WHERE a IN (%s, %s)')), fingerprint(normalize_sql('SELECT 2 WHERE a IN (%s, %s, %s, %s)')))
+
+    def test_log_entries(self):
+        response = self.client.get('/apis/trips/', {'limit': 5, 'gender': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        entries = read_slow_queries(self.path)
+        self.assertTrue(entries)
+        select = [entry for entry in entries if '"apis_trip"."duration"' in entry['sql']][0]
+        self.assertEqual(select['view'], 'trip-list')
+        self.assertEqual(select['vendor'], connection.vendor)
+        self.assertIn(1, select['params'])
+        self.assertNotIn('%s', select['sql'])
+        self.assertTrue(select['plan'])
+        self.assertTrue(any('apis_trip' in line for line in select['plan']))
+
+    def test_log_without_plans(self):
+        with override_settings(SLOW_QUERY_LOG={'THRESHOLD_MS': 0, 'PATH': self.path}):
+            self.client.get('/apis/trips/', {'limit': 5, 'gender': 1}, format='json')
+        entries = read_slow_queries(self.path)
+        self.assertTrue(entries)
+        # the queries aren't explained by default
+        self.assertEqual([entry['plan'] for entry in entries], [None] * len(entries))
+
+    def test_explain_in_transaction(self):
+        with transaction.atomic():
+            self.assertIsNone(explain(connection, 'SELECT * FROM "apis_missing"', []))
+            self.assertFalse(connection.needs_rollback)
+            # the transaction is still usable after the failed EXPLAIN
+            self.assertTrue(explain(connection, 'SELECT * FROM "apis_trip" WHERE "gender" = %s', [1]))
+            self.assertEqual(Trip.objects.filter(pk=175).count(), 1)
+
+    def test_threshold(self):
+        with override_settings(SLOW_QUERY_LOG={'THRESHOLD_MS': 60000, 'PATH': self.path}):
+            self.client.get('/apis/trips/', {'limit': 5}, format='json')
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_report(self):
+        for gender in (0, 1, 2):
+            self.client.get('/apis/trips/summary/', {'group_by': 'start_station', 'gender': gender}, format='json')
+        self.client.get('/apis/trips/175/', format='json')
+
+        shapes = summarize_slow_queries(read_slow_queries(self.path))
+        summary = [shape for shape in shapes if shape['views'] == ['trip-summary'] and 'GROUP BY' in shape['sql']]
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]['count'], 3)
+        self.assertEqual(shapes, sorted(shapes, key=lambda shape: -shape['total_ms']))
+
+        out = six.StringIO()
+        call_command('slow_queries', path=self.path, view='trip-detail', stdout=out)
+        report = out.getvalue()
+        self.assertIn('1 slow queries of 1 shapes', report)
+        self.assertIn('"apis_trip"."id" = ?', report)
+        self.assertIn('plan: ', report)
+
+        out = six.StringIO()
+        call_command('slow_queries', path=self.path, top=1, json=True, stdout=out)
+        self.assertEqual(json.loads(out.getvalue())[0]['fingerprint'], shapes[0]['fingerprint'])
+
+
 class TripSummaryTests(APITestCase):
     fixtures = ['TripSummaryTests/stations', 'TripSummaryTests/trips']
 
@@ -1235,4 +1843,1243 @@ class TripSummaryTests(APITestCase):
             'start_date': '2020-03-01'
         }, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data, [])
\ No newline at end of file
+        self.assertEqual(response.data, [])
+
+    def test_get_trip_summary_multiple_group_by(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/apis/trips/summary/', {'group_by': 'start_date,gender', 'agg': 'count,max', 'field': 'duration'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len([q for q in queries if 'FROM "apis_trip"' in q['sql']]), 1)
+
+        expected = {}
+        for trip in Trip.objects.all():
+            count, max_duration = expected.get((trip.start_date, trip.gender), (0, 0))
+            expected[(trip.start_date, trip.gender)] = (count + 1, max(max_duration, trip.duration))
+        self.assertEqual([((row['start_date'], row['gender']), (row['count'], row['max_duration'])) for row in response.data], sorted(expected.items()))
+
+    def test_get_trip_summary_having_order_by_top(self):
+        response = self.client.get('/apis/trips/summary/', {
+            'group_by': 'start_station',
+            'agg': 'count,avg',
+            'field': 'duration',
+            'having': 'count_gte:2',
+            'order_by': '-count,-avg_duration',
+            'top': 3,
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        durations = {}
+        for trip in Trip.objects.all():
+            durations.setdefault(trip.start_station_id, []).append(trip.duration)
+        expected = sorted(((len(d), float(sum(d)) / len(d), pk) for pk, d in durations.items() if len(d) >= 2), reverse=True)[:3]
+        self.assertTrue(expected)
+        self.assertEqual([(row['count'], row['avg_duration'], row['start_station']) for row in response.data], expected)
+
+    def test_get_trip_summary_having_exact(self):
+        response = self.client.get('/apis/trips/summary/', {'group_by': 'start_date', 'having': 'count:6'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, [{'start_date': datetime.date(2019, 3, 3), 'count': 6}])
+
+    def test_get_trip_summary_invalid_params(self):
+        for params in [
+            {'group_by': 'start_date,unknown'},
+            {'group_by': 'start_date', 'agg': 'median', 'field': 'duration'},
+            {'group_by': 'start_date', 'agg': 'max', 'field': 'unknown'},
+            {'group_by': 'start_date', 'having': 'max_duration_gt:100'},
+            {'group_by': 'start_date', 'having': 'count_between:100'},
+            {'group_by': 'start_date', 'having': 'count_gt:many'},
+            {'group_by': 'start_date', 'order_by': 'gender'},
+            {'group_by': 'start_date', 'top': 0},
+            {'group_by': 'start_date', 'agg': 'p50'},
+            {'group_by': 'start_date', 'agg': 'p50', 'field': 'start_time'},
+            {'group_by': 'start_date', 'agg': 'p95', 'field': 'duration', 'order_by': '-p95_duration'},
+        ]:
+            response = self.client.get('/apis/trips/summary/', params, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, params)
+
+    def test_get_trip_summary_percentiles(self):
+        # the fixtures have no rollups, so the percentiles are exact
+        response = self.client.get('/apis/trips/summary/', {'group_by': 'start_date', 'agg': 'p50', 'field': 'duration'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(row['start_date'].day, row['p50_duration']) for row in response.data], [(1, 1103), (2, 210.5), (3, 1428), (4, 1092), (5, 623)])
+
+        response = self.client.get('/apis/trips/summary/', {'group_by': 'start_date', 'agg': 'count,p95,p99', 'field': 'duration', 'order_by': '-count', 'top': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['count'], 9)
+        self.assertAlmostEqual(response.data[0]['p95_duration'], 1217 + (1674 - 1217) * 0.6)
+        self.assertAlmostEqual(response.data[0]['p99_duration'], 1217 + (1674 - 1217) * 0.92)
+
+    def test_get_trip_summary_distinct_bikes(self):
+        response = self.client.get('/apis/trips/summary/', {'group_by': 'start_date', 'agg': 'distinct_bikes', 'having': 'distinct_bikes_gt:2'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(row['start_date'].day, row['distinct_bikes']) for row in response.data], [(1, 9), (3, 6), (5, 3)])
+
+    def test_get_trip_summary_by_weekday(self):
+        response = self.client.get('/apis/trips/summary/', {'group_by': 'start_weekday', 'agg': 'count,max', 'field': 'duration'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # 2019-03-01 is Friday
+        self.assertEqual([(row['start_weekday'], row['count']) for row in response.data], [(0, 6), (1, 1), (2, 3), (5, 9), (6, 2)])
+        self.assertEqual(response.data[0]['max_duration'], Trip.objects.filter(start_date=datetime.date(2019, 3, 3)).aggregate(m=Max('duration'))['m'])
+
+    def test_get_trip_summary_by_time_buckets(self):
+        trips = list(Trip.objects.all())
+        local_times = [timezone.localtime(trip.start_time) for trip in trips]
+        expected = {
+            'start_hour': [t.hour for t in local_times],
+            'start_week': [t.isocalendar()[1] for t in local_times],
+            'start_month': [t.month for t in local_times],
+            'start_hour_of_week': [t.isoweekday() % 7 * 24 + t.hour for t in local_times],
+        }
+        for group_by, keys in expected.items():
+            response = self.client.get('/apis/trips/summary/', {'group_by': group_by}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            counts = dict((key, keys.count(key)) for key in keys)
+            self.assertEqual(response.data, [{group_by: key, 'count': counts[key]} for key in sorted(counts)], group_by)
+
+
+class TripOriginDestinationTests(APITestCase):
+    fixtures = ['TripSummaryTests/stations', 'TripSummaryTests/trips']
+
+    def _matrix(self, params):
+        response = self.client.get('/apis/trips/od_matrix/', params, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = json.loads(response.content.decode('utf-8'))['results']
+        self.assertEqual(set(results.keys()), set(['start_station', 'stop_station', 'count', 'avg_duration']))
+        return list(zip(results['start_station'], results['stop_station'], results['count'], results['avg_duration']))
+
+    def _expected(self, trips):
+        pairs = {}
+        for trip in trips:
+            pairs.setdefault((trip.start_station_id, trip.stop_station_id), []).append(trip.duration)
+        rows = [(start, stop, len(durations), float(sum(durations)) / len(durations)) for (start, stop), durations in pairs.items()]
+        return sorted(rows, key=lambda row: (-row[2], row[0], row[1]))
+
+    def test_od_matrix(self):
+        expected = self._expected(Trip.objects.all())
+        self.assertTrue(any(row[2] > 1 for row in expected))
+        self.assertEqual(self._matrix({}), expected)
+
+    def test_od_matrix_top_k(self):
+        expected = self._expected(Trip.objects.all())
+        self.assertEqual(self._matrix({'k': 3}), expected[:3])
+        self.assertEqual(self._matrix({'min_count': 2}), [row for row in expected if row[2] >= 2])
+
+    def test_od_matrix_with_filter(self):
+        expected = self._expected(Trip.objects.filter(start_date__gt=datetime.date(2019, 3, 2), gender=1))
+        self.assertEqual(self._matrix({'start_date_gt': '2019-03-02', 'gender': 1}), expected)
+
+    def test_od_matrix_cached(self):
+        get_summary_cache().clear()
+        self._matrix({'k': 5})
+        with CaptureQueriesContext(connection) as queries:
+            self._matrix({'k': 5})
+        self.assertFalse([q for q in queries if 'FROM "apis_trip"' in q['sql']])
+
+        # the other parameters and the summary don't share the entry
+        with CaptureQueriesContext(connection) as queries:
+            self._matrix({'k': 4})
+        self.assertTrue([q for q in queries if 'FROM "apis_trip"' in q['sql']])
+
+    def test_od_matrix_columnar(self):
+        response = self.client.get('/apis/trips/od_matrix/', {'format': 'columnar', 'k': 5})
+        metadata, rows = decode_columnar(response.content)
+        self.assertEqual([(row['start_station'], row['stop_station'], row['count'], row['avg_duration']) for row in rows], self._matrix({'k': 5}))
+
+    def test_od_matrix_invalid_params(self):
+        response = self.client.get('/apis/trips/od_matrix/', {'k': 0}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TripImportTests(TestCase):
+    fixtures = ['TripImportTests/stations']
+
+    csv_file = os.path.join(FIXTURES_DIR, 'TripImportTests', '201903-bluebikes-tripdata.csv')
+
+    def test_import_bulk(self):
+        stats = import_files([self.csv_file], mode='bulk', batch_size=5)
+        self.assertEqual(stats.rows, 21)
+        self.assertEqual(stats.files, 1)
+        self.assertEqual(Trip.objects.count(), 21)
+
+        trip = Trip.objects.get(bike_id=3571)
+        self.assertEqual(trip.duration, 1171)
+        self.assertEqual(trip.start_station_id, 190)
+        self.assertEqual(trip.stop_station_id, 3)
+        self.assertEqual(trip.start_date, datetime.date(2019, 3, 1))
+        self.assertEqual(trip.stop_date, datetime.date(2019, 3, 1))
+        self.assertTrue(trip.is_subscriber)
+        self.assertEqual(trip.birth_year, 1984)
+        self.assertEqual(trip.gender, 1)
+
+    def test_import_bulk_same_as_rowwise(self):
+        import_files([self.csv_file], mode='rowwise')
+        fields = ('duration', 'start_time', 'stop_time', 'start_date', 'stop_date', 'start_station', 'stop_station', 'bike_id', 'is_subscriber', 'birth_year', 'gender')
+        expected = sorted(Trip.objects.values_list(*fields))
+
+        Trip.objects.all().delete()
+        ImportedFile.objects.all().delete()
+        import_files([self.csv_file], mode='bulk')
+        self.assertEqual(sorted(Trip.objects.values_list(*fields)), expected)
+
+    def test_import_bulk_queries(self):
+        # the ledger entry is created, station ids are loaded once, and each batch is inserted with its checkpoint
+        with CaptureQueriesContext(connection) as queries:
+            import_files([self.csv_file], mode='bulk', batch_size=10)
+        statements = [q['sql'].split()[0] for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE')) and 'triprollup' not in q['sql'] and 'dataversion' not in q['sql']]
+        self.assertEqual(statements, ['SELECT', 'INSERT', 'SELECT'] + ['INSERT', 'UPDATE'] * 3 + ['UPDATE'])
+
+    def test_import_bumps_version_once(self):
+        # the batches don't write the version, which the parallel writers would queue on
+        version = get_data_version()[0]
+        import_files([self.csv_file], batch_size=5)
+        self.assertEqual(get_data_version()[0], version + 1)
+
+    def test_import_unknown_stations(self):
+        Station.objects.filter(pk=190).delete()
+        stats = import_files([self.csv_file], mode='bulk')
+        self.assertEqual(stats.unknown_stations, {190})
+        self.assertEqual(Trip.objects.filter(start_station_id=190).count(), 1)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', 'COPY is used only on PostgreSQL')
+    def test_import_copy_same_as_insert(self):
+        with override_settings(TRIP_IMPORT={'COPY': False}):
+            import_files([self.csv_file], mode='bulk')
+        fields = ('duration', 'start_time', 'stop_time', 'start_date', 'stop_date', 'start_station', 'stop_station', 'bike_id', 'is_subscriber', 'birth_year', 'gender')
+        expected = sorted(Trip.objects.values_list(*fields))
+
+        Trip.objects.all().delete()
+        ImportedFile.objects.all().delete()
+        import_files([self.csv_file], mode='bulk', batch_size=5)
+        self.assertEqual(sorted(Trip.objects.values_list(*fields)), expected)
+
+    def test_import_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            import_files([self.csv_file], mode='unknown')
+
+    def _archive_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+    def test_import_zip(self):
+        filename = os.path.join(self._archive_dir(), '201903-bluebikes-tripdata.zip')
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(self.csv_file, '201903-bluebikes-tripdata.csv')
+
+        stats = import_files([filename])
+        self.assertEqual(stats.rows, 21)
+        self.assertEqual(Trip.objects.count(), 21)
+
+    def test_import_gzip(self):
+        filename = os.path.join(self._archive_dir(), '201903-bluebikes-tripdata.csv.gz')
+        with open(self.csv_file, 'rb') as src, gzip.open(filename, 'wb') as dest:
+            shutil.copyfileobj(src, dest)
+
+        stats = import_files([filename])
+        self.assertEqual(stats.rows, 21)
+        self.assertEqual(Trip.objects.filter(start_date=datetime.date(2019, 3, 3)).count(), 6)
+
+    def test_import_invalid_rows(self):
+        filename = os.path.join(self._archive_dir(), 'invalid.csv')
+        with open(self.csv_file, 'rb') as src, open(filename, 'wb') as dest:
+            shutil.copyfileobj(src, dest)
+            dest.write(b'"abc","2019-03-06 10:18:50.6110","2019-03-06 10:24:39.0460","12"\r\n')
+
+        stats = import_files([filename])
+        self.assertEqual(stats.rows, 21)
+        self.assertEqual(stats.invalid_rows, 1)
+
+    def test_find_data_files(self):
+        directory = self._archive_dir()
+        for name in ('201901-bluebikes-tripdata.zip', '201902-bluebikes-tripdata.csv.gz', '201903-bluebikes-tripdata.csv', 'README.txt'):
+            open(os.path.join(directory, name), 'w').close()
+
+        self.assertEqual([os.path.basename(f) for f in find_data_files(directory)], [
+            '201901-bluebikes-tripdata.zip', '201902-bluebikes-tripdata.csv.gz', '201903-bluebikes-tripdata.csv'])
+
+    def test_import_trips_command(self):
+        call_command('import_trips', self.csv_file, batch_size=7, stdout=six.StringIO())
+        self.assertEqual(Trip.objects.count(), 21)
+
+    def test_import_parallel(self):
+        directory = self._archive_dir()
+        files = []
+        for month in ('201903', '201904', '201905'):
+            filename = os.path.join(directory, month + '-bluebikes-tripdata.csv')
+            shutil.copy(self.csv_file, filename)
+            files.append(filename)
+
+        progress = []
+        stats = import_files(files, batch_size=5, workers=2, progress=lambda f, s: progress.append((f, s.rows)))
+        self.assertEqual(stats.rows, 63)
+        self.assertEqual(stats.files, 3)
+        self.assertEqual(sorted(progress), [(f, 21) for f in files])
+        self.assertEqual(Trip.objects.count(), 63)
+        self.assertEqual(Trip.objects.filter(bike_id=3571).count(), 3)
+
+    def test_import_ledger(self):
+        import_files([self.csv_file], batch_size=10)
+
+        entry = ImportedFile.objects.get(name='201903-bluebikes-tripdata.csv')
+        self.assertEqual(entry.size, os.path.getsize(self.csv_file))
+        self.assertEqual(len(entry.sha1), 40)
+        self.assertEqual(entry.row_offset, 21)
+        self.assertEqual(entry.row_count, 21)
+        self.assertTrue(entry.completed)
+
+    def test_import_again_is_noop(self):
+        import_files([self.csv_file])
+        with CaptureQueriesContext(connection) as queries:
+            stats = import_files([self.csv_file])
+        self.assertEqual(stats.rows, 0)
+        self.assertEqual(stats.skipped_files, [self.csv_file])
+        self.assertEqual(len(queries), 1) # only the lookup of the ledger
+        self.assertEqual(Trip.objects.count(), 21)
+
+    def test_import_resume_from_checkpoint(self):
+        # simulate a crash after committing the first 2 batches of 5 trips
+        import_files([self.csv_file], batch_size=5)
+        entry = ImportedFile.objects.get()
+        Trip.objects.filter(pk__in=Trip.objects.order_by('-pk').values_list('pk', flat=True)[:11]).delete()
+        ImportedFile.objects.filter(pk=entry.pk).update(row_offset=10, row_count=10, completed=False)
+
+        stats = import_files([self.csv_file], batch_size=5)
+        self.assertEqual(stats.rows, 11)
+        self.assertEqual(Trip.objects.count(), 21)
+        self.assertEqual(Trip.objects.filter(bike_id=2678).count(), 1)
+        entry = ImportedFile.objects.get()
+        self.assertEqual((entry.row_offset, entry.row_count, entry.completed), (21, 21, True))
+
+    def test_import_rowwise_checkpoints(self):
+        # the 13th trip can't be parsed, so the import stops after committing the first 2 batches of 5 trips
+        filename = os.path.join(self._archive_dir(), '201903-bluebikes-tripdata.csv')
+        with io.open(self.csv_file, encoding='utf-8') as f:
+            lines = f.readlines()
+        lines[13] = '"x"' + lines[13][lines[13].index(','):]
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+
+        with self.assertRaises(ValueError):
+            import_files([filename], mode='rowwise', batch_size=5)
+        entry = ImportedFile.objects.get()
+        self.assertEqual((entry.row_offset, entry.row_count, entry.completed), (10, 10, False))
+        self.assertEqual(Trip.objects.count(), 10)
+
+    def test_import_again_without_hashing(self):
+        filename = os.path.join(self._archive_dir(), '201903-bluebikes-tripdata.csv')
+        shutil.copy(self.csv_file, filename)
+        import_files([filename])
+
+        # the hash isn't compared while the size and the modification time are the same
+        ImportedFile.objects.update(sha1='0' * 40)
+        self.assertEqual(import_files([filename]).skipped_files, [filename])
+
+        mtime = os.path.getmtime(filename)
+        os.utime(filename, (mtime + 10, mtime + 10))
+        self.assertEqual(import_files([filename]).changed_files, [filename])
+
+    def test_import_changed_file(self):
+        ImportedFile.objects.create(name='201903-bluebikes-tripdata.csv', size=1, sha1='0' * 40, completed=True)
+        stats = import_files([self.csv_file])
+        self.assertEqual(stats.rows, 0)
+        self.assertEqual(stats.changed_files, [self.csv_file])
+        self.assertEqual(Trip.objects.count(), 0)
+
+    def test_import_parallel_new_files_only(self):
+        directory = self._archive_dir()
+        files = [os.path.join(directory, month + '-bluebikes-tripdata.csv') for month in ('201903', '201904', '201905')]
+        for filename in files:
+            shutil.copy(self.csv_file, filename)
+        import_files(files[:1])
+
+        stats = import_files(files, workers=2)
+        self.assertEqual(stats.rows, 42)
+        self.assertEqual(stats.skipped_files, files[:1])
+        self.assertEqual(Trip.objects.count(), 63)
+        self.assertEqual(ImportedFile.objects.filter(completed=True, row_count=21).count(), 3)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'SQLite allows only one writer at a time')
+class ConcurrentWriterTests(TransactionTestCase):
+    THREADS = 4
+
+    def _run_concurrently(self, target):
+        # every thread writes through its own connection, in its own transaction
+        start = threading.Event()
+        errors = []
+
+        def run():
+            try:
+                start.wait()
+                with transaction.atomic():
+                    target()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_bump_data_version(self):
+        self._run_concurrently(lambda: bump_data_version('concurrent'))
+        self.assertEqual(get_data_version('concurrent')[0], self.THREADS)
+
+    def test_add_trips(self):
+        start_time = timezone.make_aware(datetime.datetime(2019, 3, 1, 8, 30))
+        trips = [Trip(start_time=start_time, start_date=start_time.date(), start_station_id=station_id, gender=1, is_subscriber=True, birth_year=1990, duration=600, bike_id=station_id)
+                 for station_id in (3, 4, 3)]
+        self._run_concurrently(lambda: add_trips(trips))
+
+        self.assertEqual(DailyTripRollup.objects.get().count, 3 * self.THREADS)
+        self.assertEqual(sorted(HourlyTripRollup.objects.values_list('start_station', 'count')), [(3, 2 * self.THREADS), (4, self.THREADS)])
+
+
+class SyntheticDataTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _generate(self, directory, **options):
+        call_command('gen_synthetic_trips', directory, stdout=six.StringIO(), **dict(dict(trips=400, months=2, stations=20, bikes=50, seed=1), **options))
+        return sorted(os.listdir(directory))
+
+    def test_generate_and_import(self):
+        names = self._generate(self.directory, load_stations=True)
+        self.assertEqual(names, ['201901-bluebikes-tripdata.csv', '201902-bluebikes-tripdata.csv', 'station_information.json', 'system_regions.json'])
+        self.assertEqual(Station.objects.filter(station_id__gte=STATION_ID_BASE).count(), 20)
+
+        with io.open(os.path.join(self.directory, '201901-bluebikes-tripdata.csv'), encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(len(rows[0]), 15)
+        self.assertTrue(all(len(row) == 15 for row in rows))
+        self.assertEqual([row[1] for row in rows[1:]], sorted(row[1] for row in rows[1:]))
+
+        stats = import_files(find_data_files(self.directory))
+        self.assertEqual((stats.rows, stats.invalid_rows, stats.unknown_stations), (400, 0, set()))
+        self.assertEqual(Trip.objects.filter(start_date__month=1).count(), len(rows) - 1)
+
+    def test_seeded(self):
+        other = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other)
+        self._generate(self.directory)
+        self._generate(other)
+        for name in ('201901-bluebikes-tripdata.csv', 'station_information.json'):
+            with io.open(os.path.join(self.directory, name), 'rb') as a, io.open(os.path.join(other, name), 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+
+        self._generate(other, seed=2)
+        with io.open(os.path.join(self.directory, '201901-bluebikes-tripdata.csv'), 'rb') as a, io.open(os.path.join(other, '201901-bluebikes-tripdata.csv'), 'rb') as b:
+            self.assertNotEqual(a.read(), b.read())
+
+    def test_bench_load(self):
+        self._generate(self.directory)
+        results = bench_load(repeat=1, data=self.directory, requests=2)
+
+        self.assertEqual(results['imports']['bulk']['rows'], 400)
+        self.assertIn('rowwise', results['imports'])
+        self.assertEqual(set(results['endpoints']['summary_by_date']), set(['p50_ms', 'p99_ms', 'requests_per_sec', 'path', 'params']))
+        self.assertEqual(len(results['endpoints']), 13)
+        # every change is rolled back
+        self.assertFalse(Trip.objects.exists())
+        self.assertFalse(Station.objects.filter(station_id__gte=STATION_ID_BASE).exists())
+
+    def test_bench_sketches(self):
+        results = bench_sketches(rows=300, repeat=1)
+
+        self.assertEqual(set(results), set(['percentiles_by_date', 'percentiles_by_station', 'distinct_bikes_by_hour']))
+        self.assertEqual(set(results['percentiles_by_station']),
+                         set(['params', 'rollup_rows', 'rollups_ms', 'rollups_unlimited_ms', 'without_rollups_ms']))
+        self.assertTrue(results['percentiles_by_date']['rollup_rows'])
+        self.assertFalse(Trip.objects.exists())
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'The pragmas are applied only to SQLite connections')
+class SQLitePragmaTests(TestCase):
+
+    def _pragmas(self, *names):
+        return read_pragmas(connection.connection, names)
+
+    def test_connection_pragmas(self):
+        connection.ensure_connection()
+        # 1 is NORMAL of synchronous and 2 is MEMORY of temp_store
+        self.assertEqual(self._pragmas('busy_timeout', 'cache_size', 'synchronous', 'temp_store'),
+                         {'busy_timeout': 5000, 'cache_size': -65536, 'synchronous': 1, 'temp_store': 2})
+
+    def test_wal_on_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        raw_connection = sqlite3.connect(os.path.join(directory, 'test.sqlite3'), isolation_level=None)
+        try:
+            values = apply_pragmas(raw_connection, SQLITE_PRAGMA_DEFAULTS)
+            self.assertEqual(values['journal_mode'], 'wal')
+            self.assertEqual(read_pragmas(raw_connection, ['journal_mode', 'mmap_size']), {'journal_mode': 'wal', 'mmap_size': 268435456})
+            # the import keeps synchronous at NORMAL (1), which can't corrupt the database in WAL mode
+            apply_pragmas(raw_connection, SQLITE_BULK_LOAD_DEFAULTS)
+            self.assertEqual(read_pragmas(raw_connection, ['synchronous']), {'synchronous': 1})
+        finally:
+            raw_connection.close()
+
+    def test_bulk_load(self):
+        connection.ensure_connection()
+        with bulk_load():
+            self.assertEqual(self._pragmas('cache_size', 'wal_autocheckpoint'), {'cache_size': -262144, 'wal_autocheckpoint': 100000})
+            # synchronous can't be changed in the transaction of the test
+            self.assertEqual(self._pragmas('synchronous'), {'synchronous': 1})
+        self.assertEqual(self._pragmas('cache_size', 'wal_autocheckpoint'), {'cache_size': -65536, 'wal_autocheckpoint': 1000})
+
+    def test_bulk_load_restored_on_error(self):
+        connection.ensure_connection()
+        with self.assertRaises(ValueError):
+            with bulk_load():
+                raise ValueError
+        self.assertEqual(self._pragmas('cache_size'), {'cache_size': -65536})
+
+    def test_invalid_pragma(self):
+        with self.assertRaises(ImproperlyConfigured):
+            apply_pragmas(connection.connection, {'cache_size': '1; DROP TABLE apis_trip'})
+
+    def test_bench_concurrent_reads(self):
+        results = bench_concurrent_reads(rows=2000, repeat=1, readers=2)
+        self.assertEqual(set(results), set(['rollback_journal', 'tuned']))
+        for result in results.values():
+            self.assertTrue(result['write']['rows_per_sec'] > 0)
+            self.assertEqual(set(result), set(['write', 'reads', 'read_p50_ms', 'read_p99_ms', 'read_max_ms', 'locked_errors', 'pragmas', 'bulk_load_pragmas']))
+        self.assertEqual(results['tuned']['pragmas']['journal_mode'], 'WAL')
+
+
+@unittest.skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'Trips are partitioned only on SQLite and PostgreSQL')
+@override_settings(TRIP_PARTITIONS={'ENABLED': True}, TRIP_ROLLUPS=False)
+class TripPartitionTests(APITestCase):
+
+    MONTHS = [datetime.date(2019, 1, 1), datetime.date(2019, 2, 1), datetime.date(2019, 3, 1)]
+
+    PARAMS = [
+        {},
+        {'start_date_gt': '2019-01-31', 'start_date_lt': '2019-03-01'},
+        {'start_time_gt': '2019-02-20 00:00:00', 'start_time_lt': '2019-03-10 00:00:00', 'ordering': '-duration'},
+        {'start_date': '2019-03-02', 'gender': 1},
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        call_command('gen_synthetic_trips', self.directory, stdout=six.StringIO(), trips=300, months=3, stations=20, bikes=50, seed=1, load_stations=True)
+        get_summary_cache().clear()
+
+    def _get(self, path, params):
+        response = self.client.get(path, dict(params, limit=1000), format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def _responses(self):
+        get_summary_cache().clear()
+        return [(self._get('/apis/trips/', params), self._get('/apis/trips/', dict(params, cursor='')),
+                 self._get('/apis/trips/summary/', dict(params, group_by='start_date,gender'))) for params in self.PARAMS]
+
+    def _partition_count(self, month):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM {}'.format(partition_name(month)))
+            return cursor.fetchone()[0]
+
+    def _trip_queries(self, path, params):
+        with CaptureQueriesContext(connection) as queries:
+            data = self._get(path, params)
+        # the queries of trips, not of the catalog
+        return data, [q['sql'] for q in queries if 'apis_trip' in q['sql'] and 'sqlite_master' not in q['sql'] and 'pg_' not in q['sql']]
+
+    def test_import_into_partitions(self):
+        stats = import_files(find_data_files(self.directory))
+        self.assertEqual(stats.rows, 300)
+        self.assertTrue(is_partitioned())
+        self.assertEqual(list_partitions(), self.MONTHS)
+        for month in self.MONTHS:
+            self.assertEqual(self._partition_count(month), Trip.objects.filter(start_date__month=month.month).count())
+        # the ids are assigned over the partitions. The sequences of PostgreSQL aren't reset between the tests
+        pks = sorted(Trip.objects.values_list('pk', flat=True))
+        self.assertEqual(pks, list(range(pks[0], pks[0] + 300)))
+
+    def test_convert_same_responses(self):
+        with self.settings(TRIP_PARTITIONS={'ENABLED': False}):
+            import_files(find_data_files(self.directory))
+            expected = self._responses()
+        self.assertFalse(is_partitioned())
+
+        call_command('partition_trips', stdout=six.StringIO())
+        self.assertEqual(list_partitions(), self.MONTHS)
+        self.assertEqual(self._responses(), expected)
+
+    def test_pruning(self):
+        import_files(find_data_files(self.directory))
+
+        data, queries = self._trip_queries('/apis/trips/', {'start_date_gt': '2019-01-31', 'start_date_lt': '2019-03-01'})
+        self.assertEqual(data['count'], Trip.objects.filter(start_date__month=2).count())
+        self.assertTrue(queries)
+        for sql in queries:
+            self.assertIn('apis_trip_201902', sql)
+            self.assertNotIn('apis_trip_201901', sql)
+            self.assertNotIn('apis_trip_201903', sql)
+
+        data, queries = self._trip_queries('/apis/trips/summary/', {'group_by': 'gender', 'start_time_gt': '2019-02-20 00:00:00'})
+        self.assertEqual(sum(row['count'] for row in data), Trip.objects.filter(start_time__gt=make_aware_datetime('2019-02-20 00:00:00')).count())
+        self.assertTrue(queries)
+        self.assertTrue(all('apis_trip_201901' not in sql and 'apis_trip_201903' in sql for sql in queries))
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'PostgreSQL prunes the partitions of the queries by itself')
+    def test_pruning_without_partitions(self):
+        import_files(find_data_files(self.directory))
+        data, queries = self._trip_queries('/apis/trips/', {'start_date_gt': '2020-01-01'})
+        self.assertEqual(data['count'], 0)
+        self.assertEqual(queries, [])
+
+    def test_drop_and_reload(self):
+        import_files(find_data_files(self.directory))
+        february = Trip.objects.filter(start_date__month=2).count()
+        self.assertTrue(drop_partition(datetime.date(2019, 2, 1)))
+
+        self.assertEqual(list_partitions(), [self.MONTHS[0], self.MONTHS[2]])
+        self.assertEqual(Trip.objects.count(), 300 - february)
+        self.assertFalse(Trip.objects.filter(start_date__month=2).exists())
+        self.assertFalse(DailyTripRollup.objects.filter(start_date__month=2).exists())
+        self.assertFalse(ImportedFile.objects.filter(name__startswith='201902').exists())
+        self.assertFalse(drop_partition(datetime.date(2019, 2, 1)))
+
+        stats = import_files(find_data_files(self.directory))
+        self.assertEqual((stats.rows, len(stats.skipped_files)), (february, 2))
+        self.assertEqual(list_partitions(), self.MONTHS)
+        self.assertEqual(Trip.objects.count(), 300)
+        self.assertEqual(len(set(Trip.objects.values_list('pk', flat=True))), 300)
+
+    def test_drop_by_trip_dates(self):
+        # the ledger entries are found by the dates of their trips, not by the names of the files
+        for name in os.listdir(self.directory):
+            if name.endswith('-bluebikes-tripdata.csv'):
+                os.rename(os.path.join(self.directory, name), os.path.join(self.directory, 'trips-' + name))
+        import_files(find_data_files(self.directory))
+        entry = ImportedFile.objects.get(name='trips-201902-bluebikes-tripdata.csv')
+        february = Trip.objects.filter(start_date__month=2).aggregate(first=Min('start_date'), last=Max('start_date'))
+        self.assertEqual((entry.first_date, entry.last_date), (february['first'], february['last']))
+
+        self.assertTrue(drop_partition(datetime.date(2019, 2, 1)))
+        self.assertEqual(sorted(ImportedFile.objects.values_list('name', flat=True)),
+                         ['trips-201901-bluebikes-tripdata.csv', 'trips-201903-bluebikes-tripdata.csv'])
+        stats = import_files(find_data_files(self.directory))
+        self.assertEqual(len(stats.skipped_files), 2)
+        self.assertEqual(Trip.objects.count(), 300)
+
+    def test_save_through_orm(self):
+        import_files(find_data_files(self.directory))
+        station = Station.objects.filter(station_id__gte=STATION_ID_BASE).first()
+        trip = Trip(duration=600, start_time=make_aware_datetime('2019-05-01T08:00:00'), stop_time=make_aware_datetime('2019-05-01T08:10:00'),
+                    start_station=station, stop_station=station, bike_id=1, is_subscriber=True, birth_year=1990, gender=1)
+        last = Trip.objects.aggregate(pk=Max('pk'))['pk']
+        trip.save()
+        self.assertEqual(trip.pk, last + 1)
+        self.assertEqual(list_partitions()[-1], datetime.date(2019, 5, 1))
+        self.assertEqual(Trip.objects.get(pk=trip.pk).duration, 600)
+
+        trip.duration = 700
+        trip.save()
+        self.assertEqual(Trip.objects.get(pk=trip.pk).duration, 700)
+
+        # the trip moves to the partition of its new month
+        trip.start_time = make_aware_datetime('2019-01-05T08:00:00')
+        trip.save()
+        self.assertEqual(Trip.objects.get(pk=trip.pk).start_date, datetime.date(2019, 1, 5))
+        self.assertEqual(self._partition_count(datetime.date(2019, 5, 1)), 0)
+        self.assertEqual(Trip.objects.count(), 301)
+
+        trip.delete()
+        self.assertFalse(Trip.objects.filter(pk=trip.pk).exists())
+        self.assertEqual(Trip.objects.count(), 300)
+
+    def test_select_on_save(self):
+        self.assertEqual(Trip._meta.select_on_save, connection.vendor == 'sqlite')
+        with self.settings(TRIP_PARTITIONS={'ENABLED': False}):
+            self.assertFalse(Trip._meta.select_on_save)
+
+    def test_convert_refused_with_unapplied_migrations(self):
+        recorder = MigrationRecorder(connection)
+        name = max(name for app, name in recorder.applied_migrations() if app == 'apis')
+        recorder.record_unapplied('apis', name)
+        with self.assertRaises(ImproperlyConfigured):
+            convert_to_partitions()
+        self.assertFalse(is_partitioned())
+
+    def test_command_requires_setting(self):
+        with self.settings(TRIP_PARTITIONS={'ENABLED': False}):
+            with self.assertRaises(CommandError):
+                call_command('partition_trips', stdout=six.StringIO())
+
+        out = six.StringIO()
+        call_command('partition_trips', stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[0], 'Converted trips to 0 partitions')
+        call_command('partition_trips', '--drop', '2019-02', stdout=out)
+        self.assertIn('2019-02 has no partition', out.getvalue())
+
+
+class TimestampTests(TestCase):
+
+    def test_parse_timestamp(self):
+        for value in ('2019-03-01 00:00:34.6490', '2019-03-10 03:00:00.0000', '2019-07-04 23:59:59.9999', '2019-11-03 02:10:00.5000', '2019-12-31 12:00:00'):
+            self.assertEqual(parse_timestamp(value), make_aware_datetime(value))
+            self.assertEqual(parse_timestamp(value).utcoffset(), make_aware_datetime(value).utcoffset())
+
+    def test_parse_timestamp_dst(self):
+        self.assertEqual(parse_timestamp('2019-03-10 01:59:59.0000').utcoffset(), datetime.timedelta(hours=-5))
+        self.assertEqual(parse_timestamp('2019-03-10 03:00:00.0000').utcoffset(), datetime.timedelta(hours=-4))
+        self.assertEqual(parse_timestamp('2019-11-03 00:59:59.0000').utcoffset(), datetime.timedelta(hours=-4))
+        self.assertEqual(parse_timestamp('2019-11-03 02:00:00.0000').utcoffset(), datetime.timedelta(hours=-5))
+
+    def test_parse_timestamp_ambiguous(self):
+        # make_aware raises errors for these local times. They are resolved as standard time
+        self.assertEqual(parse_timestamp('2019-11-03 01:30:00.0000').utcoffset(), datetime.timedelta(hours=-5))
+        self.assertEqual(parse_timestamp('2019-03-10 02:30:00.0000').utcoffset(), datetime.timedelta(hours=-5))
+
+    def test_parse_timestamps_ambiguous(self):
+        # 01:30 is repeated when DST ends. Both the single values and the chunks are pinned to standard time
+        values = ['2019-11-03 01:30:00.0000'] * NUMPY_MIN_SIZE + ['2019-11-03 00:59:59.0000']
+        expected = datetime.datetime(2019, 11, 3, 6, 30, tzinfo=timezone.utc)
+        self.assertEqual(parse_timestamp(values[0]), expected)
+        parsed = parse_timestamps(values)
+        self.assertEqual(parsed[:-1], [expected] * NUMPY_MIN_SIZE)
+        self.assertEqual(set(value.utcoffset() for value in parsed[:-1]), {datetime.timedelta(hours=-5)})
+        self.assertEqual(parsed[-1], datetime.datetime(2019, 11, 3, 4, 59, 59, tzinfo=timezone.utc))
+
+    def test_parse_timestamp_invalid(self):
+        for value in ('', '2019-03-01', '2019/03/01 00:00:34.6490', '2019-03-01 00:00:3x'):
+            with self.assertRaises(ValueError):
+                parse_timestamp(value)
+
+    def test_parse_timestamps(self):
+        values = ['2019-{:02d}-{:02d} {:02d}:{:02d}:07.{:04d}'.format(m, d, h, h * 2, m * d) for m in (3, 7, 11) for d in (1, 3, 10) for h in range(0, 24, 3)]
+        self.assertEqual(parse_timestamps(values), [make_aware_datetime(v) for v in values])
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_parse_timestamps_invalid(self):
+        values = ['2019-03-01 00:00:34.6490'] * 100 + ['2019-03-01']
+        with self.assertRaises(ValueError):
+            parse_timestamps(values)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class BitmapTests(TestCase):
+
+    def setUp(self):
+        self.random = random.Random(19)
+
+    def _positions(self):
+        # a sparse chunk, a dense chunk (bitset) and a chunk far away
+        positions = set(self.random.sample(range(0, 65536), 100))
+        positions |= set(self.random.sample(range(65536, 131072), 30000))
+        positions |= set(self.random.sample(range(10 * 65536, 11 * 65536), 4096))
+        return positions
+
+    def test_bitmap(self):
+        a, b = self._positions(), self._positions()
+        bitmap_a, bitmap_b = Bitmap.from_positions(sorted(a)), Bitmap.from_positions(sorted(b))
+        self.assertEqual(len(bitmap_a), len(a))
+        self.assertEqual(bitmap_a.to_positions().tolist(), sorted(a))
+        self.assertEqual((bitmap_a & bitmap_b).to_positions().tolist(), sorted(a & b))
+        self.assertEqual((bitmap_a | bitmap_b).to_positions().tolist(), sorted(a | b))
+        # the dense chunk is kept as a bitset of 8192 bytes
+        self.assertEqual(bitmap_a.containers[1].nbytes, 8192)
+        self.assertEqual(bitmap_a.containers[10].nbytes, 8192)
+        self.assertEqual(len(Bitmap() & bitmap_a), 0)
+
+    def test_bitmap_index(self):
+        column = numpy.array([self.random.choice((-1, 1950, 1980, 1990, 2000)) for i in range(200000)], dtype='int16')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        BitmapIndex.build(column).save(directory, 'birth_year')
+        index = BitmapIndex.load(directory, 'birth_year')
+
+        self.assertEqual(index.values.tolist(), [-1, 1950, 1980, 1990, 2000])
+        self.assertEqual(index.equal(1980).to_positions().tolist(), numpy.flatnonzero(column == 1980).tolist())
+        self.assertEqual(len(index.equal(1985)), 0)
+        self.assertEqual(index.range(lower=1950).to_positions().tolist(), numpy.flatnonzero(column > 1950).tolist())
+        self.assertEqual(index.range(lower=-1, upper=1990).to_positions().tolist(), numpy.flatnonzero((column > -1) & (column < 1990)).tolist())
+        combined = index.range(upper=1990) & index.range(lower=1950)
+        self.assertEqual(len(combined), int(((column > 1950) & (column < 1990)).sum()))
+
+
+class SketchTests(TestCase):
+
+    def setUp(self):
+        self.random = random.Random(17)
+
+    def test_tdigest_quantiles(self):
+        values = [self.random.lognormvariate(6.5, 0.8) for i in range(20000)]
+        digest = TDigest()
+        for value in values:
+            digest.add(value)
+        values.sort()
+        for q in (0.01, 0.1, 0.5, 0.9, 0.95, 0.99):
+            # the errors are measured in ranks
+            rank = bisect.bisect_left(values, digest.quantile(q)) / float(len(values))
+            self.assertAlmostEqual(rank, q, delta=0.01 if q in (0.1, 0.5, 0.9) else 0.005)
+        self.assertEqual(digest.count, len(values))
+        self.assertLess(len(digest.centroids), 100)
+
+    def test_tdigest_merge_serialized(self):
+        values = [self.random.randint(60, 7200) for i in range(5000)]
+        merged = TDigest()
+        for i in range(0, len(values), 37):
+            digest = TDigest()
+            for value in values[i:i + 37]:
+                digest.add(value)
+            merged.merge(TDigest.from_bytes(digest.to_bytes()))
+        values.sort()
+        self.assertEqual((merged.min, merged.max, merged.count), (values[0], values[-1], len(values)))
+        for q in (0.5, 0.95, 0.99):
+            self.assertAlmostEqual(merged.quantile(q), percentile(values, q), delta=(values[-1] - values[0]) * 0.01)
+
+    def test_tdigest_small(self):
+        digest = TDigest()
+        self.assertIsNone(digest.quantile(0.5))
+        for value in (30, 10, 20):
+            digest.add(value)
+        digest = TDigest.from_bytes(digest.to_bytes())
+        self.assertEqual([digest.quantile(q) for q in (0, 0.5, 1)], [10, 20, 30])
+
+    def test_hyperloglog(self):
+        for n in (0, 1, 10, 1000, 100000):
+            sketch = HyperLogLog()
+            for i in range(n):
+                sketch.add(i)
+                sketch.add(i) # duplicates are ignored
+            self.assertAlmostEqual(sketch.cardinality(), n, delta=max(n * 0.05, 0.5))
+
+    def test_hyperloglog_merge_serialized(self):
+        merged = HyperLogLog()
+        for start in range(0, 50000, 5000):
+            sketch = HyperLogLog()
+            # overlapping ranges of ids
+            for i in range(start, start + 10000):
+                sketch.add(i)
+            data = sketch.to_bytes()
+            self.assertEqual(HyperLogLog.from_bytes(data).registers, sketch.registers)
+            merged.merge(HyperLogLog.from_bytes(data))
+        self.assertAlmostEqual(merged.cardinality(), 55000, delta=55000 * 0.05)
+
+        # the registers of a few values are stored sparsely
+        sketch = HyperLogLog()
+        for i in range(10):
+            sketch.add(i)
+        self.assertEqual(len(sketch.to_bytes()), 2 + 3 * len(sketch.registers))
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is specific to SQLite')
+class TripIndexTests(APITestCase):
+    fixtures = ['TripSummaryTests/stations', 'TripSummaryTests/trips']
+
+    def _query_plans(self, path, params):
+        """
+        Return the query plans (lists of plan details) of the trip queries executed for the request
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path, params, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        plans = []
+        with connection.cursor() as cursor:
+            for query in queries:
+                if 'FROM "apis_trip"' in query['sql']:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                    plans.append([row[-1] for row in cursor.fetchall()])
+        self.assertTrue(plans)
+        return plans
+
+    def assertUseIndex(self, path, params, index):
+        for plan in self._query_plans(path, params):
+            self.assertTrue(any(('INDEX ' + index) in detail for detail in plan), plan)
+            # neither full table scans nor sorts for GROUP BY
+            self.assertFalse([detail for detail in plan if detail in ('SCAN apis_trip', 'SCAN TABLE apis_trip') or 'TEMP B-TREE FOR GROUP BY' in detail], plan)
+
+    def test_summary_filter_by_subscriber(self):
+        self.assertUseIndex('/apis/trips/summary/', {'group_by': 'start_date', 'is_subscriber': 'true'}, 'trip_start_date_subscr_idx')
+
+    def test_summary_filter_by_gender(self):
+        self.assertUseIndex('/apis/trips/summary/', {'group_by': 'start_date', 'gender': 1}, 'trip_start_date_gender_idx')
+
+    def test_summary_duration_by_date(self):
+        self.assertUseIndex('/apis/trips/summary/', {'group_by': 'start_date', 'agg': 'avg', 'field': 'duration', 'start_date_gt': '2019-03-02'}, 'trip_start_date_duration_idx')
+
+    def test_list_start_time_range(self):
+        self.assertUseIndex('/apis/trips/', {'start_time_gt': '2019-03-04', 'start_time_lt': '2019-03-05'}, 'trip_start_time_idx')
+
+    def test_list_start_station_and_time(self):
+        self.assertUseIndex('/apis/trips/', {'start_station': 43, 'start_time_gt': '2019-03-04'}, 'trip_start_station_time_idx')
+
+    def test_list_duration_range(self):
+        self.assertUseIndex('/apis/trips/', {'duration_gt': 4000}, 'trip_duration_idx')
+
+    def test_list_keyset_page(self):
+        # the keys of the previous page are sought in the index instead of skipping rows
+        next_link = self.client.get('/apis/trips/', {'cursor': '', 'limit': 5}, format='json').data['next']
+        self.assertUseIndex(next_link, {}, 'trip_start_time_idx')
+
+
+class TripRollupTests(APITestCase):
+    fixtures = ['TripImportTests/stations']
+
+    csv_file = os.path.join(FIXTURES_DIR, 'TripImportTests', '201903-bluebikes-tripdata.csv')
+
+    PARAMS = [
+        {'group_by': 'start_date'},
+        {'group_by': 'start_date', 'agg': 'count,max,min,avg,sum', 'field': 'duration'},
+        {'group_by': 'gender', 'agg': 'avg', 'field': 'duration', 'start_date_gt': '2019-03-01', 'start_date_lt': '2019-03-05'},
+        {'group_by': 'birth_year', 'is_subscriber': 'true', 'birth_year_gt': 1985},
+        {'group_by': 'start_station', 'agg': 'sum,count', 'field': 'duration', 'gender': 1},
+        {'group_by': 'start_date', 'start_station': 43},
+        {'group_by': 'start_date', 'start_date': '2020-03-01'},
+        # the empty parameters sent by the dashboard are ignored
+        {'group_by': 'start_date', 'is_subscriber': '', 'gender': '', 'duration_gt': ''},
+        {'group_by': 'start_weekday', 'agg': 'count,max,min,avg,sum', 'field': 'duration', 'is_subscriber': 'true'},
+        {'group_by': 'start_month', 'gender': 1},
+        {'group_by': 'start_hour', 'agg': 'avg', 'field': 'duration'},
+        {'group_by': 'start_hour_of_week', 'start_station': 43},
+        {'group_by': 'start_date,gender,is_subscriber', 'agg': 'count,avg', 'field': 'duration'},
+        {'group_by': 'start_station,start_hour', 'having': 'count_gt:1', 'order_by': '-count,start_station,start_hour', 'top': 5},
+        {'group_by': 'start_weekday,gender', 'agg': 'avg,max', 'field': 'duration', 'having': 'avg_duration_lt:1000', 'order_by': '-avg_duration'},
+        # small sets of bikes are counted exactly by HyperLogLog
+        {'group_by': 'start_date', 'agg': 'count,distinct_bikes'},
+        {'group_by': 'start_station,gender', 'agg': 'distinct_bikes', 'is_subscriber': 'true'},
+    ]
+
+    def _summary(self, params):
+        # compare the computed summaries, not the cached ones
+        get_summary_cache().clear()
+        response = self.client.get('/apis/trips/summary/', params, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return sorted(response.data, key=lambda row: sorted(row.items()))
+
+    def _raw_summaries(self, params_list):
+        with self.settings(TRIP_ROLLUPS=False):
+            return [self._summary(params) for params in params_list]
+
+    def test_rollups_at_import(self):
+        import_files([self.csv_file], batch_size=4)
+
+        self.assertEqual(DailyTripRollup.objects.aggregate(count=Sum('count'))['count'], 21)
+        self.assertEqual(HourlyTripRollup.objects.aggregate(count=Sum('count'))['count'], 21)
+        row = DailyTripRollup.objects.get(start_date=datetime.date(2019, 3, 3), gender=1, is_subscriber=False, birth_year=1999)
+        self.assertEqual((row.count, row.duration_sum, row.duration_min, row.duration_max), (2, 8265, 4114, 4151))
+        self.assertEqual(HourlyTripRollup.objects.get(start_station=43, start_date=datetime.date(2019, 3, 5)).start_hour, 7)
+
+    def test_rollups_same_as_rebuild(self):
+        import_files([self.csv_file], batch_size=4)
+        columns = ('start_date', 'start_hour', 'start_station', 'gender', 'is_subscriber', 'birth_year', 'count', 'duration_sum', 'duration_min', 'duration_max')
+        imported = sorted(HourlyTripRollup.objects.values_list(*columns))
+
+        rebuild_rollups()
+        self.assertEqual(sorted(HourlyTripRollup.objects.values_list(*columns)), imported)
+
+    def test_rollups_updated_in_batches(self):
+        import_files([self.csv_file])
+        ImportedFile.objects.all().delete()
+        with CaptureQueriesContext(connection) as queries:
+            import_files([self.csv_file])
+        # the existing rows of each rollup are updated by one statement
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE') and 'triprollup' in q['sql']]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(DailyTripRollup.objects.aggregate(count=Sum('count'))['count'], 42)
+        row = DailyTripRollup.objects.get(start_date=datetime.date(2019, 3, 3), gender=1, is_subscriber=False, birth_year=1999)
+        self.assertEqual((row.count, row.duration_sum, row.duration_min, row.duration_max), (4, 16530, 4114, 4151))
+        self.assertEqual(TDigest.from_bytes(row.duration_digest).count, 4)
+
+    def test_summary_from_rollups(self):
+        import_files([self.csv_file])
+        expected = self._raw_summaries(self.PARAMS)
+
+        for params, summary in zip(self.PARAMS, expected):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self._summary(params), summary)
+            self.assertFalse([q for q in queries if 'FROM "apis_trip"' in q['sql']], params)
+
+    def test_percentiles_from_rollups(self):
+        import_files([self.csv_file], batch_size=4)
+        params = {'group_by': 'start_weekday', 'agg': 'min,max,p50,p95,p99', 'field': 'duration'}
+        expected = self._raw_summaries([params])[0]
+
+        with CaptureQueriesContext(connection) as queries:
+            summary = self._summary(params)
+        self.assertFalse([q for q in queries if 'FROM "apis_trip"' in q['sql']])
+
+        self.assertEqual(len(summary), len(expected))
+        for row, exact in zip(summary, expected):
+            self.assertEqual(row['start_weekday'], exact['start_weekday'])
+            for name in ('p50_duration', 'p95_duration', 'p99_duration'):
+                # the digests of a few trips keep every duration, and only interpolate differently at the tails
+                self.assertTrue(exact['min_duration'] <= row[name] <= exact['max_duration'], (row, name))
+                self.assertAlmostEqual(row[name], exact[name], delta=(exact['max_duration'] - exact['min_duration']) * 0.5)
+            self.assertAlmostEqual(row['p50_duration'], exact['p50_duration'], delta=(exact['max_duration'] - exact['min_duration']) * 0.25)
+
+    def test_sketches_limit(self):
+        import_files([self.csv_file])
+        params = {'group_by': 'start_station', 'agg': 'p50,distinct_bikes', 'field': 'duration'}
+        expected = self._raw_summaries([params])[0]
+
+        # the hourly rollup has more rows than the limit, so the summary is computed from the trips
+        with self.settings(TRIP_ROLLUP_SKETCH_ROWS=5), CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self._summary(params), expected)
+        self.assertTrue([q for q in queries if 'FROM "apis_trip"' in q['sql']])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self._summary(params)), len(expected))
+        self.assertFalse([q for q in queries if 'FROM "apis_trip"' in q['sql']])
+
+    def test_stale_rollups(self):
+        import_files([self.csv_file])
+        Trip.objects.filter(gender=2).delete()
+        params = {'group_by': 'gender'}
+        expected = self._raw_summaries([params])[0]
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self._summary(params), expected)
+        self.assertTrue([q for q in queries if 'FROM "apis_trip"' in q['sql']])
+
+        rebuild_rollups()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self._summary(params), expected)
+        self.assertFalse([q for q in queries if 'FROM "apis_trip"' in q['sql']])
+
+    def test_summary_not_covered_by_rollups(self):
+        import_files([self.csv_file])
+        params_list = [
+            {'group_by': 'stop_station'},
+            {'group_by': 'start_date', 'duration_gt': 1000},
+            {'group_by': 'start_date', 'agg': 'max', 'field': 'birth_year'},
+            {'group_by': 'start_date', 'agg': 'p50', 'field': 'birth_year'},
+            {'group_by': 'start_date', 'agg': 'distinct_bikes', 'order_by': '-distinct_bikes'},
+        ]
+        expected = self._raw_summaries(params_list)
+
+        for params, summary in zip(params_list, expected):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(self._summary(params), summary)
+            self.assertTrue([q for q in queries if 'FROM "apis_trip"' in q['sql']], params)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TripColumnStoreTests(APITestCase):
+    fixtures = ['TripImportTests/stations']
+
+    csv_file = os.path.join(FIXTURES_DIR, 'TripImportTests', '201903-bluebikes-tripdata.csv')
+
+    PARAMS = [
+        {'group_by': 'start_date'},
+        {'group_by': 'start_date', 'agg': 'count,max,min,avg,sum', 'field': 'duration'},
+        {'group_by': 'stop_station', 'agg': 'avg', 'field': 'duration', 'start_date_gt': '2019-03-01', 'start_date_lt': '2019-03-05'},
+        {'group_by': 'birth_year', 'is_subscriber': 'true'},
+        {'group_by': 'gender', 'birth_year_lt': 1990},
+        {'group_by': 'start_station', 'agg': 'sum,count', 'field': 'duration', 'duration_gt': 1000},
+        {'group_by': 'start_date', 'start_station': 43},
+        {'group_by': 'start_date', 'start_time_gt': '2019-03-03 12:00', 'stop_time_lt': '2019-03-05 08:00'},
+        {'group_by': 'start_date', 'start_station': 3}, # no trips
+        {'group_by': 'start_weekday', 'agg': 'max', 'field': 'bike_id', 'is_subscriber': 'false'},
+        {'group_by': 'start_week,start_month', 'agg': 'min', 'field': 'duration'},
+        {'group_by': 'start_hour', 'agg': 'avg', 'field': 'duration', 'gender': 1},
+        {'group_by': 'start_hour_of_week,gender', 'agg': 'distinct_bikes'},
+        {'group_by': 'start_station,is_subscriber', 'agg': 'p50,p95,p99', 'field': 'duration'},
+        {'group_by': 'stop_station', 'having': 'count_gt:1', 'order_by': '-count,stop_station', 'top': 5},
+        # the filters resolved by the bitmap indexes, combined with the one evaluated on the column
+        {'group_by': 'is_subscriber', 'gender': 1, 'birth_year_gt': 1980, 'birth_year_lt': 1995, 'start_date_lt': '2019-03-04'},
+        {'group_by': 'gender', 'start_date_gt': '2019-03-01', 'start_station': 43, 'duration_lt': 2000},
+        {'group_by': 'start_date,gender', 'agg': 'avg', 'field': 'duration', 'having': 'avg_duration_lt:1000', 'order_by': '-avg_duration,start_date,gender'},
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _summary(self, params, enabled=True):
+        get_summary_cache().clear()
+        with self.settings(TRIP_ROLLUPS=False, TRIP_COLUMNSTORE={'ENABLED': enabled, 'PATH': self.directory}):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/apis/trips/summary/', params, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK, params)
+        return response.data, [q for q in queries if 'FROM "apis_trip"' in q['sql']]
+
+    def _import(self):
+        with self.settings(TRIP_COLUMNSTORE={'ENABLED': True, 'PATH': self.directory}):
+            import_files([self.csv_file])
+
+    def test_build_at_import(self):
+        self._import()
+        with self.settings(TRIP_COLUMNSTORE={'ENABLED': True, 'PATH': self.directory}):
+            columns = get_trip_columns()
+        self.assertEqual(columns.size, 21)
+        self.assertEqual(int(columns.arrays['duration'].sum()), Trip.objects.aggregate(s=Sum('duration'))['s'])
+        trip = Trip.objects.order_by('start_time').first()
+        i = int(numpy.argmin(columns.arrays['start_time']))
+        self.assertEqual(int(columns.station_ids[columns.arrays['start_station'][i]]), trip.start_station_id)
+        self.assertEqual(int(columns.arrays['start_hour'][i]), timezone.localtime(trip.start_time).hour)
+        self.assertEqual(columns.bitmaps['gender'].equal(1).to_positions().tolist(), numpy.flatnonzero(columns.arrays['gender'] == 1).tolist())
+
+        # building again replaces the current store
+        self.assertEqual(build_columnstore(self.directory), 21)
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.startswith('trips-')]), 2)
+        self.assertEqual(build_columnstore(self.directory), 21)
+        self.assertEqual(len([name for name in os.listdir(self.directory) if name.startswith('trips-')]), 2)
+
+    def test_summary_same_as_database(self):
+        self._import()
+        for params in self.PARAMS:
+            expected, queries = self._summary(params, enabled=False)
+            self.assertTrue(queries, params)
+            summary, queries = self._summary(params)
+            self.assertFalse(queries, params)
+            self.assertEqual(summary, expected, params)
+
+    def test_groups_beyond_codes(self):
+        # the groups whose codes would overflow int64 are the distinct rows of the grouped values
+        self._import()
+        params_list = [params for params in self.PARAMS if ',' in params['group_by']] + [{'group_by': 'start_date,start_station,stop_station,gender', 'agg': 'avg', 'field': 'duration'}]
+        expected = [self._summary(params)[0] for params in params_list]
+
+        self.addCleanup(setattr, columnstore, 'MAX_GROUP_CODES', columnstore.MAX_GROUP_CODES)
+        columnstore.MAX_GROUP_CODES = 1
+        for params, summary in zip(params_list, expected):
+            self.assertEqual(self._summary(params), (summary, []), params)
+
+    def test_stale_store(self):
+        self._import()
+        Trip.objects.filter(duration__gt=4000).first().delete()
+        summary, queries = self._summary({'group_by': 'gender'})
+        self.assertTrue(queries)
+        self.assertEqual(sum(row['count'] for row in summary), 20)
+
+    def test_summary_not_covered(self):
+        self._import()
+        for params in [
+            {'group_by': 'start_date', 'agg': 'max', 'field': 'birth_year'},
+            {'group_by': 'start_time'},
+            {'group_by': 'start_date', 'ordering': '-start_date'},
+        ]:
+            summary, queries = self._summary(params)
+            self.assertTrue(queries, params)
+
+
+class TripSummaryCacheTests(APITestCase):
+    fixtures = ['TripImportTests/stations']
+
+    csv_file = os.path.join(FIXTURES_DIR, 'TripImportTests', '201903-bluebikes-tripdata.csv')
+
+    def setUp(self):
+        get_summary_cache().clear()
+        import_files([self.csv_file])
+
+    def _summary(self, params, **headers):
+        return self.client.get('/apis/trips/summary/', params, format='json', **headers)
+
+    def _summary_queries(self, params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self._summary(params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, [q['sql'] for q in queries if 'dataversion' not in q['sql']]
+
+    def test_cache_hit(self):
+        params = {'group_by': 'gender', 'agg': 'count,avg', 'field': 'duration', 'is_subscriber': 'true'}
+        first, queries = self._summary_queries(params)
+        self.assertTrue(queries)
+
+        second, queries = self._summary_queries(params)
+        self.assertEqual(queries, [])
+        self.assertEqual(second.data, first.data)
+
+    def test_cache_hit_normalized_params(self):
+        self._summary({'group_by': 'gender', 'agg': 'count,avg', 'field': 'duration', 'is_subscriber': 'true', 'gender': ''})
+        response, queries = self._summary_queries({'group_by': 'gender', 'agg': 'avg,count', 'field': 'duration', 'is_subscriber': 'True'})
+        self.assertEqual(queries, [])
+
+        response, queries = self._summary_queries({'group_by': 'gender', 'agg': 'avg,count', 'field': 'duration', 'is_subscriber': 'false'})
+        self.assertTrue(queries)
+
+    def test_invalidated_by_import(self):
+        params = {'group_by': 'start_date'}
+        self.assertEqual(sum(row['count'] for row in self._summary(params).data), 21)
+
+        Trip.objects.filter(start_date=datetime.date(2019, 3, 5)).delete()
+        rebuild_rollups()
+        self.assertEqual(sum(row['count'] for row in self._summary(params).data), 18)
+
+        ImportedFile.objects.all().delete()
+        import_files([self.csv_file])
+        self.assertEqual(sum(row['count'] for row in self._summary(params).data), 39)
+
+    def test_errors_not_cached(self):
+        response = self._summary({'group_by': 'start_date', 'agg': 'max'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self._summary({'group_by': 'start_date', 'agg': 'max'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_etag(self):
+        params = {'group_by': 'start_date'}
+        response = self._summary(params)
+        etag = response['ETag']
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+        response = self._summary(params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+        # the tags of the other summaries or the other versions don't match
+        self.assertEqual(self._summary({'group_by': 'gender'}, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+        Trip.objects.filter(start_date=datetime.date(2019, 3, 5)).delete()
+        self.assertEqual(self._summary(params, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_last_modified(self):
+        params = {'group_by': 'start_date'}
+        last_modified = self._summary(params)['Last-Modified']
+
+        response = self._summary(params, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        response = self._summary(params, HTTP_IF_MODIFIED_SINCE='Fri, 01 Mar 2019 00:00:00 GMT')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_lru_cache(self):
+        cache = LRUCache('test_lru_cache', {'TIMEOUT': 60, 'OPTIONS': {'MAX_ENTRIES': 2}})
+        cache.clear()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1) # b is the least recently used
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+        self.assertFalse(cache.add('c', 5))
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.set('d', 4, timeout=0)
+        self.assertIsNone(cache.get('d'))
+
+    @unittest.skipUnless(redis is not None and os.environ.get('REDIS_URL'), 'Set REDIS_URL to test the Redis cache')
+    def test_redis_cache(self):
+        cache = RedisCache(os.environ['REDIS_URL'], {'TIMEOUT': 60, 'KEY_PREFIX': 'test_redis_cache'})
+        other = RedisCache(os.environ['REDIS_URL'], {'TIMEOUT': 60, 'KEY_PREFIX': 'test_redis_cache_other'})
+        self.addCleanup(other.clear)
+        cache.clear()
+        other.set('a', 'other')
+        cache.set('a', {'rows': [1, 2]})
+        self.assertEqual(cache.get('a'), {'rows': [1, 2]})
+        self.assertTrue(cache.has_key('a'))
+
+        self.assertFalse(cache.add('a', 5))
+        self.assertTrue(cache.add('b', 5))
+        self.assertEqual(cache.get('b'), 5)
+        cache.delete('b')
+        self.assertIsNone(cache.get('b'))
+
+        cache.set('a', 4, timeout=0)
+        self.assertIsNone(cache.get('a'))
+        cache.set('c', 3, timeout=None)
+        cache.clear()
+        self.assertIsNone(cache.get('c'))
+        # other caches in the same database are kept
+        self.assertEqual(other.get('a'), 'other')
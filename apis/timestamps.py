@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Fast parsers of the timestamps in trip history files ('YYYY-MM-DD HH:MM:SS.ffff' in local time).
+
+Django's parse_datetime runs a regular expression and make_aware localizes every value with pytz.
+Since the format is fixed, these parsers slice the strings instead, and look up the time zone of
+each local hour only once. The UTC offset is cached per local hour, so the values around DST
+transitions still get the right offset, except in the hour repeated when DST ends (see local_tzinfo).
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+import pytz
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils import timezone
+
+try:
+    import numpy
+except ImportError: # numpy is optional
+    numpy = None
+
+# the number of timestamps from which the numpy path is used
+NUMPY_MIN_SIZE = 64
+
+_tzinfos = {} # 'YYYY-MM-DD HH' -> tzinfo of the local hour
+_MAX_CACHED_HOURS = 1000000
+
+
+def local_tzinfo(year, month, day, hour):
+    """
+    Return the tzinfo (with its UTC offset) of the local hour in the default time zone.
+    Ambiguous hours (when DST ends) and non-existent hours (when DST starts), for which
+    make_aware raises errors, are resolved as standard time. The files carry no UTC offsets,
+    so both passes of the repeated hour get the offset of standard time: e.g. 2019-11-03 01:30
+    in America/New_York is read as 01:30-05:00 (06:30 UTC), and the trips in its first pass
+    (05:xx UTC) are placed an hour later than they happened.
+    """
+    key = (year, month, day, hour)
+    tzinfo = _tzinfos.get(key)
+    if tzinfo is None:
+        tz = timezone.get_default_timezone()
+        naive = datetime.datetime(year, month, day, hour)
+        try:
+            tzinfo = tz.localize(naive, is_dst=None).tzinfo
+        except pytz.InvalidTimeError:
+            tzinfo = tz.localize(naive, is_dst=False).tzinfo
+        except AttributeError: # not a pytz time zone
+            tzinfo = timezone.make_aware(naive, tz).tzinfo
+
+        if len(_tzinfos) >= _MAX_CACHED_HOURS:
+            _tzinfos.clear()
+        _tzinfos[key] = tzinfo
+    return tzinfo
+
+
+def parse_timestamp(value):
+    """
+    Parse a timestamp like '2019-03-01 00:00:34.6490' into an aware datetime in the default time zone.
+    The fraction of seconds is optional. The local times repeated or skipped by DST transitions are
+    resolved as standard time (see local_tzinfo).
+
+    Raises
+    ----------
+    ValueError
+        if the value is not in the format
+    """
+    if len(value) < 19 or value[4] != '-' or value[7] != '-' or value[10] not in ' T' or value[13] != ':' or value[16] != ':':
+        raise ValueError("Invalid timestamp '{}'".format(value))
+
+    year, month, day, hour = int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13])
+    fraction = value[20:26]
+    microsecond = int(fraction) * 10 ** (6 - len(fraction)) if fraction else 0
+    return datetime.datetime(year, month, day, hour, int(value[14:16]), int(value[17:19]), microsecond,
+                             tzinfo=local_tzinfo(year, month, day, hour))
+
+
+def parse_timestamps(values):
+    """
+    Parse a chunk of timestamps at once. When numpy is available, the strings are converted
+    to datetime64 in one call and the time zone is looked up once per distinct local hour.
+    The offsets are the same as the ones of parse_timestamp, including standard time for the
+    local times repeated or skipped by DST transitions.
+
+    Raises
+    ----------
+    ValueError
+        if any of the values is not in the format
+    """
+    if numpy is None or len(values) < NUMPY_MIN_SIZE:
+        return [parse_timestamp(value) for value in values]
+
+    if min(len(value) for value in values) < 19:
+        raise ValueError('Invalid timestamp in the chunk')
+
+    local = numpy.array(values, dtype='datetime64[us]')
+    hours = local.astype('datetime64[h]')
+    unique_hours, inverse = numpy.unique(hours, return_inverse=True)
+    tzinfos = [local_tzinfo(h.year, h.month, h.day, h.hour) for h in unique_hours.astype(datetime.datetime)]
+    return [d.replace(tzinfo=tzinfos[i]) for d, i in zip(local.astype(datetime.datetime).tolist(), inverse.tolist())]
+
+
+@receiver(setting_changed)
+def _clear_tzinfos(setting, **kwargs):
+    if setting == 'TIME_ZONE':
+        _tzinfos.clear()
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import itertools
+
 from django.shortcuts import render
 from django.db.models import Count, Max, Min, Sum, Avg
 
@@ -9,11 +11,32 @@ from rest_framework.response import Response
 from rest_framework.filters import OrderingFilter
 from rest_framework.exceptions import APIException
 from rest_framework.decorators import action
+from rest_framework.settings import api_settings
 from django_filters.rest_framework import FilterSet, NumberFilter, DateFilter, DateTimeFilter, CharFilter, DjangoFilterBackend
+from .apps import TripPagination
 from .models import Station, Trip
+from .partitions import PartitionPruningFilter
+from .renderers import Columns, ColumnarRenderer, CSVRenderer, NDJSONRenderer
 from .serializers import StationSerializer, TripSerializer
+from .sketches import PERCENTILES, percentile
+from .spatial import StationSpatialFilter, parse_positive
+from . import buckets, caching, columnstore, exports, rollups
 
 # Create your views here.
+def requested_fields(request, fields):
+    """
+    Return the names of the fields to be serialized, following 'fields' and 'omit' parameters of drf_dynamic_fields
+    """
+    query_params = request.query_params
+    if 'fields' in query_params:
+        allowed = set(filter(None, query_params['fields'].split(',')))
+        fields = [f for f in fields if f in allowed]
+    if 'omit' in query_params:
+        omitted = set(query_params['omit'].split(','))
+        fields = [f for f in fields if f not in omitted]
+    return fields
+
+
 class StationFilter(FilterSet):
     """
     The filter class for stations
@@ -48,7 +71,8 @@ class StationViewSet(mixins.CreateModelMixin,
     Return the given station.
 
     list:
-    Return a list of all the stations.
+    Return a list of all the stations. Give bbox=minLon,minLat,maxLon,maxLat to get the stations in the bounding box,
+    and near=lat,lon with radius (meters) and/or k to get the stations near the point ordered by distance.
 
     update: 
     Update the station.
@@ -91,10 +115,29 @@ class StationViewSet(mixins.CreateModelMixin,
 
     queryset = Station.objects.all()
     serializer_class = StationSerializer
-    filter_backends = (OrderingFilter, DjangoFilterBackend,)
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (ColumnarRenderer,)
+    filter_backends = (OrderingFilter, DjangoFilterBackend, StationSpatialFilter,)
     filter_class = StationFilter
     ordering_fields = '__all__'
 
+    def list(self, request, *args, **kwargs):
+        """
+        Return a list of stations. The columnar format (format=columnar) is built from the column values
+        without the serializer.
+        """
+        if request.accepted_renderer.format != ColumnarRenderer.format:
+            return super(StationViewSet, self).list(request, *args, **kwargs)
+
+        fields = requested_fields(request, list(StationSerializer.Meta.fields))
+        columns = ['region__name' if field == 'region' else field for field in fields]
+        # pk is fetched as well, since values_list() without any fields would fetch all of them
+        queryset = self.filter_queryset(self.get_queryset()).values_list(*(columns + ['pk']))
+
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response(Columns.from_tuples(fields, queryset))
+        return self.get_paginated_response(Columns.from_tuples(fields, page))
+
 
 class TripFilter(FilterSet):
     """
@@ -120,6 +163,14 @@ class TripFilter(FilterSet):
         fields = '__all__'
 
 
+TRIP_FIELDS = set(f.name for f in Trip._meta.concrete_fields)
+
+# the fields of Trip whose percentiles can be computed
+NUMERIC_FIELDS = set(f.name for f in Trip._meta.concrete_fields if f.get_internal_type() in ('IntegerField', 'BigIntegerField', 'FloatField'))
+
+# the lookups of the conditions of 'having'
+HAVING_LOOKUPS = ('exact', 'gt', 'gte', 'lt', 'lte')
+
 ANNODATIONS_DEFS = {
     'max' : Max,
     'min' : Min,
@@ -134,7 +185,8 @@ class TripViewSet(viewsets.ReadOnlyModelViewSet):
     Return the given trip.
 
     list:
-    Return a list of all the trips.
+    Return a list of all the trips. Give an empty 'cursor' parameter to page through them in the order of start_time
+    by the cursors of 'next' and 'previous' links, which is faster than page numbers for deep pages.
 
     summary:
     Return summary information of trips
@@ -142,19 +194,166 @@ class TripViewSet(viewsets.ReadOnlyModelViewSet):
     
     queryset = Trip.objects.all()
     serializer_class = TripSerializer
-    filter_backends = (OrderingFilter, DjangoFilterBackend,)
+    filter_backends = (OrderingFilter, DjangoFilterBackend, PartitionPruningFilter,)
     filter_class = TripFilter
+    pagination_class = TripPagination
+
+    def _requested_fields(self):
+        # TripSerializer serializes all the fields
+        return set(requested_fields(self.request, [f.name for f in Trip._meta.concrete_fields]))
+
+    def get_queryset(self):
+        """
+        Join the stations (and their regions) to be serialized, and fetch only the requested columns.
+        The summary doesn't use this queryset, since ordering would be added to its GROUP BY.
+        """
+        queryset = super(TripViewSet, self).get_queryset()
+        fields = self._requested_fields()
+
+        stations = [f for f in ('start_station', 'stop_station') if f in fields]
+        if stations:
+            queryset = queryset.select_related(*[station + '__region' for station in stations])
+
+        # keep trips in the order of ids, which doesn't depend on the index chosen for the selected columns.
+        # start_time is the key of the keyset pagination
+        return queryset.only('id', 'start_time', *fields).order_by('pk')
+
+    @action(detail=False, methods=['get'], renderer_classes=(CSVRenderer, NDJSONRenderer))
+    def export(self, request, *args, **kwargs):
+        """
+        Stream all the trips matching the filters as CSV or NDJSON (one JSON object per line) without pagination.
+        Stations are exported as their ids, and datetimes in ISO 8601 with UTC offsets.
+
+        Query Parameters
+        ----------
+        format: str
+
+            csv (default) or ndjson. The Accept header (text/csv or application/x-ndjson) also selects the format
+
+        fields, omit: str
+
+            the fields to be exported or omitted. Specify multiple names with comma (,)
+
+        The response is compressed by gzip when the request accepts it (Accept-Encoding: gzip).
+
+        Examples
+        -----------
+        http://127.0.0.1:8000/apis/trips/export/?format=ndjson&start_date_gt=2019-03-01&fields=id,start_station,duration
+
+            Get the ids, start stations and durations of trips after 2019-03-01 as NDJSON
+        """
+        fields = self._requested_fields()
+        fields = [f.name for f in Trip._meta.concrete_fields if f.name in fields]
+        queryset = self.filter_queryset(Trip.objects.order_by('pk'))
+        return exports.export_response(queryset, fields, request.accepted_renderer.format, compress=exports.accepts_gzip(request))
+
+    @action(detail=False, methods=['get'], renderer_classes=tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (ColumnarRenderer,))
+    def od_matrix(self, request, *args, **kwargs):
+        """
+        Return the origin-destination matrix of trips, which has the number of trips and the average duration
+        for each pair of start and stop stations. The matrix is sparse, so only the pairs with trips are returned
+        as the arrays of the coordinate format, ordered by the number of trips (descending).
+
+        Query Parameters
+        ----------
+        k: int
+
+            the number of the pairs with the most trips to be returned
+
+        min_count: int
 
-    def _raiseException(self, field):
+            the minimum number of trips of the pairs to be returned
+
+        The filters of trips are also available.
+
+        Examples
+        -----------
+        http://127.0.0.1:8000/apis/trips/od_matrix/?k=100&start_date_gt=2019-03-01&start_date_lt=2019-03-08
+
+            Get the 100 busiest pairs of stations in the first week of March
+
+        Returns
+        ----------
+        results: start_station, stop_station, count and avg_duration arrays. format=columnar returns them as typed arrays
+        """
+        k = parse_positive(request, 'k', int)
+        min_count = parse_positive(request, 'min_count', int)
+
+        def summarize():
+            # one aggregation over the pairs, pruned by the database
+            queryset = self.filter_queryset(Trip.objects.all()).values_list('start_station', 'stop_station').annotate(
+                count=Count('pk'), avg_duration=Avg('duration')
+            )
+            if min_count is not None:
+                queryset = queryset.filter(count__gte=min_count)
+            queryset = queryset.order_by('-count', 'start_station', 'stop_station')
+            if k is not None:
+                queryset = queryset[:k]
+
+            return {'results': Columns.from_tuples(['start_station', 'stop_station', 'count', 'avg_duration'], queryset)}
+
+        return caching.cached_summary(request, self.filter_class, summarize, params=('k', 'min_count'))
+
+    def _raiseException(self, field, message=None):
         """
         Raise 400 exceptions for invalid or missing parameters
         """
-        e = APIException("The request parameter '{}' is required.".format(field))
+        e = APIException(message or "The request parameter '{}' is required.".format(field))
         e.status_code = 400
         raise e
+
+    def _raiseInvalid(self, field, value):
+        self._raiseException(field, "The request parameter '{}' has an invalid value '{}'.".format(field, value))
+
+    def _add_percentiles(self, summary, trips, group_by, field, percentiles):
+        """
+        Add the exact percentiles of the field to the summaries, reading the values of each group in order
+        """
+        groups = dict((tuple(e[name] for name in group_by), e) for e in summary)
+        values = trips.filter(**{field + '__isnull': False}).values_list(*(group_by + [field])).order_by(*(group_by + [field]))
+        for key, rows in itertools.groupby(values.iterator(), lambda row: row[:-1]):
+            e = groups.get(key)
+            if e is not None:
+                sorted_values = [row[-1] for row in rows]
+                for name, q in percentiles.items():
+                    e[name] = percentile(sorted_values, q)
+        for e in summary:
+            for name in percentiles:
+                e.setdefault(name, None)
+
+    def _parse_having(self, annotations):
+        """
+        Return the conditions on the aggregated values given by 'having' parameter (e.g. count_gt:100,avg_duration_lt:600)
+        as (name, lookup, value)
+        """
+        having = []
+        for condition in filter(None, self.request.query_params.get('having', '').split(',')):
+            name, _, value = condition.partition(':')
+            lookup = 'exact'
+            if name not in annotations:
+                name, _, lookup = name.rpartition('_')
+            try:
+                value = float(value)
+            except ValueError:
+                self._raiseInvalid('having', condition)
+            if name not in annotations or lookup not in HAVING_LOOKUPS:
+                self._raiseInvalid('having', condition)
+            having.append((name, lookup, value))
+        return having
+
+    def _parse_order_by(self, names):
+        """
+        Return the ordering given by 'order_by' parameter, which are the grouped fields or the aggregated values
+        with '-' for descending order
+        """
+        order_by = list(filter(None, self.request.query_params.get('order_by', '').split(',')))
+        for name in order_by:
+            if name.lstrip('-') not in names:
+                self._raiseInvalid('order_by', name)
+        return order_by
         
 
-    @action(detail=False, methods=['get'])
+    @action(detail=False, methods=['get'], renderer_classes=tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (ColumnarRenderer,))
     def summary(self, request, *args, **kwargs):
         """
         Return a summary of trip history using specified aggregate functions and field. The summaries are grouped by the field specified by 'group_by'.
@@ -163,16 +362,33 @@ class TripViewSet(viewsets.ReadOnlyModelViewSet):
         ----------
         group_by (required): str
 
-            a field name of Trip to be grouped
+            field names of Trip to be grouped, or the time buckets of start time
+            (start_weekday, start_hour, start_week, start_month or start_hour_of_week). Specify multiple names with comma (,)
 
         agg: str
 
-            aggregation function names (count, max, min, avg or sum). Specify multiple names with comma (,). Default is 'coubt'
+            aggregation function names (count, max, min, avg, sum, p50, p95, p99 or distinct_bikes). Specify multiple names with comma (,). Default is 'coubt'.
+            The percentiles (p50, p95 and p99) of duration and distinct_bikes are estimated from the sketches of the rollups
+            when the rollups answer the summary, and computed exactly otherwise. The percentiles can't be used in having and order_by
 
         field: str
 
             a field name of Trip to summarize
 
+        having: str
+
+            conditions on the aggregated values as name:value (equal) or name_gt, name_gte, name_lt, name_lte:value.
+            Specify multiple conditions with comma (,)
+
+        order_by: str
+
+            the grouped fields or the aggregated values to order the summaries. Prefix '-' for descending order.
+            Default is the order of the grouped fields
+
+        top: int
+
+            the number of the summaries to be returned from the first
+
         Examples
         -----------
         http://127.0.0.1:8000/apis/trips/summary/?group_by=gender
@@ -187,6 +403,22 @@ class TripViewSet(viewsets.ReadOnlyModelViewSet):
 
             Get maximum and minimum duration for each gender
 
+        http://127.0.0.1:8000/apis/trips/summary/?group_by=start_weekday&agg=avg&field=duration
+
+            Get average duration for each day of the week (0 is Sunday and 6 is Saturday)
+
+        http://127.0.0.1:8000/apis/trips/summary/?group_by=start_station,gender&having=count_gte:100&order_by=-count&top=10
+
+            Get the 10 pairs of start station and gender with the most trips among the ones with 100 trips or more
+
+        http://127.0.0.1:8000/apis/trips/summary/?group_by=start_station&agg=p50,p95&field=duration
+
+            Get the median and the 95th percentile of duration for each start station
+
+        http://127.0.0.1:8000/apis/trips/summary/?group_by=start_date&agg=distinct_bikes
+
+            Get the number of distinct bikes used on each day
+
         Returns
         ----------
         The fields of response depends on how you specify 'group_by', 'field', 'agg' request parameters.
@@ -198,20 +430,71 @@ class TripViewSet(viewsets.ReadOnlyModelViewSet):
         if group_by is None:
             self._raiseException('group_by') # group_by is required. So raise exception when not specified.
 
+        # validate the names before querying, since unknown names make errors in the database
+        group_by = [str(name) for name in group_by.split(',')]
+        for name in group_by:
+            if name not in TRIP_FIELDS and not buckets.is_time_bucket(name):
+                self._raiseInvalid('group_by', name)
+
         field = query_params.get('field')
-        aggs = query_params.get('agg', 'count') # default is count
+        if field is not None and field not in TRIP_FIELDS:
+            self._raiseInvalid('field', field)
+        aggs = query_params.get('agg', 'count').split(',') # default is count
         
         annotations = {}
+        percentiles = {} # the names of the percentiles -> the quantiles, which are computed in Python
 
-        for agg in aggs.split(','):
+        for agg in aggs:
             if agg == 'count':
                 annotations[agg] = Count('pk')
-            else:
+            elif agg == 'distinct_bikes':
+                annotations[agg] = Count('bike_id', distinct=True)
+            elif agg in ANNODATIONS_DEFS or agg in PERCENTILES:
                 if field is None:
-                    # field is required for max, min, ave, and sum
+                    # field is required for max, min, ave, sum and the percentiles
                     self._raiseException('field')
-                
-                annotations[agg + '_' + str(field)] = ANNODATIONS_DEFS[agg](field)
+
+                if agg in PERCENTILES:
+                    if field not in NUMERIC_FIELDS:
+                        self._raiseInvalid('field', field)
+                    percentiles[agg + '_' + str(field)] = PERCENTILES[agg]
+                else:
+                    annotations[agg + '_' + str(field)] = ANNODATIONS_DEFS[agg](field)
+            else:
+                self._raiseInvalid('agg', agg)
+
+        having = self._parse_having(annotations)
+        order_by = self._parse_order_by(group_by + list(annotations))
+        top = parse_positive(request, 'top', int)
         
-        queryset = self.filter_queryset(self.queryset)
-        return Response([e for e in queryset.values(str(group_by)).annotate(**annotations).iterator()])
+        def summarize():
+            # the pre-aggregated trips answer most of the summaries
+            summary = rollups.summarize(request, self.filter_class, group_by, aggs, field, having, order_by, top)
+            if summary is not None:
+                return summary
+            # the columnar store answers the others when it's enabled
+            summary = columnstore.summarize(request, self.filter_class, group_by, aggs, field, having, order_by, top)
+            if summary is not None:
+                return summary
+
+            trips = self.filter_queryset(self.queryset)
+            for name in group_by:
+                trips = buckets.annotate_bucket(trips, name)
+            # distinct groups the trips when only the percentiles are requested
+            queryset = trips.values(*group_by).annotate(**annotations) if annotations else trips.values(*group_by).distinct()
+            for name, lookup, value in having:
+                queryset = queryset.filter(**{name + '__' + lookup: value})
+            if order_by:
+                queryset = queryset.order_by(*order_by)
+            elif not query_params.get('ordering'):
+                queryset = queryset.order_by(*group_by)
+            if top is not None:
+                queryset = queryset[:top]
+            summary = [e for e in queryset.iterator()]
+
+            if percentiles:
+                self._add_percentiles(summary, trips, group_by, field, percentiles)
+            return summary
+
+        # the summaries are cached until trips change
+        return caching.cached_summary(request, self.filter_class, summarize)
@@ -15,9 +15,11 @@ Including another URLconf
 """
 from django.conf.urls import url, include
 from rest_framework.documentation import include_docs_urls
+from apis.instrumentation import metrics_view
 
 urlpatterns = [
     url(r'^apis/', include('apis.urls')),
     url(r'^dashboards/', include('dashboards.urls')),
-    url(r'^docs/', include_docs_urls(title='BLUEBikes API docs', public=False))
+    url(r'^docs/', include_docs_urls(title='BLUEBikes API docs', public=False)),
+    url(r'^metrics$', metrics_view, name='metrics'),
 ]
@@ -3,29 +3,71 @@
     const DAYS = ["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"]
     const MARGIN = {top: 20, right: 20, bottom: 70, left: 60};
 
-    // functions to summarize values for each day
-    const summarize_funcs = {
-        count: (countOfDays, countOfDate) => {
-            day = new Date(countOfDate.start_date).getDay();
-            countOfDays[day] += countOfDate.count;
-            return countOfDays;
-        },
-        max: (maxOfDays, maxOfDate) => {
-            day = new Date(maxOfDate.start_date).getDay();
-            maxOfDays[day] = Math.max(maxOfDate.max_duration, maxOfDays[day]);
-            return maxOfDays;
-        },
-        min: (minOfDays, minOfDate) => {
-            day = new Date(minOfDate.start_date).getDay();
-            // assume that every day has some trips
-            minOfDays[day] =  minOfDays[day] == 0 ? minOfDate.min_duration: Math.min(minOfDate.min_duration, minOfDays[day]);
-            return minOfDays;
-        },
-        sum: (sumOfDays, sumOfDate) => {
-            day = new Date(sumOfDate.start_date).getDay();
-            sumOfDays[day] = sumOfDate.sum_duration + sumOfDays[day];
-            return sumOfDays;
+    const COLUMNAR_TYPE = 'application/vnd.bluebikes.columnar';
+
+    /**
+     * Decode the columnar format of the APIs into typed arrays (strings into arrays).
+     * 
+     * @param {ArrayBuffer} buffer response body
+     * @returns {Object} metadata, the number of rows and the columns keyed by their names
+     */
+    function decodeColumnar(buffer) {
+        const view = new DataView(buffer);
+        const decoder = new TextDecoder('utf-8');
+        const align = offset => offset + (8 - offset % 8) % 8;
+
+        let offset = 8; // magic and version
+        const metadataLength = view.getUint32(offset, true);
+        const meta = JSON.parse(decoder.decode(new Uint8Array(buffer, offset + 4, metadataLength)));
+        offset = align(offset + 4 + metadataLength);
+
+        const length = view.getUint32(offset, true);
+        const count = view.getUint32(offset + 4, true);
+        offset += 8;
+
+        const columns = {};
+        for (let i = 0; i < count; i++) {
+            const nameLength = view.getUint32(offset, true);
+            const name = decoder.decode(new Uint8Array(buffer, offset + 4, nameLength));
+            const type = view.getUint8(offset + 4 + nameLength);
+            offset = align(offset + 5 + nameLength);
+
+            if (type == 4) {
+                // strings: offsets and UTF-8 bytes
+                const offsets = new Uint32Array(buffer, offset, length + 1);
+                const start = align(offset + (length + 1) * 4);
+                const values = new Array(length);
+                for (let j = 0; j < length; j++) {
+                    values[j] = decoder.decode(new Uint8Array(buffer, start + offsets[j], offsets[j + 1] - offsets[j]));
+                }
+                columns[name] = values;
+                offset = align(start + offsets[length]);
+            } else {
+                // little-endian typed arrays, which every browser uses
+                const ArrayType = {1: Int32Array, 2: Float64Array, 3: Uint8Array}[type];
+                columns[name] = new ArrayType(buffer, offset, length);
+                offset = align(offset + length * ArrayType.BYTES_PER_ELEMENT);
+            }
         }
+        return {meta: meta, length: length, columns: columns};
+    }
+
+    /**
+     * Get the columnar data from the API.
+     * 
+     * @param {string} url API url
+     * @param {Object} params query parameters
+     * @returns {Promise} promise of the decoded data, rejected if the response is an error
+     */
+    function getColumnar(url, params) {
+        return fetch(url + '?' + $.param(params), {headers: {Accept: COLUMNAR_TYPE}})
+            .then(resp => {
+                if (!resp.ok) {
+                    throw new Error(url + ': ' + resp.status + ' ' + resp.statusText);
+                }
+                return resp.arrayBuffer();
+            })
+            .then(decodeColumnar);
     }
 
     /**
@@ -38,16 +80,19 @@
 
         const agg = $('#summary-agg').val(); // aggregation function name
 
-        // get summary of trips for each date
-        $.ajax('../apis/trips/summary', {
-            data: $.extend({
-                group_by: 'start_date',
-                agg: agg,
-                field: 'duration' // ignored when agg == count
-            }, filter)
-        }).done(resp => {
-            // summarize by day
-            data = resp.reduce(summarize_funcs[agg], [0, 0, 0, 0, 0, 0, 0]);
+        // get summary of trips for each day of the week (0 is Sunday)
+        getColumnar('../apis/trips/summary/', $.extend({
+            group_by: 'start_weekday',
+            agg: agg,
+            field: 'duration' // ignored when agg == count
+        }, filter)).then(resp => {
+            // the days without trips are missing in the response
+            const values = resp.columns[agg == 'count' ? 'count' : agg + '_duration'];
+            const weekdays = resp.columns.start_weekday;
+            const data = [0, 0, 0, 0, 0, 0, 0];
+            for (let i = 0; i < resp.length; i++) {
+                data[weekdays[i]] = values[i];
+            }
 
             const width = $root.width() - MARGIN.left - MARGIN.right;
             const height = 400 - MARGIN.top - MARGIN.bottom;
@@ -130,65 +175,79 @@
         const svg = d3.select('#map').select('svg');
         const g = svg.append('g').attr('class', 'leaflet-zoom-hide');
 
-        // get capacity and location information of all stations
-        $.ajax('../apis/stations', {
-            data: $.extend({
-                limit: 300,
-                fields: 'lat,lon,station_id,capacity,name'
-            }, filters)
-        }).done(resp => {
+        // the circles of stations, which are updated every time the map is reset
+        let circles = g.selectAll('circle');
 
-            const results = resp['results'];
-            
-            // add Location data object to original data
-            results.forEach(function(d){
-                d.LatLngObj = new L.LatLng(d.lat, d.lon);
+        function update() {
+            circles.attr('transform', d => {
+                const point = map.latLngToLayerPoint(d.LatLngObj)
+                return `translate(${point.x}, ${point.y})`
             });
+            zoom = map.getZoom();
+            circles.attr('r', d => {
+                return d.capacity / 15 * 3 * (zoom / INITIAL_ZOOM_LEVEL) ** 2 // change circle size depending on capacity and zoom level
+            });
+        }
+
+        // get capacity and location information of the stations in the visible area
+        function load() {
+            getColumnar('../apis/stations/', $.extend({
+                limit: 1000,
+                fields: 'lat,lon,station_id,capacity,name',
+                bbox: map.getBounds().toBBoxString() // minLon,minLat,maxLon,maxLat
+            }, filters)).then(resp => {
+
+                const columns = resp.columns;
+                const results = [];
+                for (let i = 0; i < resp.length; i++) {
+                    results.push({
+                        station_id: columns.station_id[i],
+                        name: columns.name[i],
+                        capacity: columns.capacity[i],
+                        LatLngObj: new L.LatLng(columns.lat[i], columns.lon[i]) // Location data object
+                    });
+                }
+
+                circles = g.selectAll('circle').data(results, d => d.station_id);
+                circles.exit().remove();
 
-            // add circles
-            const circles = g.selectAll("circle")
-                .data(results)
-                .enter()
-                .append("circle")
-                .attr({
-                    "stroke": "black",
-                    "stroke-width": 1,
-                    "opacity": .7,
-                    "fill": "red",
-                    "pointer-events": "visible"
-                })
-                .on('mouseover', function(d) {
-                    // show tooltip of station on mouseover
-                    tooltip.transition()		
-                        .duration(200)		
-                        .style('opacity', .9);		
-                    tooltip.html(d.name + '<br> capacity:' + d.capacity)	
-                        .style('left', (d3.event.pageX) + 'px')		
-                        .style('top', (d3.event.pageY - 28) + 'px');	
+                // add circles of the stations which have come into the area
+                circles.enter()
+                    .append("circle")
+                    .attr({
+                        "stroke": "black",
+                        "stroke-width": 1,
+                        "opacity": .7,
+                        "fill": "red",
+                        "pointer-events": "visible"
                     })
-                .on('mouseout', function(d) {
-                    tooltip.transition()		
-                        .duration(100)		
-                        .style('opacity', 0);
-                }); 
-                    
-            // update every time the map is reset
-            function update() {
-                circles.attr('transform', d => {
-                    const point = map.latLngToLayerPoint(d.LatLngObj)
-                    return `translate(${point.x}, ${point.y})`
-                });
-                zoom = map.getZoom();
-                circles.attr('r', d => {
-                    return d.capacity / 15 * 3 * (zoom / INITIAL_ZOOM_LEVEL) ** 2 // change circle size depending on capacity and zoom level
-                });
-            } 
-    
-            map.on('moveend', update);
-     
-            update(); // first update
+                    .on('mouseover', function(d) {
+                        // show tooltip of station on mouseover
+                        tooltip.transition()		
+                            .duration(200)		
+                            .style('opacity', .9);		
+                        tooltip.html(d.name + '<br> capacity:' + d.capacity)	
+                            .style('left', (d3.event.pageX) + 'px')		
+                            .style('top', (d3.event.pageY - 28) + 'px');	
+                        })
+                    .on('mouseout', function(d) {
+                        tooltip.transition()		
+                            .duration(100)		
+                            .style('opacity', 0);
+                    }); 
+
+                update();
+            });
+        }
+
+        // reposition the circles, and load the stations which have come into the area
+        map.on('moveend', () => {
+            update();
+            load();
         });
 
+        load(); // first load
+
     };
 
     // execute after finishing loading